@@ -0,0 +1,447 @@
+# ======================================================================
+#
+#   asnengine.py
+#
+# Offline IP-to-ASN lookup by longest prefix match, used as library by
+# asnlookup.py. A prefix table is loaded from a CAIDA pfx2as file, a RIB
+# dump in `bgpdump -m` format or a CSV file, e.g. the output of
+# ip2asn.sh, and flattened into sorted, disjoint address intervals: each
+# interval maps to the most specific prefix that covers it. A lookup is
+# then a binary search (numpy.searchsorted) over a whole batch of
+# addresses at once.
+#
+# The table is saved to a single file of aligned arrays, which is
+# memory-mapped on open, so the startup does not depend on its size.
+#
+# IPv6 intervals are kept on the upper 64 bits of the address; prefixes
+# longer than /64 are skipped while building, as they are not routed
+# globally.
+#
+# Usage:
+#
+#   PrefixTable.build(read_source("routeviews-rv2-pfx2as.txt.gz")).save("asn.db")
+#   table = PrefixTable.open("asn.db")
+#   for ip, pfx in zip(ips, table.lookup(ips)):
+#       print(ip, table.row(pfx) if pfx >= 0 else None)
+#
+# ======================================================================
+
+import bz2
+import csv
+import gzip
+import ipaddress
+import json
+import mmap
+import socket
+import sys
+
+import numpy as np
+
+
+MAGIC = b"MRITASN1"
+# Alignment of the arrays in the file
+ALIGN = 64
+
+# Columns of the prefix table, as written by ip2asn.sh
+COLUMNS = ("asn", "prefix", "cc", "rir", "allocated", "asname")
+
+
+def _open(path: str):
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", errors="replace")
+    if path.endswith(".bz2"):
+        return bz2.open(path, "rt", errors="replace")
+
+    return open(path, "r", errors="replace")
+
+
+def _asn(field: str) -> int:
+    """Returns the first ASN of a multi-origin (`1_2`) or AS set
+    (`{1,2}`) field.
+    """
+    field = field.strip().strip("{}").upper().removeprefix("AS")
+    for sep in ("_", ",", " "):
+        field = field.split(sep, 1)[0]
+
+    return int(field)
+
+
+def load_pfx2as(f):
+    """CAIDA Routeviews pfx2as: `<network>\\t<length>\\t<ASN>`."""
+    for line in f:
+        tokens = line.split()
+        if len(tokens) < 3 or line[0] == "#":
+            continue
+
+        try:
+            yield ipaddress.ip_network(f"{tokens[0]}/{tokens[1]}", strict=False), _asn(tokens[2]), {}
+        except ValueError:
+            continue
+
+
+def load_rib(f):
+    """RIB dump of `bgpdump -m`: `TABLE_DUMP2|<ts>|B|<peer>|<peer AS>|
+    <prefix>|<AS path>|...`. The origin is the last ASN of the path.
+    """
+    seen = set()
+
+    for line in f:
+        tokens = line.split("|")
+        if len(tokens) < 7 or not tokens[6].strip():
+            continue
+
+        prefix = tokens[5]
+        if prefix in seen:
+            # The same prefix as seen by another peer
+            continue
+
+        try:
+            network = ipaddress.ip_network(prefix, strict=False)
+            origin = _asn(tokens[6].split()[-1])
+        except ValueError:
+            continue
+
+        seen.add(prefix)
+        yield network, origin, {}
+
+
+def load_csv(f):
+    """CSV with a header that names the columns, at least `asn` and
+    `prefix`, e.g. the output of ip2asn.sh. Rows without a routed
+    prefix (`NA`) are skipped.
+    """
+    for row in csv.DictReader(f, skipinitialspace=True):
+        try:
+            network = ipaddress.ip_network(row["prefix"].strip(), strict=False)
+            asn = _asn(row["asn"])
+        except (KeyError, AttributeError, ValueError):
+            continue
+
+        yield network, asn, {k: (row.get(k) or "").strip() for k in COLUMNS[2:]}
+
+
+LOADERS = {
+    "pfx2as": load_pfx2as,
+    "rib": load_rib,
+    "csv": load_csv,
+}
+
+
+def detect(line: str) -> str:
+    if "|" in line:
+        return "rib"
+    if "," in line:
+        return "csv"
+
+    return "pfx2as"
+
+
+def read_source(path: str, fmt: str = "auto"):
+    """Yields (network, ASN, metadata) of a source file, which may be
+    compressed by gzip or bzip2.
+    """
+    with _open(path) as f:
+        if fmt == "auto":
+            first = f.readline()
+            fmt = detect(first)
+            lines = (line for chunk in ([first], f) for line in chunk)
+        else:
+            lines = f
+
+        yield from LOADERS[fmt](lines)
+
+
+def load_asnames(path: str) -> dict:
+    """Reads AS names in the format of RIPE's asn.txt: `<ASN> <name>`."""
+    names = {}
+
+    with _open(path) as f:
+        for line in f:
+            asn, _, name = line.strip().partition(" ")
+            try:
+                names[_asn(asn)] = name.strip()
+            except ValueError:
+                continue
+
+    return names
+
+
+def flatten(prefixes: list):
+    """Turns (start, end, value) prefixes into sorted, disjoint
+    intervals of the most specific value. Returns the starts, ends and
+    values as lists.
+    """
+    starts, ends, values = [], [], []
+
+    def emit(s, e, v):
+        if s > e:
+            return
+        if ends and ends[-1] == s - 1 and values[-1] == v:
+            ends[-1] = e
+            return
+
+        starts.append(s)
+        ends.append(e)
+        values.append(v)
+
+    # Covering prefixes before the ones they cover
+    prefixes.sort(key=lambda p: (p[0], -p[1]))
+
+    stack = []
+    pos = 0
+
+    for start, end, value in prefixes:
+        while stack and stack[-1][0] < start:
+            e, v = stack.pop()
+            emit(pos, e, v)
+            pos = max(pos, e + 1)
+
+        if stack:
+            emit(pos, start - 1, stack[-1][1])
+
+        pos = start
+        stack.append((end, value))
+
+    while stack:
+        e, v = stack.pop()
+        emit(pos, e, v)
+        pos = max(pos, e + 1)
+
+    return starts, ends, values
+
+
+class Strings:
+    """Deduplicated strings, stored as one UTF-8 blob with offsets."""
+
+    def __init__(self):
+        self._ids = {"": 0}
+        self._list = [""]
+
+    def add(self, s: str) -> int:
+        if (i := self._ids.get(s)) is None:
+            i = self._ids[s] = len(self._list)
+            self._list.append(s)
+
+        return i
+
+    def arrays(self):
+        encoded = [s.encode() for s in self._list]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.uint64)
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+
+        return np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets
+
+
+class PrefixTable:
+    """Interval arrays of the longest prefix match, with the ASN and
+    metadata per prefix.
+    """
+
+    def __init__(self, arrays: dict, mm=None):
+        self.arrays = arrays
+        self._mm = mm
+        self._strings = {}
+
+        for name, value in arrays.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.pfx_asn)
+
+    @classmethod
+    def build(cls, entries, asnames: dict = None):
+        """Builds the table of (network, ASN, metadata) entries. A later
+        entry of the same prefix replaces an earlier one.
+        """
+        asnames = asnames or {}
+        strings = Strings()
+        index = {}
+        skipped = 0
+
+        for network, asn, meta in entries:
+            if network.version == 6 and network.prefixlen > 64:
+                skipped += 1
+                continue
+
+            name = meta.get("asname") or asnames.get(asn, "")
+            index[network] = (
+                asn,
+                strings.add(str(network)),
+                strings.add(meta.get("cc", "")),
+                strings.add(meta.get("rir", "")),
+                strings.add(meta.get("allocated", "")),
+                strings.add(name),
+            )
+
+        if skipped:
+            sys.stderr.write(f"[WW] Skipped {skipped} IPv6 prefixes longer than /64\n")
+
+        v4, v6 = [], []
+        rows = []
+        for network, row in index.items():
+            i = len(rows)
+            rows.append(row)
+
+            if network.version == 4:
+                v4.append((int(network.network_address), int(network.broadcast_address), i))
+            else:
+                v6.append((int(network.network_address) >> 64, int(network.broadcast_address) >> 64, i))
+
+        rows = np.array(rows, dtype=np.uint32).reshape(-1, 6)
+        blob, offsets = strings.arrays()
+        arrays = {
+            "pfx_asn": rows[:, 0].copy(),
+            "pfx_prefix": rows[:, 1].copy(),
+            "pfx_cc": rows[:, 2].copy(),
+            "pfx_rir": rows[:, 3].copy(),
+            "pfx_allocated": rows[:, 4].copy(),
+            "pfx_asname": rows[:, 5].copy(),
+            "str_blob": blob,
+            "str_offsets": offsets,
+        }
+
+        for family, prefixes, dtype in (("v4", v4, np.uint32), ("v6", v6, np.uint64)):
+            starts, ends, values = flatten(prefixes)
+            arrays[f"{family}_start"] = np.array(starts, dtype=dtype)
+            arrays[f"{family}_end"] = np.array(ends, dtype=dtype)
+            arrays[f"{family}_pfx"] = np.array(values, dtype=np.int32)
+
+        return cls(arrays)
+
+    def save(self, path: str):
+        """Writes the arrays to a single file: the magic, the length of
+        a JSON header with the dtype, length and offset of each array,
+        the header, and the arrays at aligned offsets.
+        """
+        header = {}
+        offset = 0
+        for name, a in self.arrays.items():
+            header[name] = [a.dtype.str, len(a), offset]
+            offset += -(-a.nbytes // ALIGN) * ALIGN
+
+        encoded = json.dumps(header).encode()
+        base = -(-(len(MAGIC) + 8 + len(encoded)) // ALIGN) * ALIGN
+
+        with open(path, "wb") as f:
+            f.write(MAGIC)
+            f.write(len(encoded).to_bytes(8, "little"))
+            f.write(encoded)
+            f.write(b"\0" * (base - f.tell()))
+
+            for name, a in self.arrays.items():
+                f.seek(base + header[name][2])
+                f.write(np.ascontiguousarray(a).tobytes())
+
+            f.truncate(base + offset)
+
+    @classmethod
+    def open(cls, path: str):
+        """Maps a saved table into memory. The arrays are read-only views
+        of the file.
+        """
+        with open(path, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a prefix table")
+
+        length = int.from_bytes(mm[len(MAGIC):len(MAGIC) + 8], "little")
+        start = len(MAGIC) + 8
+        header = json.loads(mm[start:start + length])
+        base = -(-(start + length) // ALIGN) * ALIGN
+
+        arrays = {
+            name: np.frombuffer(mm, dtype=np.dtype(dtype), count=count, offset=base + offset)
+            for name, (dtype, count, offset) in header.items()
+        }
+
+        return cls(arrays, mm)
+
+    def string(self, i: int) -> str:
+        if (s := self._strings.get(i)) is None:
+            lo, hi = int(self.str_offsets[i]), int(self.str_offsets[i + 1])
+            s = self._strings[i] = self.str_blob[lo:hi].tobytes().decode()
+
+        return s
+
+    @staticmethod
+    def _search(starts, ends, values, keys):
+        if not len(starts):
+            return np.full(len(keys), -1, dtype=np.int32)
+
+        i = np.searchsorted(starts, keys, side="right") - 1
+        found = i >= 0
+        i[~found] = 0
+        found &= keys <= ends[i]
+
+        return np.where(found, values[i], -1).astype(np.int32)
+
+    def lookup4(self, keys: np.ndarray) -> np.ndarray:
+        """Returns the prefix IDs of IPv4 addresses given as uint32, -1
+        where no prefix matches.
+        """
+        return self._search(self.v4_start, self.v4_end, self.v4_pfx, keys.astype(np.uint32))
+
+    def lookup6(self, keys: np.ndarray) -> np.ndarray:
+        """Returns the prefix IDs of IPv6 addresses given by their upper
+        64 bits as uint64.
+        """
+        return self._search(self.v6_start, self.v6_end, self.v6_pfx, keys.astype(np.uint64))
+
+    def lookup(self, ips: list) -> np.ndarray:
+        """Returns the prefix IDs of IP addresses given as strings, -1
+        for unrouted or invalid addresses.
+        """
+        result = np.full(len(ips), -1, dtype=np.int32)
+        v4, v4_idx, v6, v6_idx = parse(ips)
+
+        if v4_idx:
+            result[v4_idx] = self.lookup4(v4)
+        if v6_idx:
+            result[v6_idx] = self.lookup6(v6)
+
+        return result
+
+    def row(self, pfx: int) -> tuple:
+        """Returns the columns of a prefix, in the order of COLUMNS."""
+        return (
+            int(self.pfx_asn[pfx]),
+            self.string(self.pfx_prefix[pfx]),
+            self.string(self.pfx_cc[pfx]),
+            self.string(self.pfx_rir[pfx]),
+            self.string(self.pfx_allocated[pfx]),
+            self.string(self.pfx_asname[pfx]),
+        )
+
+
+def parse(ips: list):
+    """Splits IP address strings into IPv4 addresses as uint32 and the
+    upper 64 bits of IPv6 addresses as uint64, each with their positions
+    in the input. Invalid addresses are left out.
+    """
+    v4, v4_idx, v6, v6_idx = [], [], [], []
+    pton = socket.inet_pton
+    AF_INET, AF_INET6 = socket.AF_INET, socket.AF_INET6
+
+    for i, ip in enumerate(ips):
+        try:
+            v4.append(pton(AF_INET, ip))
+            v4_idx.append(i)
+            continue
+        except OSError:
+            pass
+
+        try:
+            v6.append(pton(AF_INET6, ip)[:8])
+            v6_idx.append(i)
+        except OSError:
+            pass
+
+    return (
+        np.frombuffer(b"".join(v4), dtype=">u4").astype(np.uint32),
+        v4_idx,
+        np.frombuffer(b"".join(v6), dtype=">u8").astype(np.uint64),
+        v6_idx,
+    )
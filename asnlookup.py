@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+# ======================================================================
+#
+#   asnlookup.py
+#
+# Offline IP-to-ASN lookup. Reads IP addresses from STDIN, or from a
+# column of a Parquet file, and writes the origin ASN and the most
+# specific routed prefix of each address as CSV to STDOUT, with the
+# columns of ip2asn.sh. No remote service is queried: the answers come
+# from a local prefix table (see asnengine.py), which is built once from
+# a CAIDA pfx2as file, a RIB dump or a CSV file:
+#
+#   asnlookup.py --db asn.db --build routeviews-rv2-20241001-1200.pfx2as.gz
+#   asnlookup.py --db asn.db < ips.txt
+#
+# The addresses are looked up in batches by binary search over the
+# memory-mapped table. The output keeps the order of the input; as with
+# ip2asn.sh, addresses without a routed prefix have no row.
+#
+# ======================================================================
+
+import argparse
+import os
+import socket
+import sys
+import time
+
+import numpy as np
+
+from asnengine import PrefixTable, load_asnames, read_source
+
+
+# Number of addresses looked up at once
+BATCH = 1 << 16
+
+HEADER = "asn,ip,prefix,cc,rir,allocated,asname"
+
+
+def err(msg, do_flush=True):
+    sys.stderr.write(msg)
+    sys.stderr.write('\n')
+
+    if do_flush:
+        sys.stderr.flush()
+
+
+class Formatter:
+    """Formats the CSV rows, with the columns of each prefix formatted
+    once.
+    """
+
+    def __init__(self, table: PrefixTable):
+        self.table = table
+        self._rows = {}
+
+    def _columns(self, pfx: int) -> tuple:
+        asn, prefix, cc, rir, allocated, asname = self.table.row(pfx)
+        asname = asname.replace('"', '""')
+        cols = self._rows[pfx] = (f"{asn},", f',{prefix},{cc},{rir},{allocated},"{asname}"\n')
+
+        return cols
+
+    def rows(self, ips: list, pfx: list) -> str:
+        """Returns the rows of the routed addresses."""
+        get = self._rows.get
+        out = []
+
+        for ip, p in zip(ips, pfx):
+            if p >= 0:
+                cols = get(p) or self._columns(p)
+                out.append(cols[0] + ip + cols[1])
+
+        return "".join(out)
+
+
+def read_stdin():
+    """Yields batches of the addresses of STDIN, without empty lines and
+    comments.
+    """
+    while lines := sys.stdin.buffer.readlines(BATCH * 16):
+        batch = [line.strip().decode(errors="replace") for line in lines]
+        yield [ip for ip in batch if ip and ip[0] != "#"]
+
+
+def read_parquet(path: str, column: str):
+    """Yields batches of the addresses of a Parquet column. Integer
+    columns are read as IPv4 addresses.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    for batch in pq.ParquetFile(path).iter_batches(batch_size=BATCH, columns=[column]):
+        values = batch.column(0)
+
+        if pa.types.is_integer(values.type):
+            ints = values.drop_null().to_numpy()
+            yield ints
+        else:
+            yield [ip for ip in values.to_pylist() if ip]
+
+
+def lookup(table: PrefixTable, batches, output):
+    """Looks up the batches and writes the rows. Returns the number of
+    addresses and of routed addresses.
+    """
+    fmt = Formatter(table)
+    total = routed = 0
+
+    for batch in batches:
+        if isinstance(batch, np.ndarray):
+            pfx = table.lookup4(batch)
+            ips = [socket.inet_ntoa(int(n).to_bytes(4, "big")) for n in batch]
+        else:
+            pfx = table.lookup(batch)
+            ips = batch
+
+        output.write(fmt.rows(ips, pfx.tolist()))
+
+        total += len(ips)
+        routed += int((pfx >= 0).sum())
+
+    return total, routed
+
+
+def build(args):
+    asnames = load_asnames(args.asnames) if args.asnames else None
+
+    def entries():
+        for path in args.build:
+            yield from read_source(path, args.source_format)
+
+    s = time.perf_counter()
+    table = PrefixTable.build(entries(), asnames)
+    table.save(args.db)
+
+    err(
+        f"[OK] {len(table)} prefixes, {len(table.v4_start)} IPv4 and {len(table.v6_start)} IPv6 "
+        f"intervals written to {args.db} in {time.perf_counter() - s:0.1f} seconds"
+    )
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Look up the origin ASN and prefix of IP addresses in a local prefix table",
+    )
+    parser.add_argument(
+        "-d",
+        "--db",
+        type=str,
+        default=os.environ.get("MRIT_ASN_DB"),
+        help="Prefix table file ; By default $MRIT_ASN_DB",
+    )
+    parser.add_argument(
+        "--build",
+        type=str,
+        nargs="+",
+        metavar="SOURCE",
+        help="Build the prefix table from pfx2as, RIB dump (bgpdump -m) or CSV files, "
+        "optionally compressed, and exit ; Later files take precedence",
+    )
+    parser.add_argument(
+        "--source-format",
+        choices=["auto", "pfx2as", "rib", "csv"],
+        default="auto",
+        help="Format of the sources of --build ; By default detected from the first line",
+    )
+    parser.add_argument(
+        "--asnames",
+        type=str,
+        metavar="PATH",
+        help="AS names in the format of RIPE's asn.txt, for sources without names",
+    )
+    parser.add_argument(
+        "--parquet",
+        type=str,
+        metavar="PATH",
+        help="Read the addresses from a Parquet file instead of STDIN",
+    )
+    parser.add_argument(
+        "--column",
+        type=str,
+        default="ip",
+        help="Column of the addresses in the Parquet file ; By default ip",
+    )
+
+    args = parser.parse_args()
+
+    if not args.db:
+        parser.error("a prefix table is required, see --db")
+
+    return args
+
+
+def main():
+    args = parse_args()
+
+    if args.build:
+        build(args)
+        return
+
+    table = PrefixTable.open(args.db)
+    batches = read_parquet(args.parquet, args.column) if args.parquet else read_stdin()
+
+    s = time.perf_counter()
+
+    try:
+        sys.stdout.write(HEADER + "\n")
+        total, routed = lookup(table, batches, sys.stdout)
+        sys.stdout.flush()
+    except KeyboardInterrupt:
+        sys.exit(255)
+    except BrokenPipeError:
+        # STDOUT is closed early, e.g. by `head`
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+    elapsed = time.perf_counter() - s
+    err(
+        f"[OK] {total} addresses, {routed} routed, in {elapsed:0.2f} seconds "
+        f"({total / elapsed if elapsed else 0.0:0.0f} per second)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -6,134 +6,653 @@
 #
 # Small lookup tool that simply reads from STDIN, parses the input line
 # by line. Each line that looks like a domain name will be resolved by
-# using `dig`. The output will be in CSV format and printed to STDOUT.
+# the asynchronous DNS engine in `dnsengine.py`. Many lines are resolved
+# concurrently, but the output is written in input order. The output
+# will be in CSV format and printed to STDOUT.
+#
+# A nameserver can be defined similar to `dig` with the `@` operator,
+# e.g. `@9.9.9.9`. By default, the nameserver from /etc/resolv.conf is
+# used.
 #
 # ======================================================================
 
-import subprocess
+import argparse
+import asyncio
+import collections
+import ipaddress
 import sys
 
+from dnscache import Cache, CachedResolver
+from dnsengine import DNSError, NXDOMAIN, Resolver, fqdn, reverse_name
+from journal import Journal
+
 
-BIN = "/usr/bin/dig"
 ENCODING = "utf-8"
 
+# Number of input lines that are read at once
+READ_HINT = 1 << 16
 
-def query_ptr(ip: str, nameserver: str = None):
-    ip = ip.lower()
+# Longest CNAME chain that is followed
+MAX_CNAME_DEPTH = 16
 
-    args = [BIN]
-    if nameserver:
-        args.append(f"@{nameserver}")
 
-    args.append("+short")
-    args.append("-x")
-    args.append(ip)
+def stderr(msg):
+    sys.stderr.write(msg)
+    sys.stderr.write("\n")
+    sys.stderr.flush()
 
-    try:
-        return subprocess.check_output(args).decode(ENCODING).strip()
-    except subprocess.CalledProcessError:
-        return None
 
-def query(domain_name: str, qtype: str, nameserver: str = None):
-    domain_name = domain_name.lower()
-    qtype = qtype.upper()
+def stdout(results):
+    for r in results:
+        sys.stdout.write(",".join(r))
+        sys.stdout.write("\n")
 
-    # TODO: Add filter to query type
-    # if qtype not in ['A', 'AAAA', 'CNAME', ...]
-    args = [BIN]
 
-    if nameserver:
-        args.append(f"@{nameserver}")
+async def _answers(resolver: Resolver, name: str, qtype: str):
+    """Returns the RDATA of all records of the given type in the answer
+    section, similar to `dig +short`. Returns None if the query fails.
+    """
+    try:
+        msg = await resolver.query(name, qtype)
+    except (DNSError, ValueError):
+        return None
 
-    args.append(domain_name)
-    args.append(qtype)
-    args.append("+short")
+    return [rr.data for rr in msg.answers if rr.rtype == qtype]
 
+
+async def query_ptr(resolver: Resolver, ip: str):
     try:
-        return subprocess.check_output(args).decode(ENCODING).strip()
-    except subprocess.CalledProcessError:
+        name = reverse_name(ip)
+    except ValueError:
         return None
 
+    return await _answers(resolver, name, "PTR")
+
+
+class Resolution:
+    """Result of a forward lookup: the CNAME chain as list of tuples
+    (owner, target) and the addresses of the final name. `failed` is set
+    if a query got no answer, e.g. due to a timeout.
+    """
+    __slots__ = ("chain", "a", "aaaa", "loop", "failed")
+
+    def __init__(self, chain=None, a=None, aaaa=None, loop=False, failed=False):
+        self.chain = chain or []
+        self.a = a or []
+        self.aaaa = aaaa or []
+        self.loop = loop
+        self.failed = failed
+
+
+class Planner:
+    """Plans the queries of a forward lookup. A and AAAA are sent in
+    parallel and the CNAME chain is taken from their answer sections,
+    instead of querying every hop on its own. The results of all names
+    in a chain are memoized, since many names point to the same few
+    CDN edge names.
+
+    Args:
+        resolver (Resolver): DNS engine to send the queries to.
+        memo_size (int): Number of memoized names.
+    """
+
+    def __init__(self, resolver: Resolver, memo_size: int = 65536):
+        self.resolver = resolver
+        self.memo_size = memo_size
+        self._memo = collections.OrderedDict()
+
+    def _remember(self, name: str, fut: asyncio.Future):
+        self._memo[name] = fut
+        self._memo.move_to_end(name)
+
+        while len(self._memo) > self.memo_size:
+            self._memo.popitem(last=False)
+
+    def _memoized(self, name: str, resolution: Resolution):
+        fut = asyncio.get_running_loop().create_future()
+        fut.set_result(resolution)
+        self._remember(name, fut)
+
+    async def _query(self, name: str, qtype: str):
+        try:
+            return await self.resolver.query(name, qtype)
+        except (DNSError, ValueError):
+            return None
+
+    async def lookup(self, name: str) -> Resolution:
+        """Resolves a name; concurrent lookups of the same name share
+        the same queries.
+        """
+        name = fqdn(name)
+
+        if fut := self._memo.get(name):
+            self._memo.move_to_end(name)
+            return await fut
+
+        task = asyncio.ensure_future(self._resolve(name, {name}))
+        self._remember(name, task)
+        task.add_done_callback(lambda t: self._forget_failed(name, t))
+        return await task
+
+    def _forget_failed(self, name: str, fut: asyncio.Future):
+        """Drops a failed lookup from the memo, so that a later lookup
+        of the name queries again.
+        """
+        if self._memo.get(name) is not fut:
+            return
+
+        if fut.cancelled() or fut.exception() is not None or fut.result().failed:
+            del self._memo[name]
+
+    async def _follow(self, name: str, seen: set) -> Resolution:
+        """Looks up the target of an incomplete chain. Pending memo
+        entries are not awaited here, since two chains pointing at each
+        other would wait on each other forever.
+        """
+        fut = self._memo.get(name)
+        if fut is not None and fut.done():
+            self._memo.move_to_end(name)
+            return fut.result()
+
+        return await self._resolve(name, seen)
+
+    async def _resolve(self, name: str, seen: set) -> Resolution:
+        msgs = await asyncio.gather(
+            self._query(name, "A"),
+            self._query(name, "AAAA"),
+        )
+
+        cnames = {}
+        addrs = {"A": {}, "AAAA": {}}
+        failed = False
+
+        for msg in msgs:
+            if msg is None:
+                failed = True
+                continue
+
+            for rr in msg.answers:
+                if rr.rtype == "CNAME":
+                    cnames.setdefault(rr.name, rr.data)
+                elif rr.rtype == "A" or rr.rtype == "AAAA":
+                    addrs[rr.rtype].setdefault(rr.name, [])
+                    if rr.data not in addrs[rr.rtype][rr.name]:
+                        addrs[rr.rtype][rr.name].append(rr.data)
+
+        # Follow the chain in the answer sections
+        chain = []
+        target = name
+
+        while target in cnames:
+            nxt = cnames[target]
+            chain.append((target, nxt))
+
+            if nxt in seen or len(seen) > MAX_CNAME_DEPTH:
+                stderr(f"[WW] CNAME loop or chain too long: {name}")
+                return Resolution(chain, loop=True, failed=failed)
+
+            seen.add(nxt)
+            target = nxt
+
+        res = Resolution(chain, addrs["A"].get(target), addrs["AAAA"].get(target), failed=failed)
+
+        if chain and not res.a and not res.aaaa and cnames.get(target) is None:
+            # The nameserver did not chase the chain to the end, e.g.
+            # due to a timeout. Resolve the last target on its own.
+            sub = await self._follow(target, seen)
+            res = Resolution(chain + sub.chain, sub.a, sub.aaaa, sub.loop, failed or sub.failed)
 
-def resolve(
+            if target not in self._memo and not sub.failed:
+                self._memoized(target, sub)
+        elif chain and not failed:
+            # Every name in the chain is resolved, memoize the tail
+            for i, (owner, _) in enumerate(chain[1:], start=1):
+                if owner not in self._memo:
+                    self._memoized(owner, Resolution(chain[i:], res.a, res.aaaa))
+            if target not in self._memo:
+                self._memoized(target, Resolution([], res.a, res.aaaa))
+
+        return res
+
+
+async def resolve(
     q,
-    nameserver: str = None,
+    planner: Planner,
     reverse_lookup: bool = False,
 ):
     results = []
 
     if reverse_lookup:
-        if q_res := query_ptr(q, nameserver=nameserver):
-            for line in q_res.splitlines():
-                if len(line) <= 0:
-                    continue
-                results.append((nameserver, q, "PTR", line))
+        if q_res := await query_ptr(planner.resolver, q):
+            for line in q_res:
+                results.append((q, "PTR", line))
         else:
             results.append((q, "PTR", "null"))
-    else:
-        while cname := query(q, "CNAME", nameserver=nameserver):
-            results.append(([q, "CNAME", cname]))
-            q = cname
-
-        if q_res:= query(q, "A", nameserver=nameserver):
-            for line in q_res.splitlines():
-                if len(line) <= 0:
-                    continue
 
-                results.append((q, "A", line))
-        else:
-            results.append((q, "A", "null"))
+        return results
 
-        if q_res := query(q, "AAAA", nameserver=nameserver):
-            for line in q_res.splitlines():
-                if len(line) <= 0:
-                    continue
+    res = await planner.lookup(q)
+
+    for i, (_, cname) in enumerate(res.chain):
+        # Keep the input as first owner name, like the original output
+        results.append((q if i == 0 else res.chain[i][0], "CNAME", cname))
 
-                results.append((q, "AAAA", line))
+    if res.chain:
+        q = res.chain[-1][1]
+
+    for qtype, addrs in (("A", res.a), ("AAAA", res.aaaa)):
+        if addrs and not res.loop:
+            for line in addrs:
+                results.append((q, qtype, line))
         else:
-            results.append((q, "AAAA", "null"))
+            results.append((q, qtype, "null"))
 
     return results
 
 
-def main():
+def arpa_name(net) -> str:
+    """Returns the in-addr.arpa / ip6.arpa name of an octet or nibble
+    aligned network, e.g. `2.0.192.in-addr.arpa.` for 192.0.2.0/24.
+    """
+    if net.version == 4:
+        labels = [str(b) for b in net.network_address.packed[:net.prefixlen // 8]]
+        return ".".join(list(reversed(labels)) + ["in-addr", "arpa", ""]) if labels else "in-addr.arpa."
+
+    nibbles = net.network_address.packed.hex()[:net.prefixlen // 4]
+    return ".".join(list(reversed(nibbles)) + ["ip6", "arpa", ""])
+
+
+class Sweep:
+    """Reverse-DNS sweep over a network. The reverse tree is walked depth
+    first by a fixed number of workers, the names are generated lazily
+    per node. A subtree is pruned if its node returns NXDOMAIN, since
+    then there are no names below it (RFC 8020). This is what makes the
+    enumeration of IPv6 networks tractable at all.
+
+    Args:
+        resolver (Resolver): DNS engine to send the queries to.
+        workers (int): Number of nodes that are queried concurrently.
+        depth (int): Prefix length of the IPv6 leaves, a multiple of 4.
+            Leaves shorter than /128 are written as `exists` rows.
+    """
+
+    def __init__(self, resolver: Resolver, workers: int = 256, depth: int = 128):
+        self.resolver = resolver
+        self.workers = workers
+        self.depth = depth
+
+        self.queries = 0
+        self.pruned = 0
+        self.failed = 0
+        self.found = 0
+
+    def _step(self, net):
+        return 8 if net.version == 4 else 4
+
+    def _limit(self, net):
+        return 32 if net.version == 4 else self.depth
+
+    def _roots(self, net):
+        """Aligns a network to the next octet or nibble boundary."""
+        step = self._step(net)
+        aligned = min(self._limit(net), -(-net.prefixlen // step) * step)
+
+        if aligned <= net.prefixlen:
+            return [net]
+
+        return net.subnets(new_prefix=aligned)
+
+    async def _query(self, name: str):
+        self.queries += 1
+
+        try:
+            return await self.resolver.query(name, "PTR")
+        except (DNSError, ValueError):
+            self.failed += 1
+            return None
+
+    async def _node(self, net, stack: list, rows: list):
+        msg = await self._query(arpa_name(net))
+
+        if msg is None:
+            stderr(f"[WW] Failed to query {net}, subtree skipped")
+            return
+
+        if msg.rcode == NXDOMAIN:
+            self.pruned += 1
+            return
+
+        if net.prefixlen == net.max_prefixlen:
+            for rr in msg.answers:
+                if rr.rtype == "PTR":
+                    rows.append((str(net.network_address), "PTR", rr.data))
+                    self.found += 1
+        elif net.prefixlen >= self._limit(net):
+            rows.append((str(net), "PTR", "exists"))
+            self.found += 1
+        else:
+            # Push in reverse order to walk the tree in address order
+            children = list(net.subnets(new_prefix=net.prefixlen + self._step(net)))
+            stack.extend(reversed(children))
+
+    async def run(self, network: str):
+        """Sweeps a network and writes the PTR rows to STDOUT as soon as
+        they are found.
+        """
+        net = ipaddress.ip_network(network, strict=False)
+
+        if net.version == 6 and self.depth % 4:
+            raise ValueError("IPv6 sweep depth must be a multiple of 4")
+
+        # LIFO stack of nodes; its size is bounded by depth * fan-out
+        stack = list(reversed(list(self._roots(net))))
+        busy = 0
+        wakeup = asyncio.Event()
+
+        async def worker():
+            nonlocal busy
+
+            while True:
+                if not stack:
+                    if busy == 0:
+                        wakeup.set()
+                        return
+
+                    # Another worker may still push children
+                    wakeup.clear()
+                    await wakeup.wait()
+                    continue
 
-    # TODO: Add feature to reverse lookup
+                node = stack.pop()
+                busy += 1
+                rows = []
+
+                try:
+                    await self._node(node, stack, rows)
+                finally:
+                    busy -= 1
+                    wakeup.set()
+
+                if rows:
+                    stdout(rows)
+                    sys.stdout.flush()
+
+        await asyncio.gather(*[worker() for _ in range(self.workers)])
+
+    def report(self):
+        stderr(
+            f"Sweep: {self.queries} queries, {self.pruned} subtrees pruned, "
+            f"{self.failed} failed, {self.found} records found"
+        )
+
+
+async def readlines(stream):
+    """Reads lines from a stream without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+
+    while lines := await loop.run_in_executor(None, stream.readlines, READ_HINT):
+        for line in lines:
+            yield line
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Bulk-resolve domain names from STDIN to CSV",
+    )
+    parser.add_argument(
+        "nameserver",
+        nargs="*",
+        metavar="@nameserver",
+        help="Nameservers to query, e.g. @9.9.9.9 @1.1.1.1 ; By default from /etc/resolv.conf",
+    )
+    parser.add_argument(
+        "-f",
+        "--nameservers",
+        type=str,
+        metavar="FILE",
+        help="File with one nameserver per line, added to the @nameserver arguments",
+    )
+    parser.add_argument(
+        "-x",
+        dest="reverse_lookup",
+        action="store_true",
+        help="Reverse lookup of IP addresses",
+    )
+    parser.add_argument(
+        "--sweep",
+        action="store_true",
+        help="Reverse-DNS sweep over the networks in the input, e.g. 192.0.2.0/22",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=128,
+        help="Prefix length of the IPv6 sweep leaves, multiple of 4 ; By default 128",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=1024,
+        help="Maximum number of queries in flight ; By default 1024",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=2.0,
+        help="Timeout of a single query attempt in seconds ; By default 2",
+    )
+    parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=2,
+        help="Number of retries per query ; By default 2",
+    )
+    parser.add_argument(
+        "--memo-size",
+        type=int,
+        default=65536,
+        help="Number of names whose resolution is kept in memory ; By default 65536",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        metavar="PATH",
+        help="SQLite file to cache the responses between runs",
+    )
+    parser.add_argument(
+        "--cache-size",
+        type=int,
+        default=65536,
+        help="Number of cached responses kept in memory ; By default 65536",
+    )
+    parser.add_argument(
+        "--min-ttl",
+        type=int,
+        default=0,
+        help="Lower bound of the cache TTL in seconds ; By default 0",
+    )
+    parser.add_argument(
+        "--max-ttl",
+        type=int,
+        default=86400,
+        help="Upper bound of the cache TTL in seconds ; By default 86400",
+    )
+    parser.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="Answer from the cache only, do not send any query",
+    )
+    parser.add_argument(
+        "--window",
+        type=int,
+        default=32,
+        help="Initial number of queries in flight per nameserver ; By default 32",
+    )
+    parser.add_argument(
+        "--journal",
+        type=str,
+        metavar="PATH",
+        help="Checkpoint file to resume an interrupted run",
+    )
+    parser.add_argument(
+        "--sockets",
+        type=int,
+        default=4,
+        help="Number of UDP sockets per nameserver ; By default 4",
+    )
+
+    args = parser.parse_args()
+
+    for ns in args.nameserver:
+        if not ns.startswith("@"):
+            parser.error(f"Nameserver must start with `@`: {ns}")
+
+    if args.cache_only and not args.cache:
+        parser.error("--cache-only requires --cache")
+
+    args.nameserver = [ns[1:] for ns in args.nameserver]
+
+    if args.nameservers:
+        with open(args.nameservers, "r") as f:
+            for line in f:
+                line = line.strip()
+                if line and line[0] != "#":
+                    args.nameserver.append(line.lstrip("@"))
+
+    return args
+
+
+async def main_sweep(args, resolver, pool, journal: Journal = None):
+    sweep = Sweep(resolver, workers=args.concurrency, depth=args.depth)
+
+    async with resolver:
+        idx = -1
+        async for line in readlines(sys.stdin):
+            idx += 1
+            line = line.strip()
 
-    # Parse arguments...
-    nameserver = None
-    reverse_lookup = False
+            if not line or line[0] == "#":
+                if journal:
+                    journal.complete(idx)
+                continue
 
-    for arg in sys.argv:
-        arg = arg.strip()
-        
-        # Check on dig @nameserver argument
-        if arg[0] == "@":
-            nameserver = arg[1:]
-        elif arg == "-x":
-            reverse_lookup = True
+            if journal and journal.done(idx):
+                continue
 
+            try:
+                await sweep.run(line)
+            except ValueError as e:
+                stderr(f"[EE] Cannot sweep {line}: {e}")
+
+            if journal:
+                journal.complete(idx)
+
+        sweep.report()
+
+        if len(pool.servers) > 1:
+            pool.report()
+
+
+async def main_resolve(args, planner: Planner, pool, journal: Journal = None):
+    resolver = planner.resolver
+
+    # Tasks in input order. Results are written once the oldest task
+    # is done, so the output is in the same order as the input.
+    window = collections.deque()
+
+    def write(idx, results):
+        stdout(results)
+        if journal:
+            journal.complete(idx)
+
+    async with resolver:
+        idx = -1
+        async for line in readlines(sys.stdin):
+            idx += 1
 
-    # Loop over STDIN and resolve domain names
-    try:
-        for line in sys.stdin:
             # Prepare the input data ...
             line = line.strip(' \t.\r\n')
 
             if not line or line[0] == "#":
                 # Skip empty lines or in-line comments
+                if journal:
+                    journal.complete(idx)
+                continue
+
+            if journal and journal.done(idx):
+                # Done in a previous run
                 continue
 
             # Lookup all CNAMES, IPv4 and IPv6
-            results = resolve(line, nameserver=nameserver, reverse_lookup=reverse_lookup)
+            window.append((idx, asyncio.create_task(
+                resolve(line, planner, reverse_lookup=args.reverse_lookup)
+            )))
 
-            for r in results:
-                sys.stdout.write(",".join(r))
-                sys.stdout.write("\n")
+            written = False
+            while len(window) >= args.concurrency or (window and window[0][1].done()):
+                i, task = window.popleft()
+                write(i, await task)
+                written = True
+
+            if written:
                 sys.stdout.flush()
-    except KeyboardInterrupt:
-        pass
+
+        while window:
+            i, task = window.popleft()
+            write(i, await task)
+
+        sys.stdout.flush()
+
+        if len(pool.servers) > 1:
+            pool.report()
+
+
+async def main():
+    args = parse_args()
+
+    resolver = Resolver(
+        args.nameserver,
+        sockets=args.sockets,
+        timeout=args.timeout,
+        retries=args.retries,
+        concurrency=args.concurrency,
+        window=args.window,
+    )
+    pool = resolver
+
+    cache = None
+    if args.cache:
+        cache = Cache(
+            args.cache,
+            size=args.cache_size,
+            min_ttl=args.min_ttl,
+            max_ttl=args.max_ttl,
+        )
+        resolver = CachedResolver(resolver, cache, cache_only=args.cache_only)
+
+    planner = Planner(resolver, memo_size=args.memo_size)
+
+    journal = Journal(args.journal) if args.journal else None
+
+    try:
+        if args.sweep:
+            await main_sweep(args, resolver, pool, journal)
+        else:
+            await main_resolve(args, planner, pool, journal)
+    finally:
+        if journal:
+            journal.close()
+
+    if cache is not None:
+        resolver.report()
+        cache.close()
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -15,14 +15,28 @@
 # ======================================================================
 
 import asyncio
+import ipaddress
 import subprocess
 import sys
 import time
 
+from dnscache import Cache, CachedResolver
+from dnsengine import DNSError, Resolver
+from journal import Journal
+from topology import Topology
+from tracengine import DoubletreeTracer, RawBackend, SimulatedBackend, StatelessTracer, path_rows
+
 BIN = "/usr/bin/traceroute"
 ENCODING = "utf-8"
-# Limit on the number of traceroute calls
+# Default limit on the number of concurrent traceroute calls, set by
+# --concurrency=N
 SUBPROCESS_SEMAPHORE_LIMIT = 64
+# Number of input lines that are read at once
+READ_HINT = 1 << 16
+# Number of targets the stateless engine probes at once
+STATELESS_BLOCK = 1 << 16
+# First TTL of the Doubletree mode, set by --doubletree=N
+DOUBLETREE_START = 4
 
 
 def stderr(msg):
@@ -38,55 +52,90 @@ def stdout(results):
         sys.stdout.flush()
 
 
-def _parse_probes(tokens):
-    """Parses a set of probes and returns them as a list of tuples."""
+def _parse_probes(tokens, i=0):
+    """Parses the probes of a hop line, starting at token `i`, and
+    returns them as a list of tuples. The tokens are consumed by index,
+    so a hop line is parsed in linear time, however many probes it has.
+    """
     probes = []
+    n = len(tokens)
 
     name = ""
     ip = ""
-    rtt = 0.0
-    annotation = ""
 
-    while len(tokens):
-        t1 = tokens.pop(0)
+    while i < n:
+        t1 = tokens[i]
+        i += 1
 
         if t1 == '*':
             # Skip probe wildcards
-            while len(tokens) > 0 and tokens[0] == '*':
-                tokens.pop(0)
+            while i < n and tokens[i] == '*':
+                i += 1
             probes.append(("*", "*", -1.0, ""))
             continue
 
-        t2 = tokens.pop(0).strip(" (),.")
+        t2 = tokens[i].strip(" (),.")
+        i += 1
 
         if t2 == 'ms':
             # Same probe signature with another RTT
-            # Thus, fill the tokens to be parsed properly at the end of
-            # the while loop
-            t3 = t1
-            t2 = ip
-            t1 = name
+            rtt = t1
+        elif i < n and tokens[i] == 'ms':
+            # New probe signature without name, e.g. `traceroute -n`
+            name, ip, rtt = t1, t1, t2
+            i += 1
         else:
             # New probe signature
-            t3 = tokens.pop(0)
-            # Drop "ms"
-            tokens.pop(0)
-        
-        name, ip, rtt, annotation = t1, t2, float(t3), (tokens.pop(0) if len(tokens) and tokens[0].startswith("!") else "")
-        probes.append((name, ip, rtt, annotation))
-    
+            name, ip, rtt = t1, t2, tokens[i]
+            # Skip "ms"
+            i += 2
+
+        annotation = ""
+        if i < n and tokens[i].startswith("!"):
+            annotation = tokens[i]
+            i += 1
+
+        probes.append((name, ip, float(rtt), annotation))
+
     return probes
 
 
+def _parse_title(line):
+    """Parses the title line of a traceroute and returns the tuple
+    (dest_host, dest_ip).
+    """
+    tokens = line[len("traceroute to "):].split()
+
+    if len(tokens) < 2:
+        raise ValueError(f"Failed to parse title line: {line}")
+
+    return tokens[0].strip(" (),."), tokens[1].strip(" (),.")
+
+
+def _parse_hop(line, dest_host, dest_ip):
+    """Parses a hop line. Each probe is returned as a tuple:
+    dest_host, dest_ip, hop_index, probe_index, probe_name, probe_ip, probe_rtt, annotation
+    """
+    tokens = line.split()
+
+    if len(tokens) < 4:
+        raise ValueError(f"Failed to parse hop line: {line}")
+
+    # Parse hop index
+    hop_idx = int(tokens[0])
+
+    return [
+        (dest_host, dest_ip, hop_idx, probe_idx, *probe)
+        for probe_idx, probe in enumerate(_parse_probes(tokens, 1))
+    ]
+
+
 def _parse_traceroute(input):
-    """Reads the input of a traceroute and parses it to allow the
-    generation of a CSV file.
+    """Reads the complete output of a traceroute and parses it to allow
+    the generation of a CSV file.
     """
     dest_host = ""
     dest_ip = ""
-
-    # Hops is a list of tuples. Each tuple should have the shape:
-    # dest_host, dest_ip, hop_index, probe_index, probe_name, probe_ip, probe_rtt, annotation
     hops = []
 
     for line in input.split('\n'):
@@ -96,103 +145,308 @@ def _parse_traceroute(input):
 
         if line.lower().startswith("traceroute to "):
             # Title line includes host name and IP
-            line = line.replace("traceroute to ", "")
-            tokens = line.split()
-
-            if len(tokens) < 2:
-                raise ValueError(f"Failed to parse title line: {line}")
-                
-            dest_host = tokens[0].strip(" (),.")
-            dest_ip = tokens[1].strip(" (),.")
+            dest_host, dest_ip = _parse_title(line)
         else:
-            tokens = line.split()
-
-            if len(tokens) < 4:
-                raise ValueError(f"Failed to parse hop line: {line}")
-
-            # Parse hop index
-            hop_idx = int(tokens.pop(0))
-            for (probe_idx, probe) in enumerate(_parse_probes(tokens)):
-                # Generate probe lines for CSV
-                rec = (dest_host, dest_ip, hop_idx, probe_idx, *probe)
-                hops.append(rec)
+            hops += _parse_hop(line, dest_host, dest_ip)
 
     return hops
 
 
 async def _traceroute(target, *args):
-    """Calls a traceroute subprocess and parses the results.
+    """Calls a traceroute subprocess and parses its output line by line,
+    while the hops arrive. Yields the probes of each hop as soon as the
+    hop is complete. The subprocess is killed if the caller stops early.
     """
     args = [BIN, target] + list(args)
-    # return subprocess.check_output(args, stderr=subprocess.PIPE).decode(ENCODING).strip()
     p = await asyncio.create_subprocess_exec(
         *args,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
 
-    out, err = await p.communicate()
+    dest_host = ""
+    dest_ip = ""
 
-    if p.returncode == 0:
-        return out.decode(ENCODING).strip()
-    else:
+    try:
+        async for line in p.stdout:
+            line = line.decode(ENCODING).strip()
+            if not line:
+                continue
+
+            if line.lower().startswith("traceroute to "):
+                # Title line includes host name and IP
+                dest_host, dest_ip = _parse_title(line)
+            else:
+                yield _parse_hop(line, dest_host, dest_ip)
+
+        err = await p.stderr.read()
+        await p.wait()
+    finally:
+        if p.returncode is None:
+            p.kill()
+            await p.wait()
+
+    if p.returncode != 0:
         raise subprocess.CalledProcessError(
             p.returncode,
             " ".join(args),
-            out,
+            None,
             err,
         )
 
 
-
-def drop_complete(tasks):
-    """Should be called if at least one task is done (e.g. the semaphore
-    is NOT locked. Then, the complete tasks are dropped and new can be
-    scheduled.
+async def resolve_target(resolver: CachedResolver, target: str):
+    """Resolves a target host name to its first IPv4 address. IP
+    addresses are returned as they are.
     """
-    tmp = []
-    for task in tasks:
-        if task.done():
-            handle_task(task)
+    try:
+        ipaddress.ip_address(target)
+        return target
+    except ValueError:
+        pass
+
+    msg = await resolver.query(target, "A")
+
+    for rr in msg.answers:
+        if rr.rtype == "A":
+            return rr.data
+
+    raise DNSError(f"No A record for {target} ({msg.rcode_name})")
+
+
+async def traceroute(
+    target,
+    *args,
+    resolver: CachedResolver = None,
+    journal: Journal = None,
+    idx: int = None,
+    topology: Topology = None,
+):
+    """Async call to manage the traceroute of a single target. The rows
+    of each hop are written as soon as it arrives. If a journal is given,
+    the rows are written at once when the traceroute is done and the
+    input line `idx` is marked as done right after, so an interrupted
+    traceroute leaves no rows behind to be duplicated on resume. If a
+    topology is given, the hops are added to it.
+    """
+    ip = target
+    if resolver is not None:
+        # Resolve via the shared DNS cache instead of traceroute
+        ip = await resolve_target(resolver, target)
+
+    rows = []
+    prev = None
+    async for hop in _traceroute(ip, *args):
+        if ip != target:
+            # Keep the host name of the input in the output
+            hop = [(target, *rec[1:]) for rec in hop]
+
+        if journal is not None:
+            rows += hop
         else:
-            tmp.append(task)
-        
-    return tmp
+            stdout(hop)
+
+        if topology is not None:
+            prev = topology.add_hop(prev, hop)
+
+    if journal is not None:
+        stdout(rows)
+        journal.complete(idx)
 
 
-def handle_task(task: asyncio.Task):
-    """Handles the result of a task and prints some information to the
-    STDERR. The STDOUT is not affected.
+async def readlines(stream):
+    """Reads lines from a stream without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+
+    while lines := await loop.run_in_executor(None, stream.readlines, READ_HINT):
+        for line in lines:
+            yield line
+
+
+async def producer(queue: asyncio.Queue, workers: int, journal: Journal = None):
+    """Feeds the input lines to the bounded queue and finally one stop
+    marker per worker.
     """
-    name = task.get_name()
-    
+    idx = -1
+    async for line in readlines(sys.stdin):
+        idx += 1
+
+        # Prepare the input data ...
+        line = line.strip()
+
+        if not line or line[0] == "#":
+            # Skip empty lines or in-line comments
+            if journal:
+                journal.complete(idx)
+            continue
+
+        if journal and journal.done(idx):
+            # Done in a previous run
+            continue
+
+        await queue.put((idx, line))
+
+    for _ in range(workers):
+        await queue.put(None)
+
+
+async def worker(queue: asyncio.Queue, args, verbose: bool = False, **kwargs):
+    """Runs the traceroutes of the queue one after the other. Returns
+    the number of failed traceroutes.
+    """
+    failed = 0
+
+    while (item := await queue.get()) is not None:
+        idx, target = item
+
+        if verbose:
+            stderr(f"[  ] Traceroute {target}")
+
+        try:
+            await traceroute(target, *args, idx=idx, **kwargs)
+            stderr(f"[OK] {target} done")
+        except asyncio.CancelledError:
+            stderr(f"[!!] {target} cancelled")
+            raise
+        except Exception as e:
+            stderr(f"[EE] {target} failed: {str(e)}")
+            failed += 1
+
+    return failed
+
+
+async def main_stateless(opts: dict, journal: Journal = None, topology: Topology = None):
+    """Traces the targets with the stateless engine in tracengine.py,
+    in blocks of targets. Returns the number of skipped targets.
+    """
+    loop = asyncio.get_running_loop()
+
+    if opts["backend"] == "sim":
+        backend = SimulatedBackend(seed=opts["seed"] or 0)
+    elif opts["backend"] == "raw":
+        backend = RawBackend(source=opts["source"])
+    else:
+        raise ValueError(f"Unknown backend: {opts['backend']}")
+
+    kwargs = dict(
+        rate=opts["rate"],
+        min_ttl=opts["first_ttl"],
+        max_ttl=opts["max_ttl"],
+        wait=opts["wait"],
+        seed=opts["seed"],
+    )
+
+    if opts["doubletree"]:
+        tracer = DoubletreeTracer(backend, start_ttl=opts["doubletree"], **kwargs)
+    else:
+        tracer = StatelessTracer(backend, **kwargs)
+
+    skipped = 0
+    block = []
+
+    async def flush():
+        hops = await loop.run_in_executor(None, tracer.trace, [t for _, t in block])
+
+        for (idx, target), h in zip(block, hops):
+            rows = path_rows(target, h, tracer.min_ttl, tracer.max_ttl)
+            stdout(rows)
+
+            if topology is not None:
+                topology.add_path(rows)
+
+            if journal is not None:
+                journal.complete(idx)
+
+        block.clear()
+
+    s = time.perf_counter()
+
     try:
-        if e := task.exception():
-            stderr(f"[EE] {name} failed: {str(e)}")
-        else:
-            stderr(f"[OK] {name} done")
+        idx = -1
+        async for line in readlines(sys.stdin):
+            idx += 1
+            line = line.strip()
+
+            if not line or line[0] == "#":
+                if journal:
+                    journal.complete(idx)
+                continue
+
+            if journal and journal.done(idx):
+                continue
+
+            try:
+                if ipaddress.ip_address(line).version != 4:
+                    raise ValueError("IPv6 is not supported")
+            except ValueError as e:
+                stderr(f"[EE] {line} skipped: {str(e)}")
+                skipped += 1
+                if journal:
+                    journal.complete(idx)
+                continue
+
+            block.append((idx, line))
+
+            if len(block) >= STATELESS_BLOCK:
+                await flush()
+
+        if block:
+            await flush()
     except asyncio.CancelledError:
-        stderr(f"[!!] {name} cancelled")
-    except asyncio.InvalidStateError:
-        stderr(f"[EE] {name} is still running. Task cannot be handled. This is a programming error.")
+        # Stop the engine thread, the executor is joined on exit
+        tracer.stopped = True
+        raise
+    finally:
+        backend.close()
 
+    elapsed = time.perf_counter() - s
+    stderr(
+        f"[OK] Stateless engine: {tracer.sent} probes, {tracer.received} replies, "
+        f"{tracer.sent / elapsed if elapsed else 0:0.0f} probes/s"
+    )
 
+    if opts["doubletree"]:
+        stderr(
+            f"[OK] Doubletree: {tracer.inferred} hops inferred, "
+            f"{len(tracer.global_stop)} global and {len(tracer.local_stop)} local stop set entries"
+        )
 
-async def traceroute(target, semaphore: asyncio.Semaphore, *args):
-    """Async call to manage the traceroute. Can be called as a task to
-    give it a name to handle potential failure.
+    return skipped
+
+
+async def main_traceroute(args, concurrency: int, verbose: bool, **kwargs):
+    """Runs one traceroute subprocess per target. Returns the exit
+    code.
     """
-    # Await to acquire the semaphore
-    await semaphore.acquire()
+    rc = 0
+
+    # A fixed pool of workers, fed by a bounded queue. The queue keeps
+    # the workers busy without reading the whole input into memory.
+    queue = asyncio.Queue(maxsize=2 * concurrency)
+    workers = [
+        asyncio.create_task(worker(queue, args, verbose=verbose, **kwargs))
+        for _ in range(concurrency)
+    ]
 
     try:
-        tr = await _traceroute(target, *args)
-        tr = _parse_traceroute(tr)
-        stdout(tr)
+        await producer(queue, concurrency, journal=kwargs.get("journal"))
+        if sum(await asyncio.gather(*workers)) > 0:
+            rc = 1
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # asyncio.run() cancels the main task on SIGINT
+        rc = 255
     except Exception as e:
-        raise e
-    finally:
-        semaphore.release()
+        stderr(f"[EE] Unknown error: {str(e)}")
+        rc = 1
+
+    if rc == 255 or any(not w.done() for w in workers):
+        # Cancel all workers on a failure or interrupt.
+        for w in workers:
+            w.cancel()
+
+        await asyncio.gather(*workers, return_exceptions=True)
+
+    return rc
 
 
 async def main():
@@ -200,73 +454,114 @@ async def main():
     args = []
     header = True
     verbose = False
+    concurrency = SUBPROCESS_SEMAPHORE_LIMIT
+    cache_path = None
+    resolver = None
+    journal = None
+    topology_path = None
+    engine = "traceroute"
+    stateless = {
+        "backend": "raw",
+        "rate": 1000,
+        "first_ttl": 1,
+        "max_ttl": 16,
+        "wait": 2.0,
+        "seed": None,
+        "source": None,
+        "doubletree": 0,
+    }
 
     # Keep track of the return code
     rc = 0
 
-    # Define a semaphore to limit number of async subprocesses
-    semaphore = asyncio.Semaphore(value=SUBPROCESS_SEMAPHORE_LIMIT)
-    # Define a task list to join on
-    tasks = []
-
-
     for arg in sys.argv[1:]:
         if arg == "--verbose":
             verbose = True
         elif arg == "--no-header":
             header = False
+        elif arg.startswith("--concurrency="):
+            concurrency = max(1, int(arg[len("--concurrency="):]))
+        elif arg.startswith("--cache="):
+            cache_path = arg[len("--cache="):]
+        elif arg.startswith("--engine="):
+            engine = arg[len("--engine="):]
+        elif arg.startswith("--backend="):
+            stateless["backend"] = arg[len("--backend="):]
+        elif arg.startswith("--rate="):
+            stateless["rate"] = int(arg[len("--rate="):])
+        elif arg.startswith("--first-ttl="):
+            stateless["first_ttl"] = int(arg[len("--first-ttl="):])
+        elif arg.startswith("--max-ttl="):
+            stateless["max_ttl"] = int(arg[len("--max-ttl="):])
+        elif arg.startswith("--wait="):
+            stateless["wait"] = float(arg[len("--wait="):])
+        elif arg.startswith("--seed="):
+            stateless["seed"] = int(arg[len("--seed="):])
+        elif arg.startswith("--source="):
+            stateless["source"] = arg[len("--source="):]
+        elif arg == "--doubletree":
+            stateless["doubletree"] = DOUBLETREE_START
+        elif arg.startswith("--doubletree="):
+            stateless["doubletree"] = max(1, int(arg[len("--doubletree="):]))
+        elif arg.startswith("--topology="):
+            topology_path = arg[len("--topology="):]
+        elif arg.startswith("--journal="):
+            # Resume an interrupted run, see journal.py
+            journal = Journal(arg[len("--journal="):], batch=64)
         else:
             args.append(arg)
 
 
-    if header:
+    if cache_path:
+        # Share the DNS cache with bulkdig.py
+        cache = Cache(cache_path)
+        resolver = CachedResolver(Resolver(), cache)
+        await resolver.start()
+
+    if header and not (journal and journal.resumed):
         # Write header to output
         stdout([("target", "target_ip", "hop", "probe", "host", "host_ip", "rtt", "annotation")])
 
-    # Loop over STDIN and resolve the routes line by line
-    try:
-        for line in sys.stdin:
-            while semaphore.locked():
-                await asyncio.sleep(1)
-            # Remove complete tasks to let GC cleanup memory if all
-            # tasks are currently running
-            tasks = drop_complete(tasks)
-
-            # Prepare the input data ...
-            line = line.strip()
-
-            if not line or line[0] == "#":
-                # Skip empty lines or in-line comments
-                continue
-
-            # Run traceroute
-            if verbose:
-                stderr(f"[  ] Traceroute {line}")
-
-            task = asyncio.create_task(
-                traceroute(line, semaphore, *args), name=line
-            )
-            tasks.append(task)
-            # Pass on the round robin...
-            await asyncio.sleep(0.1)
-
-
-    except KeyboardInterrupt:
-        rc = 255
-    except Exception as e:
-        stderr(f"[EE] Unknown error: {str(e)}")
-        rc = 1
-
-    if rc > 0:
-        # Cancel all tasks on a failure or interrupt.
-        for task in tasks:
-            task.cancel()
-
-    await asyncio.gather(*tasks, return_exceptions=True)
+    # Aggregate the paths into a graph, see topology.py
+    topology = Topology() if topology_path else None
+
+    if stateless["doubletree"] and engine != "stateless":
+        stderr("[WW] --doubletree needs --engine=stateless and is ignored")
+
+    if engine == "stateless":
+        try:
+            if await main_stateless(stateless, journal=journal, topology=topology) > 0:
+                rc = 1
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            rc = 255
+        except Exception as e:
+            stderr(f"[EE] Unknown error: {str(e)}")
+            rc = 1
+    else:
+        rc = await main_traceroute(
+            args,
+            concurrency,
+            verbose,
+            resolver=resolver,
+            journal=journal,
+            topology=topology,
+        )
 
-    while len(tasks):
-        task = tasks.pop(0)
-        handle_task(task)
+    if topology is not None:
+        try:
+            topology.write(topology_path)
+            stderr(f"[OK] Topology: {len(topology.nodes)} nodes, {len(topology)} edges written to {topology_path}")
+        except Exception as e:
+            stderr(f"[EE] Topology not written: {str(e)}")
+            rc = rc or 1
+
+    if journal is not None:
+        journal.close()
+
+    if resolver is not None:
+        await resolver.close()
+        resolver.report()
+        resolver.cache.close()
 
     sys.exit(rc)
 
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+# ======================================================================
+#
+#   cymru.py
+#
+# Bulk IP-to-ASN lookup at Team Cymru's whois service, used by ip2asn.sh
+# and as library. The input is deduplicated while it is read and split
+# into chunks; each chunk is sent as one bulk session (`begin`,
+# `verbose`, the addresses, `end`) on its own connection, and several
+# sessions run in parallel. The pipe-delimited responses are parsed as
+# they arrive and written as CSV with the header of ip2asn.sh, so the
+# output is not in input order. A chunk that fails is retried with the
+# addresses that have no answer yet.
+#
+# Usage:
+#
+#   client = BulkWhois(connections=4)
+#   await client.run(lines, on_row)
+#
+# ======================================================================
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+
+
+HOST = "whois.cymru.com"
+PORT = 43
+
+HEADER = "asn,ip,prefix,cc,rir,allocated,asname"
+
+# Parallel bulk sessions
+CONNECTIONS = 4
+# Addresses per bulk session
+CHUNK = 10000
+# Retries of a failed chunk
+RETRIES = 3
+# Seconds without any data until a session fails
+TIMEOUT = 30
+# Number of lines read from STDIN at once
+READ_HINT = 1 << 16
+
+
+def err(msg, do_flush=True):
+    sys.stderr.write(msg)
+    sys.stderr.write('\n')
+
+    if do_flush:
+        sys.stderr.flush()
+
+
+def normalize(line: str):
+    """Returns the canonical form of an IP address, or None if the line
+    is not an IP address.
+    """
+    for family in (socket.AF_INET, socket.AF_INET6):
+        try:
+            return socket.inet_ntop(family, socket.inet_pton(family, line))
+        except OSError:
+            pass
+
+    return None
+
+
+def parse(line: str):
+    """Returns the fields of a response line, or None for the banner and
+    error lines.
+    """
+    if "|" not in line:
+        return None
+
+    return [f.strip() for f in line.split("|")]
+
+
+def to_csv(fields: list) -> str:
+    """Formats a row as ip2asn.sh does, with the AS name quoted."""
+    asname = fields[-1].replace('"', '""')
+    return ",".join(fields[:-1]) + f',"{asname}"'
+
+
+class BulkWhois:
+    """Client of the bulk whois protocol of Team Cymru.
+
+    Args:
+        host (str): Whois server, e.g. `v4-peer.whois.cymru.com` for the
+            upstream peers.
+        port (int): TCP port of the server.
+        connections (int): Number of bulk sessions in parallel.
+        chunk (int): Number of addresses per session.
+        retries (int): Retries of a failed chunk.
+        timeout (float): Seconds without data until a session fails.
+    """
+
+    def __init__(
+        self,
+        host: str = HOST,
+        port: int = PORT,
+        connections: int = CONNECTIONS,
+        chunk: int = CHUNK,
+        retries: int = RETRIES,
+        timeout: float = TIMEOUT,
+    ):
+        self.host = host
+        self.port = port
+        self.connections = max(1, connections)
+        self.chunk = max(1, chunk)
+        self.retries = retries
+        self.timeout = timeout
+
+        self.addresses = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.sessions = 0
+        self.retried = 0
+        self.failed = 0
+        self.rows = 0
+
+    async def session(self, ips: list, on_row, answered: set):
+        """Runs one bulk session and calls `on_row` with the fields of
+        each answer as it arrives. The answered addresses are added to
+        `answered`.
+        """
+        self.sessions += 1
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(self.host, self.port), self.timeout)
+
+        async def send():
+            writer.write(b"begin\nverbose\n")
+            for i in range(0, len(ips), 1024):
+                writer.write(("\n".join(ips[i:i + 1024]) + "\n").encode())
+                await writer.drain()
+
+            writer.write(b"end\n")
+            await writer.drain()
+
+        sender = asyncio.create_task(send())
+
+        try:
+            while line := await asyncio.wait_for(reader.readline(), self.timeout):
+                if not line.endswith(b"\n"):
+                    raise ConnectionError("Session ended within a line")
+
+                fields = parse(line.decode(errors="replace"))
+                if fields is None or len(fields) < 3:
+                    continue
+
+                answered.add(fields[1])
+                if fields[0][:1].isdigit():
+                    # Rows without a routed prefix start with NA
+                    self.rows += 1
+                    on_row(fields)
+
+            await sender
+
+            # A clean EOF before all answers, e.g. a server that closed
+            # the session early
+            if missing := sum(1 for ip in ips if ip not in answered):
+                raise ConnectionError(f"Session ended without answers for {missing} addresses")
+        finally:
+            sender.cancel()
+            writer.close()
+
+    async def lookup(self, ips: list, on_row):
+        """Looks up a chunk of addresses, with retries of those that have
+        no answer yet.
+        """
+        answered = set()
+
+        for attempt in range(self.retries + 1):
+            try:
+                await self.session(ips, on_row, answered)
+                return
+            except (OSError, asyncio.TimeoutError) as e:
+                ips = [ip for ip in ips if ip not in answered]
+                if not ips:
+                    return
+
+                if attempt < self.retries:
+                    self.retried += 1
+                    err(f"[WW] Session failed ({str(e) or type(e).__name__}), retrying {len(ips)} addresses")
+                    await asyncio.sleep(2 ** attempt)
+                else:
+                    err(f"[EE] Session failed ({str(e) or type(e).__name__}), giving up on {len(ips)} addresses")
+
+        self.failed += len(ips)
+
+    async def run(self, lines, on_row):
+        """Looks up the IP addresses of an async iterator of lines. Empty
+        lines, comments and duplicates are skipped.
+        """
+        seen = set()
+        chunk = []
+        slots = asyncio.Semaphore(self.connections)
+        tasks = set()
+
+        async def start(ips):
+            await slots.acquire()
+
+            async def go():
+                try:
+                    await self.lookup(ips, on_row)
+                finally:
+                    slots.release()
+
+            task = asyncio.create_task(go())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        try:
+            async for line in lines:
+                line = line.strip()
+                if not line or line[0] == "#":
+                    continue
+
+                if (ip := normalize(line)) is None:
+                    self.invalid += 1
+                    continue
+                if ip in seen:
+                    self.duplicates += 1
+                    continue
+
+                seen.add(ip)
+                self.addresses += 1
+                chunk.append(ip)
+
+                if len(chunk) >= self.chunk:
+                    await start(chunk)
+                    chunk = []
+
+            if chunk:
+                await start(chunk)
+
+            while tasks:
+                await asyncio.gather(*tasks)
+        finally:
+            for t in tasks:
+                t.cancel()
+
+    def report(self):
+        err(
+            f"[OK] {self.addresses} addresses ({self.duplicates} duplicates, {self.invalid} invalid skipped), "
+            f"{self.rows} rows, {self.sessions} sessions, {self.retried} retries, {self.failed} addresses failed"
+        )
+
+
+async def readlines(stream):
+    """Reads lines from a stream without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+
+    while lines := await loop.run_in_executor(None, stream.readlines, READ_HINT):
+        for line in lines:
+            yield line
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Look up IP addresses of STDIN or a file at Team Cymru's bulk whois service",
+    )
+    parser.add_argument(
+        "input",
+        nargs="?",
+        help="Input file ; By default STDIN",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=HOST,
+        help=f"Whois server ; By default {HOST}",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help=f"Port of the whois server ; By default {PORT}",
+    )
+    parser.add_argument(
+        "-c",
+        "--connections",
+        type=int,
+        default=CONNECTIONS,
+        help=f"Number of bulk sessions in parallel ; By default {CONNECTIONS}",
+    )
+    parser.add_argument(
+        "--chunk",
+        type=int,
+        default=CHUNK,
+        help=f"Number of addresses per bulk session ; By default {CHUNK}",
+    )
+    parser.add_argument(
+        "-r",
+        "--retries",
+        type=int,
+        default=RETRIES,
+        help=f"Retries of a failed session ; By default {RETRIES}",
+    )
+    parser.add_argument(
+        "-t",
+        "--timeout",
+        type=float,
+        default=TIMEOUT,
+        help=f"Seconds without data until a session fails ; By default {TIMEOUT}",
+    )
+
+    return parser.parse_args()
+
+
+async def main():
+    args = parse_args()
+
+    client = BulkWhois(
+        host=args.host,
+        port=args.port,
+        connections=args.connections,
+        chunk=args.chunk,
+        retries=args.retries,
+        timeout=args.timeout,
+    )
+
+    stream = open(args.input, "r") if args.input else sys.stdin
+    rc = 0
+
+    def on_row(fields):
+        sys.stdout.write(to_csv(fields) + "\n")
+
+    try:
+        sys.stdout.write(HEADER + "\n")
+        await client.run(readlines(stream), on_row)
+        sys.stdout.flush()
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        rc = 255
+    except BrokenPipeError:
+        # STDOUT is closed early, e.g. by `head`
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        rc = 1
+
+    client.report()
+
+    if client.failed:
+        rc = rc or 1
+
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
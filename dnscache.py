@@ -0,0 +1,278 @@
+# ======================================================================
+#
+#   dnscache.py
+#
+# TTL-aware cache of DNS responses, used as library by the bulk tools.
+# It keeps a small LRU in memory in front of a SQLite file on disk, so
+# the answers survive between daily runs. Entries are keyed by (name,
+# qtype, nameserver) and expire with the smallest TTL of their records.
+# NXDOMAIN and NODATA responses are cached negatively with the TTL of
+# the SOA record in the authority section (RFC 2308).
+#
+# Usage:
+#
+#   cache = Cache("dns.sqlite", min_ttl=60)
+#   async with CachedResolver(Resolver("9.9.9.9"), cache) as r:
+#       msg = await r.query("example.org", "A")
+#   cache.report()
+#
+# ======================================================================
+
+import collections
+import json
+import sqlite3
+import sys
+import time
+
+from dnsengine import DNSError, Message, NOERROR, NXDOMAIN, Record, fqdn
+
+
+# Number of writes that are committed at once
+COMMIT_BATCH = 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS answers (
+    name TEXT NOT NULL,
+    qtype TEXT NOT NULL,
+    nameserver TEXT NOT NULL,
+    expires REAL NOT NULL,
+    rcode INTEGER NOT NULL,
+    answers TEXT NOT NULL,
+    authority TEXT NOT NULL,
+    PRIMARY KEY (name, qtype, nameserver)
+) WITHOUT ROWID
+"""
+
+
+class CacheMiss(DNSError):
+    """Raised in cache-only mode if an answer is not cached."""
+
+
+class Cache:
+    """Two-tier cache of DNS responses.
+
+    Args:
+        path (str): Path of the SQLite file. Without a path, the cache
+            lives in memory only.
+        size (int): Number of entries of the in-memory LRU.
+        min_ttl (int): Lower bound of the TTL in seconds.
+        max_ttl (int): Upper bound of the TTL in seconds.
+    """
+
+    def __init__(
+        self,
+        path: str = None,
+        size: int = 65536,
+        min_ttl: int = 0,
+        max_ttl: int = 86400,
+    ):
+        self.size = size
+        self.min_ttl = min_ttl
+        self.max_ttl = max(min_ttl, max_ttl)
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+        self._lru = collections.OrderedDict()
+        self._pending = []
+        self._db = None
+
+        if path:
+            self._db = sqlite3.connect(path)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(SCHEMA)
+
+    def _clamp(self, ttl):
+        return min(self.max_ttl, max(self.min_ttl, ttl))
+
+    def _ttl(self, msg: Message, qtype: str):
+        """Returns the TTL to cache a response with, or None if the
+        response must not be cached at all.
+        """
+        if msg.rcode not in (NOERROR, NXDOMAIN) or msg.tc:
+            return None
+
+        if msg.rcode == NOERROR and any(rr.rtype in (qtype, "CNAME") for rr in msg.answers):
+            return self._clamp(min(rr.ttl for rr in msg.answers))
+
+        # NXDOMAIN or NODATA
+        for rr in msg.authority:
+            if rr.rtype == "SOA":
+                minimum = int(rr.data.split()[-1])
+                return self._clamp(min(rr.ttl, minimum))
+
+        return None
+
+    def _remember(self, key, entry):
+        self._lru[key] = entry
+        self._lru.move_to_end(key)
+
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    def get(self, name: str, qtype: str, nameserver: str):
+        """Returns the cached response with the remaining TTLs, or None
+        if the response is not cached or expired.
+        """
+        key = (fqdn(name), qtype, nameserver)
+        now = time.time()
+        entry = self._lru.get(key)
+
+        if entry is not None:
+            self._lru.move_to_end(key)
+        elif self._db is not None:
+            row = self._db.execute(
+                "SELECT expires, rcode, answers, authority FROM answers WHERE name = ? AND qtype = ? AND nameserver = ?",
+                key,
+            ).fetchone()
+
+            if row is not None and row[0] > now:
+                entry = (
+                    row[0],
+                    row[1],
+                    [Record(*r) for r in json.loads(row[2])],
+                    [Record(*r) for r in json.loads(row[3])],
+                )
+                self._remember(key, entry)
+                self.disk_hits += 1
+
+        if entry is None or entry[0] <= now:
+            self.misses += 1
+            return None
+
+        expires, rcode, answers, authority = entry
+        remaining = int(expires - now)
+
+        self.hits += 1
+        if rcode == NXDOMAIN or not answers:
+            self.negative_hits += 1
+
+        return Message(
+            0,
+            rcode,
+            False,
+            (key[0], qtype),
+            [rr._replace(ttl=min(rr.ttl, remaining)) for rr in answers],
+            [rr._replace(ttl=min(rr.ttl, remaining)) for rr in authority],
+        )
+
+    def put(self, name: str, qtype: str, nameserver: str, msg: Message):
+        ttl = self._ttl(msg, qtype)
+        if ttl is None or ttl <= 0:
+            return
+
+        key = (fqdn(name), qtype, nameserver)
+        entry = (time.time() + ttl, msg.rcode, msg.answers, msg.authority)
+        self._remember(key, entry)
+
+        if self._db is not None:
+            self._pending.append((
+                *key,
+                entry[0],
+                msg.rcode,
+                json.dumps(msg.answers),
+                json.dumps(msg.authority),
+            ))
+
+            if len(self._pending) >= COMMIT_BATCH:
+                self.flush()
+
+    def flush(self):
+        if self._db is None or not self._pending:
+            return
+
+        self._db.executemany("INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)", self._pending)
+        self._db.commit()
+        self._pending = []
+
+    def purge(self):
+        """Drops expired entries from the disk."""
+        if self._db is not None:
+            self._db.execute("DELETE FROM answers WHERE expires <= ?", (time.time(),))
+            self._db.commit()
+
+    def close(self):
+        self.flush()
+
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def report(self, saved_seconds: float = None):
+        """Writes the hit/miss statistics to STDERR."""
+        total = self.hits + self.misses
+        ratio = 100.0 * self.hits / total if total else 0.0
+
+        msg = (
+            f"Cache: {self.hits} hits ({self.disk_hits} from disk, "
+            f"{self.negative_hits} negative), {self.misses} misses, "
+            f"hit ratio {ratio:0.1f}%"
+        )
+        if saved_seconds is not None:
+            msg += f", ~{saved_seconds:0.1f} seconds of query latency saved"
+
+        sys.stderr.write(msg)
+        sys.stderr.write("\n")
+        sys.stderr.flush()
+
+
+class CachedResolver:
+    """Wraps a resolver with the same `query` interface and answers
+    from the cache where possible.
+
+    Args:
+        resolver (Resolver): DNS engine to send the cache misses to.
+        cache (Cache): Cache of the responses.
+        cache_only (bool): Raise a CacheMiss instead of querying.
+    """
+
+    def __init__(self, resolver, cache: Cache, cache_only: bool = False):
+        self.resolver = resolver
+        self.cache = cache
+        self.cache_only = cache_only
+        self.nameserver = resolver.nameserver
+
+        # Time spent on queries, to estimate the time saved by the hits
+        self._queries = 0
+        self._elapsed = 0.0
+
+    async def __aenter__(self):
+        await self.resolver.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        await self.resolver.start()
+
+    async def close(self):
+        await self.resolver.close()
+        self.cache.flush()
+
+    async def query(self, name: str, qtype: str = "A") -> Message:
+        qtype = qtype.upper()
+
+        if (msg := self.cache.get(name, qtype, self.nameserver)) is not None:
+            return msg
+
+        if self.cache_only:
+            raise CacheMiss(f"Not cached: {name} {qtype}")
+
+        s = time.perf_counter()
+        msg = await self.resolver.query(name, qtype)
+        self._elapsed += time.perf_counter() - s
+        self._queries += 1
+
+        self.cache.put(name, qtype, self.nameserver, msg)
+        return msg
+
+    def report(self):
+        saved = None
+        if self._queries:
+            saved = self.cache.hits * self._elapsed / self._queries
+
+        self.cache.report(saved_seconds=saved)
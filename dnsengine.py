@@ -0,0 +1,707 @@
+# ======================================================================
+#
+#   dnsengine.py
+#
+# Small asyncio DNS stub resolver, used as library by the bulk tools.
+# It builds and parses the DNS wire format itself (RFC 1035), keeps
+# thousands of queries in flight over a handful of connected UDP
+# sockets and matches responses by query ID and question. Queries time
+# out and are retried; truncated responses are repeated over TCP.
+#
+# The queries are spread on a pool of nameservers, based on their
+# latency and error rate. Each nameserver has its own window of queries
+# in flight that adapts to timeouts, SERVFAIL and REFUSED.
+#
+# Usage:
+#
+#   async with Resolver(["9.9.9.9", "1.1.1.1"]) as r:
+#       msg = await r.query("example.org", "A")
+#       for rr in msg.answers:
+#           print(rr.name, rr.rtype, rr.data)
+#
+# ======================================================================
+
+import asyncio
+import collections
+import ipaddress
+import random
+import socket
+import struct
+import sys
+
+from typing import NamedTuple
+
+
+DEFAULT_PORT = 53
+RESOLV_CONF = "/etc/resolv.conf"
+
+# Payload size advertised via EDNS(0), see DNS flag day 2020
+EDNS_PAYLOAD = 1232
+
+QTYPES = {
+    "A": 1,
+    "NS": 2,
+    "CNAME": 5,
+    "SOA": 6,
+    "PTR": 12,
+    "MX": 15,
+    "TXT": 16,
+    "AAAA": 28,
+    "SRV": 33,
+    "DNAME": 39,
+    "OPT": 41,
+    "ANY": 255,
+}
+QTYPE_NAMES = {v: k for k, v in QTYPES.items()}
+
+RCODES = {
+    0: "NOERROR",
+    1: "FORMERR",
+    2: "SERVFAIL",
+    3: "NXDOMAIN",
+    4: "NOTIMP",
+    5: "REFUSED",
+}
+
+NOERROR = 0
+SERVFAIL = 2
+NXDOMAIN = 3
+REFUSED = 5
+
+# Consecutive failures that open the circuit breaker of a nameserver,
+# and the time in seconds until it is probed again
+CIRCUIT_FAILURES = 5
+CIRCUIT_COOLDOWN = 5.0
+CIRCUIT_MAX_COOLDOWN = 60.0
+
+_HEADER = struct.Struct("!HHHHHH")
+_RR = struct.Struct("!HHIH")
+_QUESTION = struct.Struct("!HH")
+
+
+class DNSError(Exception):
+    """Raised if a query cannot be answered by the nameserver."""
+
+
+class DNSTimeout(DNSError):
+    """Raised if a query is not answered after all retries."""
+
+
+class Record(NamedTuple):
+    # Owner name, lower case and with trailing dot
+    name: str
+    # Record type, e.g. "A" or "TYPE65" if unknown
+    rtype: str
+    ttl: int
+    # Presentation format of the RDATA, similar to `dig +short`
+    data: str
+
+
+class Message(NamedTuple):
+    id: int
+    rcode: int
+    # Truncation flag
+    tc: bool
+    # Question as tuple (name, rtype)
+    question: tuple
+    answers: list
+    authority: list
+
+    @property
+    def rcode_name(self):
+        return RCODES.get(self.rcode, f"RCODE{self.rcode}")
+
+
+# ----------------------------------------------------------------------
+# Wire format
+# ----------------------------------------------------------------------
+
+def qtype_code(qtype) -> int:
+    if isinstance(qtype, int):
+        return qtype
+
+    qtype = qtype.upper()
+    if qtype in QTYPES:
+        return QTYPES[qtype]
+    if qtype.startswith("TYPE") and qtype[4:].isdigit():
+        return int(qtype[4:])
+
+    raise ValueError(f"Unknown query type: {qtype}")
+
+
+def qtype_name(code: int) -> str:
+    return QTYPE_NAMES.get(code, f"TYPE{code}")
+
+
+def fqdn(name: str) -> str:
+    """Normalizes a domain name to lower case with a trailing dot."""
+    name = name.strip().lower().rstrip(".")
+    return name + "."
+
+
+def encode_name(name: str) -> bytes:
+    name = name.strip().rstrip(".")
+    if not name:
+        return b"\x00"
+
+    buf = bytearray()
+    for label in name.split("."):
+        try:
+            raw = label.lower().encode("ascii")
+        except UnicodeEncodeError:
+            raw = label.encode("idna")
+
+        if not 0 < len(raw) < 64:
+            raise ValueError(f"Invalid label in domain name: {name}")
+
+        buf.append(len(raw))
+        buf += raw
+
+    buf.append(0)
+
+    if len(buf) > 255:
+        raise ValueError(f"Domain name too long: {name}")
+
+    return bytes(buf)
+
+
+def build_query(qid: int, name: str, qtype, rd: bool = True) -> bytes:
+    """Builds a query packet with a single question and an EDNS(0) OPT
+    record to allow responses larger than 512 bytes over UDP.
+    """
+    flags = 0x0100 if rd else 0
+    header = _HEADER.pack(qid, flags, 1, 0, 0, 1)
+    question = encode_name(name) + _QUESTION.pack(qtype_code(qtype), 1)
+    opt = b"\x00" + _RR.pack(QTYPES["OPT"], EDNS_PAYLOAD, 0, 0)
+
+    return header + question + opt
+
+
+def _decode_name(data: bytes, offset: int):
+    """Decodes a (compressed) name and returns it together with the
+    offset right after the name in the original position.
+    """
+    labels = []
+    end = None
+    jumps = 0
+
+    while True:
+        if offset >= len(data):
+            raise ValueError("Name exceeds message")
+
+        length = data[offset]
+
+        if length & 0xC0 == 0xC0:
+            if offset + 1 >= len(data):
+                raise ValueError("Truncated compression pointer")
+            if end is None:
+                end = offset + 2
+
+            # Guard against pointer loops
+            jumps += 1
+            if jumps > 64:
+                raise ValueError("Compression pointer loop")
+
+            offset = ((length & 0x3F) << 8) | data[offset + 1]
+        elif length == 0:
+            offset += 1
+            break
+        else:
+            offset += 1
+            labels.append(data[offset:offset + length].decode("ascii", "backslashreplace"))
+            offset += length
+
+    name = ".".join(labels).lower() + "."
+    return name, (end if end is not None else offset)
+
+
+def _decode_rdata(data: bytes, rtype: int, offset: int, rdlen: int) -> str:
+    rdata = data[offset:offset + rdlen]
+
+    if rtype == 1 and rdlen == 4:
+        return socket.inet_ntop(socket.AF_INET, rdata)
+    if rtype == 28 and rdlen == 16:
+        return socket.inet_ntop(socket.AF_INET6, rdata)
+    if rtype in (2, 5, 12, 39):
+        return _decode_name(data, offset)[0]
+    if rtype == 15:
+        pref = struct.unpack_from("!H", data, offset)[0]
+        return f"{pref} {_decode_name(data, offset + 2)[0]}"
+    if rtype == 6:
+        mname, o = _decode_name(data, offset)
+        rname, o = _decode_name(data, o)
+        serial, refresh, retry, expire, minimum = struct.unpack_from("!IIIII", data, o)
+        return f"{mname} {rname} {serial} {refresh} {retry} {expire} {minimum}"
+    if rtype == 16:
+        strings = []
+        i = 0
+        while i < rdlen:
+            n = rdata[i]
+            strings.append('"' + rdata[i + 1:i + 1 + n].decode("utf-8", "backslashreplace") + '"')
+            i += 1 + n
+        return " ".join(strings)
+
+    # Unknown record type, RFC 3597 notation
+    return f"\\# {rdlen} {rdata.hex()}"
+
+
+def _parse_records(data: bytes, offset: int, count: int):
+    records = []
+
+    for _ in range(count):
+        name, offset = _decode_name(data, offset)
+        rtype, _rclass, ttl, rdlen = _RR.unpack_from(data, offset)
+        offset += _RR.size
+
+        if offset + rdlen > len(data):
+            raise ValueError("Record exceeds message")
+
+        if rtype != QTYPES["OPT"]:
+            records.append(Record(name, qtype_name(rtype), ttl, _decode_rdata(data, rtype, offset, rdlen)))
+
+        offset += rdlen
+
+    return records, offset
+
+
+def parse_response(data: bytes) -> Message:
+    """Parses a response packet. Raises a ValueError on malformed
+    input. The additional section is not parsed.
+    """
+    if len(data) < _HEADER.size:
+        raise ValueError("Message shorter than header")
+
+    qid, flags, qdcount, ancount, nscount, _arcount = _HEADER.unpack_from(data)
+
+    if not flags & 0x8000:
+        raise ValueError("Message is not a response")
+
+    offset = _HEADER.size
+    question = None
+
+    for _ in range(qdcount):
+        qname, offset = _decode_name(data, offset)
+        qtype, _qclass = _QUESTION.unpack_from(data, offset)
+        offset += _QUESTION.size
+        question = (qname, qtype_name(qtype))
+
+    tc = bool(flags & 0x0200)
+    rcode = flags & 0x000F
+
+    if tc:
+        # Do not bother parsing a truncated message; it is retried
+        # via TCP anyway.
+        return Message(qid, rcode, tc, question, [], [])
+
+    answers, offset = _parse_records(data, offset, ancount)
+    authority, offset = _parse_records(data, offset, nscount)
+
+    return Message(qid, rcode, tc, question, answers, authority)
+
+
+def reverse_name(ip: str) -> str:
+    """Returns the in-addr.arpa / ip6.arpa name of an IP address."""
+    return ipaddress.ip_address(ip.strip()).reverse_pointer + "."
+
+
+# ----------------------------------------------------------------------
+# Nameservers
+# ----------------------------------------------------------------------
+
+def system_nameservers(path: str = RESOLV_CONF):
+    """Reads the nameservers from resolv.conf, as `dig` would do."""
+    servers = []
+
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                tokens = line.split()
+                if len(tokens) >= 2 and tokens[0] == "nameserver":
+                    # Drop IPv6 zone indices, e.g. fe80::1%eth0
+                    servers.append(tokens[1].split("%")[0])
+    except OSError:
+        pass
+
+    return servers or ["127.0.0.1"]
+
+
+def parse_nameserver(server: str):
+    """Parses a nameserver given as `ip`, `ip#port` or `[ip]:port` and
+    returns a tuple (ip, port).
+    """
+    server = server.strip().lstrip("@")
+    port = DEFAULT_PORT
+
+    if server.startswith("[") and "]" in server:
+        host, _, rest = server[1:].partition("]")
+        if rest.startswith(":"):
+            port = int(rest[1:])
+        server = host
+    elif "#" in server:
+        server, _, p = server.partition("#")
+        port = int(p)
+    elif server.count(":") == 1:
+        server, _, p = server.partition(":")
+        port = int(p)
+
+    return server, port
+
+
+# ----------------------------------------------------------------------
+# Transport
+# ----------------------------------------------------------------------
+
+class _UDPSocket(asyncio.DatagramProtocol):
+    """Connected UDP socket holding the queries in flight. Responses
+    are matched by query ID first and by question afterwards, so late
+    or spoofed responses are dropped.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.pending = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if len(data) < 2:
+            return
+
+        qid = (data[0] << 8) | data[1]
+        entry = self.pending.get(qid)
+        if entry is None:
+            return
+
+        fut, question = entry
+        if fut.done():
+            return
+
+        try:
+            msg = parse_response(data)
+        except (ValueError, struct.error, IndexError):
+            return
+
+        if msg.question is None or (msg.question[0], msg.question[1]) != question:
+            return
+
+        fut.set_result(msg)
+
+    def error_received(self, exc):
+        # ICMP errors are handled by the query timeout
+        pass
+
+    def connection_lost(self, exc):
+        for fut, _ in self.pending.values():
+            if not fut.done():
+                fut.set_exception(DNSError("Socket closed"))
+
+    def allocate_id(self):
+        # Random IDs make blind spoofing a bit harder than a counter
+        while True:
+            qid = random.getrandbits(16)
+            if qid not in self.pending:
+                return qid
+
+
+class Nameserver:
+    """State of a single nameserver of the pool: its sockets, the
+    observed latency and error rate (EWMA), a circuit breaker and the
+    window of queries in flight, which grows and shrinks AIMD-style.
+    """
+
+    def __init__(self, name: str, window: float, max_window: int):
+        self.name = name
+        self.address = parse_nameserver(name)
+        self.sockets = []
+
+        self.window = float(window)
+        self.max_window = max_window
+        # Slow start threshold, the window doubles per round trip below
+        self.ssthresh = float(max_window)
+        self.inflight = 0
+
+        # Smoothed RTT in seconds and error rate, None until measured
+        self.srtt = None
+        self.errors = 0.0
+
+        self.failures = 0
+        self.tripped = False
+        self.cooldown = CIRCUIT_COOLDOWN
+        self.open_until = 0.0
+        self.last_decrease = 0.0
+
+        self.queries = 0
+        self.failed = 0
+
+    def score(self, fallback_rtt: float):
+        srtt = self.srtt if self.srtt is not None else fallback_rtt
+        return srtt * (1.0 + 4.0 * self.errors)
+
+    def available(self, now: float):
+        if self.open_until > now:
+            return False
+        if self.tripped:
+            # Half-open circuit: a single probe at a time
+            return self.inflight < 1
+        return self.inflight < int(self.window)
+
+    def success(self, rtt: float, now: float):
+        self.srtt = rtt if self.srtt is None else 0.875 * self.srtt + 0.125 * rtt
+        self.errors *= 0.9
+        self.failures = 0
+        self.tripped = False
+        self.cooldown = CIRCUIT_COOLDOWN
+
+        if self.window < self.ssthresh:
+            self.window = min(self.max_window, self.window + 1.0)
+        else:
+            # Additive increase by one query per window
+            self.window = min(self.max_window, self.window + 1.0 / self.window)
+
+    def failure(self, now: float):
+        self.errors = 0.9 * self.errors + 0.1
+        self.failures += 1
+        self.failed += 1
+
+        # Multiplicative decrease, at most once per round trip, since
+        # a burst of timeouts is a single congestion signal
+        if now - self.last_decrease > (self.srtt or 0.0):
+            self.window = max(1.0, self.window / 2.0)
+            self.ssthresh = self.window
+            self.last_decrease = now
+
+        # Open the circuit only if backing off did not help, a burst of
+        # timeouts of a full window is no reason to give up a server
+        if self.failures >= CIRCUIT_FAILURES and self.window <= 1.0:
+            self.tripped = True
+            self.open_until = now + self.cooldown
+            self.cooldown = min(CIRCUIT_MAX_COOLDOWN, 2 * self.cooldown)
+
+    def state(self, now: float):
+        if self.open_until > now:
+            return "open"
+        if self.tripped:
+            return "half-open"
+        return "closed"
+
+
+class Resolver:
+    """Asynchronous stub resolver that spreads the queries on a pool of
+    recursive nameservers. Each query goes to the available nameserver
+    with the best latency and error rate. Every nameserver has its own
+    window of queries in flight, which is halved on timeouts, SERVFAIL
+    and REFUSED. A nameserver that fails repeatedly is skipped until its
+    circuit breaker closes again.
+
+    Args:
+        nameservers (list): Nameservers as `ip`, `ip#port` or
+            `[ip]:port`. A single string is accepted too. Defaults to
+            the first nameserver of /etc/resolv.conf.
+        sockets (int): Number of UDP sockets per nameserver.
+        timeout (float): Seconds to wait for a single attempt.
+        retries (int): Number of retries after the first attempt.
+        concurrency (int): Maximum number of queries in flight.
+        window (int): Initial window of queries in flight per
+            nameserver.
+    """
+
+    def __init__(
+        self,
+        nameservers=None,
+        sockets: int = 4,
+        timeout: float = 2.0,
+        retries: int = 2,
+        concurrency: int = 1024,
+        window: int = 32,
+    ):
+        if not nameservers:
+            nameservers = system_nameservers()[:1]
+        elif isinstance(nameservers, str):
+            nameservers = [nameservers]
+
+        concurrency = max(1, concurrency)
+
+        self.servers = [Nameserver(ns, min(window, concurrency), concurrency) for ns in nameservers]
+        # Used as identity of the pool, e.g. by the cache
+        self.nameserver = ",".join(sorted(s.name for s in self.servers))
+        self.timeout = timeout
+        self.retries = retries
+
+        self._n_sockets = max(1, sockets)
+        self._rr = 0
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._waiters = collections.deque()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+
+        for server in self.servers:
+            for _ in range(self._n_sockets):
+                _, protocol = await loop.create_datagram_endpoint(
+                    _UDPSocket,
+                    remote_addr=server.address,
+                )
+                server.sockets.append(protocol)
+
+    async def close(self):
+        for server in self.servers:
+            for s in server.sockets:
+                s.transport.close()
+
+            server.sockets = []
+
+    def _pick(self, now: float, exclude: set):
+        known = [s.srtt for s in self.servers if s.srtt is not None]
+        fallback = min(known) if known else 0.0
+        best = None
+
+        for server in self.servers:
+            if not server.available(now):
+                continue
+            if server in exclude and len(exclude) < len(self.servers):
+                continue
+            if best is None or server.score(fallback) < best.score(fallback):
+                best = server
+
+        return best
+
+    async def _acquire(self, exclude: set) -> Nameserver:
+        """Waits for a nameserver with a free slot in its window."""
+        loop = asyncio.get_running_loop()
+
+        while True:
+            now = loop.time()
+
+            if server := self._pick(now, exclude):
+                server.inflight += 1
+                server.queries += 1
+                return server
+
+            # Wake up when a slot is freed or the next circuit closes
+            reopen = [s.open_until - now for s in self.servers if s.open_until > now]
+            fut = loop.create_future()
+            self._waiters.append(fut)
+
+            try:
+                await asyncio.wait_for(fut, min(reopen) if reopen else None)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                if fut in self._waiters:
+                    self._waiters.remove(fut)
+
+    def _release(self, server: Nameserver):
+        server.inflight -= 1
+
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                break
+
+    def _next_socket(self, server: Nameserver):
+        self._rr = (self._rr + 1) % len(server.sockets)
+        return server.sockets[self._rr]
+
+    async def _query_udp(self, server: Nameserver, name: str, qtype: str):
+        loop = asyncio.get_running_loop()
+        sock = self._next_socket(server)
+        qid = sock.allocate_id()
+
+        fut = loop.create_future()
+        sock.pending[qid] = (fut, (name, qtype))
+
+        try:
+            sock.transport.sendto(build_query(qid, name, qtype))
+            return await asyncio.wait_for(fut, self.timeout)
+        finally:
+            del sock.pending[qid]
+
+    async def _query_tcp(self, server: Nameserver, name: str, qtype: str):
+        qid = random.getrandbits(16)
+        packet = build_query(qid, name, qtype)
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(*server.address),
+            self.timeout,
+        )
+
+        try:
+            writer.write(struct.pack("!H", len(packet)) + packet)
+            await writer.drain()
+
+            length = struct.unpack("!H", await asyncio.wait_for(reader.readexactly(2), self.timeout))[0]
+            data = await asyncio.wait_for(reader.readexactly(length), self.timeout)
+        finally:
+            writer.close()
+
+        msg = parse_response(data)
+        if msg.id != qid or msg.question != (name, qtype):
+            raise DNSError(f"Mismatching TCP response for {name} {qtype}")
+
+        return msg
+
+    async def query(self, name: str, qtype: str = "A") -> Message:
+        """Sends a query and returns the parsed response. Timeouts,
+        SERVFAIL and REFUSED are retried, preferably on another
+        nameserver. Raises a DNSTimeout if no attempt was answered.
+        """
+        loop = asyncio.get_running_loop()
+        name = fqdn(name)
+        qtype = qtype_name(qtype_code(qtype))
+        tried = set()
+        msg = None
+
+        async with self._semaphore:
+            for _ in range(self.retries + 1):
+                server = await self._acquire(tried)
+                tried.add(server)
+                s = loop.time()
+
+                try:
+                    msg = await self._query_udp(server, name, qtype)
+
+                    if msg.tc:
+                        try:
+                            msg = await self._query_tcp(server, name, qtype)
+                        except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError, ValueError) as e:
+                            raise DNSError(f"TCP fallback failed for {name} {qtype}: {e}")
+                except asyncio.TimeoutError:
+                    server.failure(loop.time())
+                    continue
+                finally:
+                    self._release(server)
+
+                if msg.rcode in (SERVFAIL, REFUSED):
+                    server.failure(loop.time())
+                    continue
+
+                server.success(loop.time() - s, loop.time())
+                return msg
+
+        if msg is not None:
+            # Every attempt failed with SERVFAIL or REFUSED
+            return msg
+
+        raise DNSTimeout(f"Timeout: {name} {qtype} @{self.nameserver}")
+
+    def report(self):
+        """Writes the statistics of the nameserver pool to STDERR."""
+        now = asyncio.get_running_loop().time()
+
+        for s in self.servers:
+            srtt = f"{1000 * s.srtt:0.1f}ms" if s.srtt is not None else "-"
+            sys.stderr.write(
+                f"Nameserver {s.name}: {s.queries} queries, {s.failed} failed, "
+                f"srtt {srtt}, window {s.window:0.1f}, circuit {s.state(now)}\n"
+            )
+
+        sys.stderr.flush()
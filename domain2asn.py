@@ -0,0 +1,313 @@
+#!/usr/bin/env python3
+
+# ======================================================================
+#
+#   domain2asn.py
+#
+# Maps domain names to the ASNs of their IP addresses. The domains are
+# read from the arguments or STDIN and resolved (A and AAAA) by the
+# asynchronous DNS engine in `dnsengine.py`, many at once. The unique
+# addresses are looked up in a single batched run: by the bulk whois
+# client in `cymru.py`, which starts its sessions while the domains are
+# still being resolved, or offline in a prefix table of asnlookup.py.
+# The results are joined back to the domains and written as CSV to
+# STDOUT:
+#
+#   domain,qtype,ip,asn,prefix,asname
+#
+# A row is written as soon as the ASN of its address is known, so the
+# output is not in input order. Addresses without a routed prefix get
+# `NA` as ASN and prefix.
+#
+# ======================================================================
+
+import argparse
+import asyncio
+import os
+import sys
+
+from cymru import HOST, PORT, BulkWhois, normalize
+from dnscache import Cache, CachedResolver
+from dnsengine import DNSError, Resolver
+
+
+HEADER = "domain,qtype,ip,asn,prefix,asname"
+
+# Number of domains resolved at once
+CONCURRENCY = 256
+# Number of input lines that are read at once
+READ_HINT = 1 << 16
+
+
+def err(msg, do_flush=True):
+    sys.stderr.write(msg)
+    sys.stderr.write('\n')
+
+    if do_flush:
+        sys.stderr.flush()
+
+
+def write(domain: str, qtype: str, ip: str, asn: str, prefix: str, asname: str):
+    asname = asname.replace('"', '""')
+    sys.stdout.write(f'{domain},{qtype},{ip},{asn},{prefix},"{asname}"\n')
+
+
+class Join:
+    """Joins the resolved addresses with their ASN. Rows wait for the ASN
+    of their address; addresses are passed on to the ASN lookup once.
+    """
+
+    def __init__(self):
+        # IP address -> (ASN, prefix, AS name), and the rows waiting for
+        # an address
+        self.known = {}
+        self.waiting = {}
+        self.queue = asyncio.Queue()
+
+        self.rows = 0
+        self.unresolved = 0
+
+    def add(self, domain: str, qtype: str, ip: str):
+        if (info := self.known.get(ip)) is not None:
+            write(domain, qtype, ip, *info)
+            self.rows += 1
+        elif (rows := self.waiting.get(ip)) is not None:
+            rows.append((domain, qtype))
+        else:
+            self.waiting[ip] = [(domain, qtype)]
+            self.queue.put_nowait(ip)
+
+    def answer(self, ip: str, asn: str, prefix: str, asname: str):
+        info = self.known[ip] = (asn, prefix, asname)
+
+        for domain, qtype in self.waiting.pop(ip, ()):
+            write(domain, qtype, ip, *info)
+            self.rows += 1
+
+    async def addresses(self):
+        """Yields the new addresses until None is queued."""
+        while (ip := await self.queue.get()) is not None:
+            yield ip
+
+    def finish(self):
+        """Writes the rows of the addresses without an answer."""
+        for ip in list(self.waiting):
+            self.answer(ip, "NA", "NA", "")
+
+
+async def query(resolver, domain: str, qtype: str) -> list:
+    try:
+        msg = await resolver.query(domain, qtype)
+    except (DNSError, ValueError):
+        return []
+
+    return [rr.data for rr in msg.answers if rr.rtype == qtype]
+
+
+async def resolve(resolver, join: Join, domain: str):
+    """Resolves A and AAAA of a domain in parallel."""
+    found = False
+    answers = await asyncio.gather(query(resolver, domain, "A"), query(resolver, domain, "AAAA"))
+
+    for qtype, data in zip(("A", "AAAA"), answers):
+        for ip in data:
+            if (ip := normalize(ip)) is not None:
+                join.add(domain, qtype, ip)
+                found = True
+
+    if not found:
+        join.unresolved += 1
+
+
+async def domains(args):
+    """Yields the unique domains of the arguments or STDIN."""
+    seen = set()
+
+    async def lines():
+        if args.domains:
+            for d in args.domains:
+                yield d
+            return
+
+        loop = asyncio.get_running_loop()
+        while chunk := await loop.run_in_executor(None, sys.stdin.readlines, READ_HINT):
+            for line in chunk:
+                yield line
+
+    async for line in lines():
+        line = line.strip(' \t.\r\n').lower()
+
+        if not line or line[0] == "#" or line in seen:
+            continue
+
+        seen.add(line)
+        yield line
+
+
+async def resolve_all(args, resolver, join: Join):
+    """Resolves all domains, at most `--concurrency` at once."""
+    slots = asyncio.Semaphore(args.concurrency)
+    tasks = set()
+
+    async def run(domain):
+        try:
+            await resolve(resolver, join, domain)
+        finally:
+            slots.release()
+
+    async for domain in domains(args):
+        await slots.acquire()
+
+        task = asyncio.create_task(run(domain))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    while tasks:
+        await asyncio.gather(*tasks)
+
+
+async def lookup_whois(args, join: Join, resolving):
+    """Looks up the addresses at Team Cymru while they are resolved."""
+    client = BulkWhois(host=args.host, port=args.port, connections=args.connections)
+
+    async def done():
+        await resolving
+        join.queue.put_nowait(None)
+
+    marker = asyncio.create_task(done())
+
+    def on_row(fields):
+        asn, ip, prefix, *_, asname = fields
+        join.answer(ip, asn, prefix, asname)
+
+    try:
+        await client.run(join.addresses(), on_row)
+        await marker
+    finally:
+        marker.cancel()
+
+    client.report()
+
+
+async def lookup_offline(args, join: Join, resolving):
+    """Looks up the addresses in a prefix table once they are resolved."""
+    from asnengine import PrefixTable
+
+    await resolving
+
+    table = PrefixTable.open(args.db)
+    ips = list(join.waiting)
+
+    for ip, pfx in zip(ips, table.lookup(ips).tolist()):
+        if pfx >= 0:
+            asn, prefix, _, _, _, asname = table.row(pfx)
+            join.answer(ip, str(asn), prefix, asname)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Map domain names to the ASNs of their IP addresses",
+    )
+    parser.add_argument(
+        "domains",
+        nargs="*",
+        help="Domain names ; By default read from STDIN",
+    )
+    parser.add_argument(
+        "-n",
+        "--nameserver",
+        action="append",
+        default=[],
+        help="Nameserver to query, e.g. 9.9.9.9, may be repeated ; By default from /etc/resolv.conf",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Number of domains resolved at once ; By default {CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        metavar="PATH",
+        default=os.environ.get("MRIT_DNS_CACHE"),
+        help="SQLite file to cache the DNS responses between runs ; By default $MRIT_DNS_CACHE",
+    )
+    parser.add_argument(
+        "-d",
+        "--db",
+        type=str,
+        metavar="PATH",
+        help="Look up the ASNs offline in a prefix table of asnlookup.py",
+    )
+    parser.add_argument(
+        "--host",
+        type=str,
+        default=HOST,
+        help=f"Whois server of the ASN lookup ; By default {HOST}",
+    )
+    parser.add_argument(
+        "--port",
+        type=int,
+        default=PORT,
+        help=f"Port of the whois server ; By default {PORT}",
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        default=4,
+        help="Number of parallel whois sessions ; By default 4",
+    )
+
+    args = parser.parse_args()
+
+    args.concurrency = max(1, args.concurrency)
+    args.nameserver = [ns.lstrip("@") for ns in args.nameserver]
+
+    return args
+
+
+async def main():
+    args = parse_args()
+
+    resolver = Resolver(args.nameserver or None, concurrency=4 * args.concurrency)
+
+    cache = None
+    if args.cache:
+        cache = Cache(args.cache)
+        resolver = CachedResolver(resolver, cache)
+
+    join = Join()
+    rc = 0
+
+    async with resolver:
+        sys.stdout.write(HEADER + "\n")
+
+        resolving = asyncio.create_task(resolve_all(args, resolver, join))
+        lookup = lookup_offline if args.db else lookup_whois
+
+        try:
+            await asyncio.gather(resolving, lookup(args, join, resolving))
+            join.finish()
+            sys.stdout.flush()
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            rc = 255
+        except BrokenPipeError:
+            # STDOUT is closed early, e.g. by `head`
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            rc = 1
+        finally:
+            resolving.cancel()
+
+    err(f"[OK] {join.rows} rows, {len(join.known)} unique addresses, {join.unresolved} domains without address")
+
+    if cache is not None:
+        resolver.report()
+        cache.close()
+
+    sys.exit(rc)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
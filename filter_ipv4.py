@@ -5,22 +5,15 @@
 #   filter_ipv4.py
 #
 # Simply filters on any IPv4 address discovered in the input and prints
-# the IPs line by line to STDOUT.
+# the IPs line by line to STDOUT. Shorthand for `ipextract.py -4`, see
+# ipextract.py for the options.
 #
 # ======================================================================
 
-from functools import reduce
-import re
 import sys
 
-ipv4_pattern = r"\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}"
-
-def main():
-    matches =[re.findall(ipv4_pattern, line) for line in sys.stdin]
-
-    for m in reduce(lambda a, b: a + b, matches):
-        print(m)
+from ipextract import main
 
 
 if __name__ == "__main__":
-    main()
+    main(["-4"] + sys.argv[1:])
@@ -2,27 +2,18 @@
 
 # ======================================================================
 #
-#   filter_ipv4.py
+#   filter_ipv6.py
 #
-# Simply filters on any IPv4 address discovered in the input and prints
-# the IPs line by line to STDOUT.
+# Simply filters on any IPv6 address discovered in the input and prints
+# the IPs line by line to STDOUT. Shorthand for `ipextract.py -6`, see
+# ipextract.py for the options.
 #
 # ======================================================================
 
-from functools import reduce
-import re
 import sys
 
-# WARNING: This is highly inacurate and only filters IPv6 out of a list
-#          of IPv4 and IPv6
-ipv6_pattern = f"[0-9a-fA-F:]+"
-
-def main():
-    matches =[re.findall(ipv6_pattern, line) for line in sys.stdin]
-
-    for m in reduce(lambda a, b: a + b, matches):
-        print(m)
+from ipextract import main
 
 
 if __name__ == "__main__":
-    main()
+    main(["-6"] + sys.argv[1:])
@@ -11,23 +11,92 @@
 # The tool tests both on HTTP and HTTPS, unless the protocol is defined
 # in the list of URLs.
 #
+# The input is read lazily and a fixed number of requests is in flight
+# at any time. Each result is written as soon as it is complete, so the
+# output is not in input order.
+#
+# All requests share a single session, so connections are kept alive
+# and reused and host names are resolved once per DNS cache TTL. Host
+# names can be resolved by the DNS engine of bulkdig.py instead of the
+# system resolver, e.g. `httplookup.py -n 9.9.9.9`.
+#
+# The URLs are handed to the workers by a scheduler with token buckets
+# per host name, per IP address and a global one. It interleaves the
+# hosts, so a host at its limit does not take a worker from the others.
+#
+# Bodies are read as a stream up to a byte cap and hashed on the fly
+# (SHA-256 and, with `py-tlsh` installed, TLSH). Only the first bytes
+# are kept in the output. With `--store DIR`, the bodies are written to
+# a content-addressed store, once per unique SHA-256.
+#
+# With `--workers N`, the input is sharded by host name across N child
+# processes, each with its own event loop and session. Their output is
+# merged into a single stream as it arrives.
+#
 # ======================================================================
 
 
+import argparse
 import asyncio
+import collections
+import hashlib
 import json
+import os
+import socket
 import sys
 import time
 import uuid
+import zlib
 
 from datetime import datetime
+from urllib.parse import urlsplit
 
 import aiohttp
+from aiohttp.abc import AbstractResolver
 from aiolimiter import AsyncLimiter
+from yarl import URL
 
+from dnsengine import DNSError, Resolver
 
-# 8 requests / second
-limiter = AsyncLimiter(1, 0.125)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import tlsh
+except ImportError:
+    tlsh = None
+
+
+# Default number of concurrent requests, set by --concurrency
+CONCURRENCY = 32
+# Default number of connections per host, set by --limit-per-host
+LIMIT_PER_HOST = 8
+# Number of input lines that are read at once
+READ_HINT = 1 << 16
+# Timeout of a request including its redirects in seconds
+TIMEOUT = 7
+# Default requests per second per host name and per IP address, set by
+# --host-rate and --ip-rate, 0 for no limit. Only --limit-per-host
+# applies by default, so a crawl of a single host is not slowed down.
+HOST_RATE = 0
+IP_RATE = 0
+# Default number of queued URLs per worker, set by --backlog
+BACKLOG = 64
+# Seconds a worker waits before it checks the token buckets again
+SCHEDULER_TICK = 0.01
+# Default number of body bytes that are read and kept in the output, set
+# by --max-body and --inline
+MAX_BODY = 1 << 20
+INLINE = 4096
+# Size of the chunks a body is read in
+CHUNK = 1 << 16
+# Redirects that are followed per URL
+REDIRECTS = (301, 302, 303, 307, 308)
+MAX_REDIRECTS = 10
+# Number of finished URLs kept to reuse their redirect chains
+REUSE_SIZE = 4096
 
 
 def err(msg, do_flush=True):
@@ -39,155 +108,1322 @@ def err(msg, do_flush=True):
 
 
 class Response:
-    # uniquely generated ID
-    id: int
-    # lookup sequence of request based on ID
-    seq: int
-    # Requested timestamp
-    ts: int
-    # Requested URL
-    url_req: str
-    # URL of the response
-    url_res: str
-    # Status code of the response
-    status_code: int
-    # Dictionary of the header fields
-    headers: dict
-    # Cookies
-    cookies: dict
-    # Raw body
-    body: str
-    # body length:
-    length: int
-    # Python error message
-    err_msg: str
+    """A single response of a redirect chain. Slotted, as millions of
+    them pass through a run.
+    """
+
+    __slots__ = (
+        # uniquely generated ID
+        "id",
+        # lookup sequence of request based on ID
+        "seq",
+        # Requested timestamp
+        "ts",
+        # Requested URL
+        "url_req",
+        # URL of the response
+        "url_res",
+        # Status code of the response
+        "status_code",
+        # Header fields as (name, value) pairs
+        "headers",
+        # Cookies as name -> value
+        "cookies",
+        # First bytes of the body, decoded
+        "body",
+        # body length:
+        "length",
+        # Number of body bytes read, at most the byte cap
+        "size",
+        # Whether the body is longer than the byte cap
+        "truncated",
+        # Hashes of the bytes read
+        "sha256",
+        "tlsh",
+        # How the URL was chosen: direct, both, reuse, https-first,
+        # http-fallback, or reused from another chain
+        "strategy",
+        # Python error message
+        "err_msg",
+    )
 
     def __init__(self):
         pass
 
+    def record(self) -> dict:
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    def copy(self, **changes):
+        r = Response()
+        for k in self.__slots__:
+            setattr(r, k, changes.get(k, getattr(self, k)))
+
+        return r
+
     def to_json(self):
-        return json.dumps(
-            self,
-            # indent=0,
-            # separators=(',', ':'),
-            default=lambda o: dict([(k, str(v)) for k, v in o.__dict__.items()]),
-            # sort_keys=False,
+        return _dumps(self.record()).decode()
+
+
+def _dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+
+    return json.dumps(obj, separators=(",", ":"), ensure_ascii=False).encode()
+
+
+class JSONWriter:
+    """Writes the responses as JSON lines, buffered. The buffer is
+    written once it is full or `interval` seconds after the last flush,
+    also while no responses come in (see `run`).
+    """
+
+    def __init__(self, stream=None, buffer: int = 1 << 16, interval: float = 1.0):
+        self.stream = stream if stream is not None else sys.stdout.buffer
+        self.buffer = buffer
+        self.interval = interval
+
+        self._lines = []
+        self._size = 0
+        self._last = time.monotonic()
+
+    def write(self, responses: list):
+        for r in responses:
+            line = _dumps(r.record())
+            self._lines.append(line)
+            self._size += len(line) + 1
+
+        if self._size >= self.buffer or time.monotonic() - self._last >= self.interval:
+            self.flush()
+
+    async def run(self):
+        """Flushes the buffer periodically, so a stalled crawl does not
+        hold responses back. Runs until cancelled.
+        """
+        while True:
+            await asyncio.sleep(max(0.0, self._last + self.interval - time.monotonic()))
+
+            if time.monotonic() - self._last < self.interval:
+                continue
+
+            try:
+                self.flush()
+            except BrokenPipeError:
+                # Reported by the next write or on close
+                return
+
+    def flush(self):
+        if self._lines:
+            self._lines.append(b"")
+            self.stream.write(b"\n".join(self._lines))
+            self._lines = []
+            self._size = 0
+
+        self.stream.flush()
+        self._last = time.monotonic()
+
+    def close(self):
+        self.flush()
+
+
+class ParquetWriter:
+    """Writes the responses to a Parquet file, one row group per batch.
+    Needs `pyarrow`.
+    """
+
+    def __init__(self, path: str, batch: int = 8192):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        pair = pa.list_(pa.struct([("name", pa.string()), ("value", pa.string())]))
+
+        self.schema = pa.schema([
+            ("id", pa.string()),
+            ("seq", pa.int32()),
+            ("ts", pa.int64()),
+            ("url_req", pa.string()),
+            ("url_res", pa.string()),
+            ("status_code", pa.int32()),
+            ("headers", pair),
+            ("cookies", pair),
+            ("body", pa.string()),
+            ("length", pa.int64()),
+            ("size", pa.int64()),
+            ("truncated", pa.bool_()),
+            ("sha256", pa.string()),
+            ("tlsh", pa.string()),
+            ("strategy", pa.string()),
+            ("err_msg", pa.string()),
+        ])
+
+        self._pa = pa
+        self._writer = pq.ParquetWriter(path, self.schema, compression="zstd")
+        self.batch = batch
+        self._columns = {name: [] for name in self.schema.names}
+        self._rows = 0
+
+    def write(self, responses: list):
+        for r in responses:
+            for name, column in self._columns.items():
+                value = getattr(r, name)
+
+                if name == "headers" and value is not None:
+                    value = [{"name": k, "value": v} for k, v in value]
+                elif name == "cookies" and value is not None:
+                    value = [{"name": k, "value": v} for k, v in value.items()]
+
+                column.append(value)
+
+            self._rows += 1
+
+        if self._rows >= self.batch:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._writer.write_table(self._pa.table(self._columns, schema=self.schema))
+            self._columns = {name: [] for name in self.schema.names}
+            self._rows = 0
+
+    def close(self):
+        self.flush()
+        self._writer.close()
+
+
+class BodyStore:
+    """Content-addressed store of response bodies on disk. A body is
+    written to `<dir>/<ab>/<cd>/<sha256>` while it is read and kept only
+    if it is complete and no body with the same hash is stored yet.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._tmp = os.path.join(path, "tmp")
+        os.makedirs(self._tmp, exist_ok=True)
+
+        self.unique = 0
+        self.duplicates = 0
+
+    def open(self):
+        """Returns a temporary file to stream a body into."""
+        return open(os.path.join(self._tmp, uuid.uuid4().hex), "wb")
+
+    def commit(self, f, digest: str):
+        f.close()
+        path = os.path.join(self.path, digest[:2], digest[2:4], digest)
+
+        if os.path.exists(path):
+            os.unlink(f.name)
+            self.duplicates += 1
+        else:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(f.name, path)
+            self.unique += 1
+
+    def discard(self, f):
+        f.close()
+        os.unlink(f.name)
+
+
+class Capture:
+    """Reads bodies as a stream, up to `max_body` bytes. Keeps the first
+    `inline` bytes, hashes the bytes read and hands them to the store.
+    """
+
+    def __init__(self, max_body: int = MAX_BODY, inline: int = INLINE, store: BodyStore = None):
+        self.max_body = max_body
+        self.inline = min(inline, max_body)
+        self.store = store
+
+    async def read(self, x: aiohttp.ClientResponse, r: Response):
+        sha256 = hashlib.sha256()
+        fuzzy = tlsh.Tlsh() if tlsh is not None else None
+        head = bytearray()
+        size = 0
+        truncated = False
+
+        f = self.store.open() if self.store is not None else None
+
+        try:
+            async for chunk in x.content.iter_chunked(CHUNK):
+                if size + len(chunk) > self.max_body:
+                    chunk = chunk[:self.max_body - size]
+                    truncated = True
+
+                sha256.update(chunk)
+                if fuzzy is not None:
+                    fuzzy.update(chunk)
+                if f is not None:
+                    f.write(chunk)
+                if len(head) < self.inline:
+                    head += chunk[:self.inline - len(head)]
+
+                size += len(chunk)
+
+                if truncated:
+                    break
+        except BaseException:
+            if f is not None:
+                self.store.discard(f)
+            raise
+
+        r.sha256 = sha256.hexdigest()
+        r.tlsh = ""
+        if fuzzy is not None:
+            try:
+                fuzzy.final()
+                r.tlsh = fuzzy.hexdigest()
+            except ValueError:
+                # Too short or too uniform for TLSH
+                pass
+
+        if f is not None:
+            # A truncated body would be stored under the hash of its
+            # first bytes, as if it were complete
+            if size and not truncated:
+                self.store.commit(f, r.sha256)
+            else:
+                self.store.discard(f)
+
+        r.body = bytes(head).decode(x.charset or "utf-8", errors="replace")
+        r.size = size
+        r.truncated = truncated
+
+
+class EngineResolver(AbstractResolver):
+    """Resolves the host names of the connector with the DNS engine in
+    dnsengine.py instead of the system resolver.
+    """
+
+    def __init__(self, resolver: Resolver):
+        self.resolver = resolver
+        self._started = False
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        if not self._started:
+            await self.resolver.start()
+            self._started = True
+
+        qtypes = {socket.AF_INET: ["A"], socket.AF_INET6: ["AAAA"]}.get(family, ["A", "AAAA"])
+        hosts = []
+        error = None
+
+        for qtype in qtypes:
+            try:
+                msg = await self.resolver.query(host, qtype)
+            except (DNSError, ValueError) as e:
+                # E.g. a timeout of AAAA, the host fails only if the
+                # other query has no address either
+                error = e
+                continue
+
+            for rr in msg.answers:
+                if rr.rtype == qtype:
+                    hosts.append({
+                        "hostname": host,
+                        "host": rr.data,
+                        "port": port,
+                        "family": socket.AF_INET if qtype == "A" else socket.AF_INET6,
+                        "proto": 0,
+                        "flags": socket.AI_NUMERICHOST,
+                    })
+
+        if not hosts:
+            raise OSError(None, f"{host}: {error or 'No address'}")
+
+        return hosts
+
+    async def close(self):
+        if self._started:
+            await self.resolver.close()
+            self._started = False
+
+
+class Stats:
+    """Counts the connection and DNS cache events of a session."""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections = 0
+        self.reused = 0
+        self.dns_hits = 0
+        self.dns_misses = 0
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        config = aiohttp.TraceConfig()
+
+        def count(attr):
+            async def handler(session, ctx, params):
+                setattr(self, attr, getattr(self, attr) + 1)
+            return handler
+
+        config.on_request_start.append(count("requests"))
+        config.on_connection_create_end.append(count("connections"))
+        config.on_connection_reuseconn.append(count("reused"))
+        config.on_dns_cache_hit.append(count("dns_hits"))
+        config.on_dns_cache_miss.append(count("dns_misses"))
+
+        return config
+
+    def report(self, scheduler=None):
+        conns = self.connections + self.reused
+        lookups = self.dns_hits + self.dns_misses
+
+        err(
+            f"[OK] {self.requests} requests, {self.connections} connections opened, "
+            f"{self.reused} reused ({100.0 * self.reused / conns if conns else 0.0:0.1f}%), "
+            f"DNS cache {self.dns_hits} hits / {self.dns_misses} misses "
+            f"({100.0 * self.dns_hits / lookups if lookups else 0.0:0.1f}%)"
         )
 
+        if scheduler is not None:
+            err(f"[OK] Scheduler: workers waited {scheduler.throttled} times for the rate limits")
 
 
-async def query(url: str, semaphore: asyncio.Semaphore):
-    """Query a given URL, merge the lookup history, by following redirects and
-    return the results in chronological order.
+class CachingResolver(AbstractResolver):
+    """Remembers the addresses of host names for `ttl` seconds. Shared
+    by the connector and the scheduler, so a host name is resolved only
+    once for both. Concurrent lookups of the same name are merged.
+    """
+
+    def __init__(self, resolver: AbstractResolver, ttl: float, size: int = 65536):
+        self.resolver = resolver
+        self.ttl = ttl
+        self.size = size
+
+        # (host, family) -> (expiry, addresses) in insertion order
+        self._cache = {}
+        self._lookups = {}
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET):
+        key = (host, family)
+        entry = self._cache.get(key)
+
+        if entry is None or entry[0] <= time.monotonic():
+            if (lookup := self._lookups.get(key)) is None:
+                lookup = self._lookups[key] = asyncio.ensure_future(self.resolver.resolve(host, 0, family))
+
+            try:
+                entry = (time.monotonic() + self.ttl, await lookup)
+            finally:
+                self._lookups.pop(key, None)
+
+            self._cache.pop(key, None)
+            self._cache[key] = entry
+
+            while len(self._cache) > self.size:
+                del self._cache[next(iter(self._cache))]
+
+        return [dict(h, port=port) for h in entry[1]]
+
+    async def close(self):
+        await self.resolver.close()
+
+
+def bucket(rate: float):
+    """Returns a token bucket for `rate` requests per second, with a
+    burst of one second, or None for no limit.
+    """
+    if rate <= 0:
+        return None
+
+    burst = max(1.0, rate)
+    return AsyncLimiter(burst, burst / rate)
+
+
+class Scheduler:
+    """Hands out the URLs to the workers. The URLs are queued per host
+    name and the hosts are served round robin. A host is skipped while
+    its token bucket, the bucket of its IP address or the global bucket
+    is empty, or while it has `per_host` requests in flight.
+
+    Args:
+        resolver (AbstractResolver): Resolves the IP addresses of hosts.
+        size (int): Maximum number of queued URLs.
+        rate (float): Global requests per second, 0 for no limit.
+        host_rate (float): Requests per second per host name.
+        ip_rate (float): Requests per second per IP address.
+        per_host (int): Requests in flight per host, 0 for no limit.
+    """
+
+    def __init__(
+        self,
+        resolver: AbstractResolver,
+        size: int,
+        rate: float = 0,
+        host_rate: float = HOST_RATE,
+        ip_rate: float = IP_RATE,
+        per_host: int = 0,
+    ):
+        self.resolver = resolver
+        self.size = size
+        self.host_rate = host_rate
+        self.ip_rate = ip_rate
+        self.per_host = per_host
+
+        self._global = bucket(rate)
+        self._buckets = {}
+
+        # Host -> queued URLs, the resolved hosts in round robin order
+        # and their IP addresses
+        self._hosts = {}
+        self._ready = collections.deque()
+        self._address = {}
+        self._inflight = collections.Counter()
+        self._lookups = set()
+
+        self._queued = 0
+        self._closed = False
+
+        # Idle workers, woken one at a time, and the producer waiting
+        # for space in the queue
+        self._waiters = collections.deque()
+        self._space = asyncio.Event()
+        self._ticking = False
+
+        self.throttled = 0
+
+    def _notify(self):
+        """Wakes the longest waiting worker."""
+        while self._waiters:
+            fut = self._waiters.popleft()
+            if not fut.done():
+                fut.set_result(None)
+                return
+
+    async def _wait(self, limited: bool):
+        """Waits until notified. If a token bucket is empty, a single
+        worker polls every tick, as the buckets fill up without notice.
+        """
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters.append(fut)
+
+        tick = limited and not self._ticking
+        self._ticking |= tick
+
+        try:
+            await asyncio.wait_for(fut, SCHEDULER_TICK if tick else None)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if tick:
+                self._ticking = False
+
+    async def _resolve(self, host: str):
+        try:
+            address = (await self.resolver.resolve(host, 0, socket.AF_UNSPEC))[0]["host"]
+        except Exception:
+            # The request fails on its own, without the IP bucket
+            address = None
+
+        self._address[host] = address
+        self._ready.append(host)
+        self._notify()
+
+    def _bucket(self, key, rate: float):
+        if (b := self._buckets.get(key)) is None:
+            if len(self._buckets) >= 4 * self.size:
+                # Drop the buckets that are full again
+                for k in [k for k, b in self._buckets.items() if b.has_capacity(b.max_rate)]:
+                    del self._buckets[k]
+
+            b = self._buckets[key] = bucket(rate)
+
+        return b
+
+    async def put(self, url: str, strategy: str = "direct"):
+        while self._queued >= self.size:
+            self._space.clear()
+            await self._space.wait()
+
+        host = urlsplit(url).hostname or ""
+
+        if (queue := self._hosts.get(host)) is None:
+            queue = self._hosts[host] = collections.deque()
+
+            task = asyncio.create_task(self._resolve(host))
+            self._lookups.add(task)
+            task.add_done_callback(self._lookups.discard)
+
+        queue.append((url, strategy))
+        self._queued += 1
+
+        if len(queue) > 1:
+            # Resolved hosts are ready right away
+            self._notify()
+
+    def close(self):
+        """No more URLs are put, `get` returns None once all are done."""
+        self._closed = True
+
+        while self._waiters:
+            self._notify()
+
+    async def get(self):
+        """Returns the next URL to fetch and its strategy, or None at
+        the end.
+        """
+        while True:
+            limited = self._global is not None and not self._global.has_capacity()
+
+            if not limited:
+                for _ in range(len(self._ready)):
+                    host = self._ready.popleft()
+                    address = self._address[host]
+
+                    buckets = [self._global]
+                    if self.host_rate > 0:
+                        buckets.append(self._bucket(("host", host), self.host_rate))
+                    if self.ip_rate > 0 and address is not None:
+                        buckets.append(self._bucket(("ip", address), self.ip_rate))
+
+                    buckets = [b for b in buckets if b is not None]
+
+                    if self.per_host and self._inflight[host] >= self.per_host:
+                        self._ready.append(host)
+                        continue
+
+                    if not all(b.has_capacity() for b in buckets):
+                        self._ready.append(host)
+                        limited = True
+                        continue
+
+                    for b in buckets:
+                        await b.acquire()
+
+                    queue = self._hosts[host]
+                    item = queue.popleft()
+                    self._queued -= 1
+                    self._inflight[host] += 1
+
+                    if queue:
+                        self._ready.append(host)
+                    else:
+                        del self._hosts[host]
+                        del self._address[host]
+
+                    self._space.set()
+                    if self._ready:
+                        # Pass the remaining work on to the next worker
+                        self._notify()
+
+                    return item
+
+            if self._closed and not self._queued:
+                # Wake the other workers to let them stop as well
+                self._notify()
+                return None
+
+            if limited:
+                self.throttled += 1
+
+            await self._wait(limited)
+
+    def done(self, url: str):
+        """Marks a URL of `get` as fetched."""
+        host = urlsplit(url).hostname or ""
+
+        self._inflight[host] -= 1
+        if self._inflight[host] <= 0:
+            del self._inflight[host]
+
+        self._notify()
+
+
+def session(args, stats: Stats, resolver: AbstractResolver) -> aiohttp.ClientSession:
+    """Creates the session shared by all requests."""
+    connector = aiohttp.TCPConnector(
+        limit=args.concurrency,
+        limit_per_host=args.limit_per_host,
+        keepalive_timeout=args.keepalive,
+        use_dns_cache=args.dns_ttl > 0,
+        ttl_dns_cache=args.dns_ttl or None,
+        resolver=resolver,
+    )
+
+    # The cookies are sent along the redirects of a chain only, a jar of
+    # the session would grow with every host
+    return aiohttp.ClientSession(
+        connector=connector,
+        cookie_jar=aiohttp.DummyCookieJar(),
+        timeout=aiohttp.ClientTimeout(total=TIMEOUT),
+        trace_configs=[stats.trace_config()],
+    )
+
+
+class Fetches:
+    """Registry of the redirect chains of this run by URL, to reuse a
+    chain that reaches a URL which is being fetched or was fetched
+    already. The last `size` finished URLs are kept.
+    """
+
+    def __init__(self, size: int = REUSE_SIZE):
+        self.size = size
+        self.reused = 0
+
+        # URL -> future of the chain from that URL on, URL -> first URL
+        # of the chain that fetches it, and first URL of a chain -> the
+        # URL it waits for
+        self._chains = {}
+        self._owner = {}
+        self._waiting = {}
+
+    def _cycle(self, key: str, own: str) -> bool:
+        while key is not None:
+            owner = self._owner.get(key, key)
+            if owner == own:
+                return True
+            key = self._waiting.get(owner)
+
+        return False
+
+    async def reuse(self, key: str, own: str = None):
+        """Returns the chain from a known URL, or None if the URL is new
+        or waiting for it would be circular.
+        """
+        chain = self._chains.get(key)
+        if chain is None or (not chain.done() and self._cycle(key, own)):
+            return None
+
+        if own is not None:
+            self._waiting[own] = key
+
+        try:
+            result = await asyncio.shield(chain)
+        finally:
+            self._waiting.pop(own, None)
+
+        if result is None:
+            # The chain ended before it reached the URL
+            return None
+
+        self.reused += 1
+        return result
+
+    def register(self, key: str, own: str = None) -> bool:
+        """Registers the URL of a hop. Returns False if another chain
+        fetches it already, which this chain then waits not for.
+        """
+        if key in self._chains:
+            return False
+
+        self._chains[key] = asyncio.get_running_loop().create_future()
+        self._owner[key] = own or key
+        return True
+
+    def finish(self, keys: list, chain: list):
+        """Resolves the URLs registered for the hops of a chain with the
+        rest of the chain from that hop on. `keys` holds the URL and the
+        position in the chain of each registered hop.
+        """
+        for key, pos in keys:
+            fut = self._chains.get(key)
+            if fut is not None and not fut.done():
+                fut.set_result(chain[pos:] or None)
+
+                if pos >= len(chain):
+                    # Cancelled before the hop, it is fetched anew
+                    del self._chains[key]
+
+            self._owner.pop(key, None)
+
+        if len(self._chains) > self.size:
+            for key in [k for k, f in self._chains.items() if f.done()][:len(self._chains) - self.size]:
+                del self._chains[key]
+
+
+def url_key(url) -> str:
+    """Normalizes a URL for the registry of fetches."""
+    u = URL(url).with_fragment(None)
+    return str(u.with_path("/") if not u.raw_path else u)
+
+
+def _response(r_id: str, seq: int, r_ts: int, url: str, strategy: str) -> Response:
+    r = Response()
+    r.id = r_id
+    r.seq = seq
+    r.ts = r_ts
+    r.url_req = url
+    r.url_res = ""
+    r.status_code = -1
+    r.headers = None
+    r.cookies = None
+    r.body = ""
+    r.length = -1
+    r.size = 0
+    r.truncated = False
+    r.sha256 = ""
+    r.tlsh = ""
+    r.strategy = strategy
+    r.err_msg = ""
+
+    return r
+
+
+async def query(
+    session: aiohttp.ClientSession,
+    url: str,
+    capture: Capture,
+    strategy: str = "direct",
+    fetches: Fetches = None,
+    verbose: bool = False,
+):
+    """Query a given URL, follow the redirects one by one and return the
+    results in chronological order. With a registry of fetches, a hop to
+    a URL that is known already reuses the known chain from there on.
     """
 
     results = []
-    responses = []
+    # URLs registered for the hops of this chain, with their position in
+    # the results, and all URLs of the chain
+    keys = []
+    visited = set()
 
     # Unique identifier
     r_id = str(uuid.uuid4())
     # POSIX timestamp
     r_ts = int(datetime.now().timestamp())
-    r_url_req = url
 
-    async with aiohttp.ClientSession() as session:
-        # Wait for it's semaphore
-        await semaphore.acquire()
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TIMEOUT
+    # Cookies of the chain, sent along the redirects
+    cookies = {}
+    current = url
 
-        try:
-            # TODO: only print if verbose output is requested
-            err(f"Fetching {url} ...")
-            async with session.get(url, timeout=7) as res:
-                responses += res.history
-                responses.append(res)
+    try:
+        for seq in range(MAX_REDIRECTS + 1):
+            if fetches is not None:
+                key = url_key(current)
+                own = keys[0][0] if keys else None
 
-                for seq, x in enumerate(responses):
-                    try:
-                        err_msg = ""
-                        content = await x.text()
-                    except Exception as e:
-                        content = ""
-                        err_msg = str(e)
-
-                    r = Response()
-                    r.id = r_id
-                    r.seq = seq
-                    r.ts = r_ts
-                    r.url_req = r_url_req
+                if key in visited:
+                    r = _response(r_id, seq, r_ts, url, strategy)
+                    r.err_msg = f"Redirect loop to {current}"
+                    results.append(r)
+                    break
+
+                visited.add(key)
+                chain = await fetches.reuse(key, own=own)
+
+                if chain is not None:
+                    results += [
+                        r.copy(id=r_id, seq=seq + i, ts=r_ts, url_req=url, strategy="reused")
+                        for i, r in enumerate(chain)
+                    ]
+                    break
+
+                # A hop that is not registered, e.g. as waiting for it
+                # would be circular, is fetched all the same
+                if fetches.register(key, own=own):
+                    keys.append((key, len(results)))
+
+            if verbose:
+                err(f"Fetching {current} ...")
+
+            r = _response(r_id, seq, r_ts, url, strategy)
+            location = None
+
+            try:
+                left = deadline - loop.time()
+                if left <= 0:
+                    # The chain ran out of time; a total timeout of 0
+                    # would disable the timeout in aiohttp
+                    raise asyncio.TimeoutError()
+
+                async with session.get(
+                    current,
+                    allow_redirects=False,
+                    cookies=cookies,
+                    timeout=aiohttp.ClientTimeout(total=left),
+                ) as x:
                     r.url_res = str(x.url)
                     r.status_code = x.status
-                    r.headers = dict(x.raw_headers)
-                    r.cookies = dict(x.cookies)
-                    r.body = content
+                    r.headers = [(k.decode("latin-1"), v.decode("latin-1")) for k, v in x.raw_headers]
+                    r.cookies = {k: m.value for k, m in x.cookies.items()}
                     r.length = x.content_length
-                    r.err_msg = err_msg
 
-                    results.append(r)
+                    try:
+                        await capture.read(x, r)
+                    except Exception as e:
+                        r.err_msg = str(e)
+
+                    cookies.update(r.cookies)
+                    if x.status in REDIRECTS:
+                        location = x.headers.get("Location")
+                        if location:
+                            location = str(x.url.join(URL(location)))
+            except Exception as e:
+                r.err_msg = str(e) or type(e).__name__
+                results.append(r)
+                break
 
-        except Exception as e:
-            r = Response()
-            r.id = r_id
-            r.seq = 0
-            r.ts = r_ts
-            r.url_req = r_url_req
-            r.url_res = ""
-            r.status_code = -1
-            r.headers = None
-            r.cookies = None
-            r.body = ""
-            r.length = -1
-            r.err_msg = str(e)
             results.append(r)
-        finally:
-            semaphore.release()
+
+            if not location:
+                break
+
+            current = location
+        else:
+            r = _response(r_id, MAX_REDIRECTS + 1, r_ts, url, strategy)
+            r.err_msg = f"More than {MAX_REDIRECTS} redirects"
+            results.append(r)
+    finally:
+        if fetches is not None:
+            fetches.finish(keys, results)
 
     return results
 
 
-async def main():
-    # TODO: Chunk the set of URLs and lookup and fetch the results while
-    #       looking up the remaining stuff. So far, the lookup first has
-    #       to finish everything before the results are written.
+async def fetch(
+    session: aiohttp.ClientSession,
+    url: str,
+    strategy: str,
+    capture: Capture,
+    fetches: Fetches = None,
+    verbose: bool = False,
+):
+    """Fetches a URL of the scheduler. In HTTPS-first mode, HTTP is
+    tried if the HTTPS request fails without a response.
+    """
+    results = await query(session, url, capture, strategy, fetches, verbose)
+
+    if strategy == "https-first" and results[0].status_code == -1:
+        fallback = "http://" + url[len("https://"):]
+        results += await query(session, fallback, capture, "http-fallback", fetches, verbose)
+
+    return results
+
+
+def expand(line: str, schemes: str = "reuse"):
+    """Returns the URLs to fetch for an input line with their strategy.
+    In reuse mode, HTTPS goes first, so the redirect of HTTP to HTTPS
+    finds it in flight.
+    """
+    if line.startswith('http://') or line.startswith('https://'):
+        return [(line, "direct")]
 
-    # Prepare list of URLs to fetch
-    urls = []
+    if schemes == "https-first":
+        return [('https://' + line, "https-first")]
+    if schemes == "reuse":
+        return [('https://' + line, "reuse"), ('http://' + line, "reuse")]
 
-    for line in sys.stdin:
+    return [('http://' + line, "both"), ('https://' + line, "both")]
+
+
+async def readlines(stream):
+    """Reads lines from a stream without blocking the event loop."""
+    loop = asyncio.get_running_loop()
+
+    while lines := await loop.run_in_executor(None, stream.readlines, READ_HINT):
+        for line in lines:
+            yield line
+
+
+async def producer(scheduler: Scheduler, schemes: str = "reuse"):
+    """Feeds the URLs of the input lines to the scheduler."""
+    async for line in readlines(sys.stdin):
         line = line.strip()
 
         if not line or line[0] == '#':
             # Skip empty lines or in-line comments
             continue
 
-        if line.startswith('http://'):
-            urls.append(line)
-        elif line.startswith('https://'):
-            urls.append(line)
-        else:
-            urls.append('http://' + line)
-            urls.append('https://' + line)
+        for url, strategy in expand(line, schemes):
+            await scheduler.put(url, strategy)
+
+    scheduler.close()
+
+
+async def worker(
+    scheduler: Scheduler,
+    session: aiohttp.ClientSession,
+    capture: Capture,
+    writer,
+    fetches: Fetches = None,
+    verbose: bool = False,
+):
+    """Fetches the URLs of the scheduler one after the other and writes
+    the responses as soon as they are complete. Returns the number of
+    URLs.
+    """
+    fetched = 0
+
+    while (item := await scheduler.get()) is not None:
+        url, strategy = item
+        try:
+            responses = await fetch(session, url, strategy, capture, fetches, verbose)
+        finally:
+            scheduler.done(url)
+
+        writer.write(responses)
+        fetched += 1
+
+    return fetched
+
+
+def shard(line: str, workers: int) -> int:
+    """Returns the worker of an input line. All URLs of a host go to
+    the same worker, so the per-host limits hold.
+    """
+    host = urlsplit(line).hostname if "://" in line else line.split("/", 1)[0]
+    return zlib.crc32((host or "").lower().encode()) % workers
+
+
+def child_args(args, idx: int) -> list:
+    """Returns the command line of worker process `idx`. The global
+    limits are split evenly across the workers.
+    """
+    cmd = [
+        sys.executable,
+        os.path.abspath(__file__),
+        f"--concurrency={max(1, args.concurrency // args.workers)}",
+        f"--limit-per-host={args.limit_per_host}",
+        f"--rate={args.rate / args.workers}",
+        f"--host-rate={args.host_rate}",
+        f"--ip-rate={args.ip_rate / args.workers}",
+        f"--backlog={args.backlog}",
+        f"--keepalive={args.keepalive}",
+        f"--dns-ttl={args.dns_ttl}",
+        f"--max-body={args.max_body}",
+        f"--inline={args.inline}",
+        f"--schemes={args.schemes}",
+        f"--format={args.format}",
+    ]
+    cmd += [f"--nameserver={ns}" for ns in args.nameserver]
+
+    if args.store:
+        cmd.append(f"--store={args.store}")
+    if args.format == "parquet":
+        # One file per worker
+        base, ext = os.path.splitext(args.output)
+        cmd.append(f"--output={base}-{idx}{ext}")
+    if args.verbose:
+        cmd.append("--verbose")
+
+    return cmd
+
+
+async def main_sharded(args) -> int:
+    """Runs `args.workers` child processes, feeds each the input lines
+    of its shard and merges their output. Returns the worst exit code.
+    """
+    children = [
+        await asyncio.create_subprocess_exec(
+            *child_args(args, i),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        for i in range(args.workers)
+    ]
+    output = open(args.output, "wb") if args.output and args.format == "json" else sys.stdout.buffer
+
+    # Set once the parent terminates the children, their exit codes
+    # are not reported then
+    stopped = False
+
+    def terminate():
+        nonlocal stopped
+        stopped = True
+
+        for p in children:
+            if p.returncode is None:
+                p.terminate()
+
+    async def feed():
+        # Shards whose worker died, their lines are dropped
+        dead = set()
+
+        try:
+            async for line in readlines(sys.stdin):
+                stripped = line.strip()
+                if not stripped or stripped[0] == '#':
+                    continue
+
+                idx = shard(stripped, args.workers)
+                if idx in dead:
+                    continue
+
+                p = children[idx]
+                try:
+                    p.stdin.write(line.encode() if line.endswith("\n") else (line + "\n").encode())
+                    await p.stdin.drain()
+                except (BrokenPipeError, ConnectionResetError):
+                    # Its exit code is reported once all workers are done
+                    dead.add(idx)
+        except BaseException:
+            terminate()
+            raise
+        finally:
+            for p in children:
+                p.stdin.close()
+
+    async def merge(p):
+        # Write complete lines only, so the streams do not interleave
+        # within a record
+        rest = b""
+
+        try:
+            while chunk := await p.stdout.read(1 << 16):
+                chunk = rest + chunk
+                end = chunk.rfind(b"\n") + 1
+                rest = chunk[end:]
+
+                if end:
+                    output.write(chunk[:end])
+                    output.flush()
+
+            if rest:
+                output.write(rest)
+        except BaseException:
+            # Without a reader, the other workers would block on their
+            # STDOUT
+            terminate()
+            raise
+
+    try:
+        # A failed worker or merge does not cancel the others
+        results = await asyncio.gather(feed(), *[merge(p) for p in children], return_exceptions=True)
+        output.flush()
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        # The children get the SIGINT of the terminal as well
+        terminate()
+        for p in children:
+            await p.wait()
+
+        return 255
+    except BrokenPipeError as e:
+        results = [e]
+
+    rc = 0
+
+    for e in results:
+        if isinstance(e, BrokenPipeError):
+            # STDOUT is closed early, e.g. by `head`
+            if output is sys.stdout.buffer:
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            rc = 1
+        elif isinstance(e, BaseException):
+            err(f"[EE] {str(e) or type(e).__name__}")
+            rc = 1
+
+    for i, p in enumerate(children):
+        code = await p.wait()
+
+        if code and not stopped:
+            err(f"[EE] Worker {i} exited with {code}")
+            # A worker killed by a signal has a negative code
+            rc = max(rc, code if code > 0 else 128 - code)
+
+    return rc
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Fetch the HTTP(S) responses of the domains or URLs from STDIN",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Number of concurrent requests and open connections ; By default {CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--limit-per-host",
+        type=int,
+        default=LIMIT_PER_HOST,
+        help=f"Number of requests in flight per host, 0 for no limit ; By default {LIMIT_PER_HOST}",
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=0,
+        help="Requests per second in total, 0 for no limit ; By default no limit",
+    )
+    parser.add_argument(
+        "--host-rate",
+        type=float,
+        default=HOST_RATE,
+        help="Requests per second per host name, 0 for no limit ; By default no limit",
+    )
+    parser.add_argument(
+        "--ip-rate",
+        type=float,
+        default=IP_RATE,
+        help="Requests per second per IP address, 0 for no limit ; By default no limit",
+    )
+    parser.add_argument(
+        "--backlog",
+        type=int,
+        default=BACKLOG,
+        help=f"Number of queued URLs per worker, to interleave the hosts ; By default {BACKLOG}",
+    )
+    parser.add_argument(
+        "--keepalive",
+        type=float,
+        default=30.0,
+        help="Seconds an idle connection is kept open for reuse ; By default 30",
+    )
+    parser.add_argument(
+        "--dns-ttl",
+        type=int,
+        default=300,
+        help="Seconds a resolved host name is cached, 0 to disable the cache ; By default 300",
+    )
+    parser.add_argument(
+        "-n",
+        "--nameserver",
+        action="append",
+        default=[],
+        help="Resolve host names with the DNS engine of bulkdig.py at this nameserver, may be repeated",
+    )
+    parser.add_argument(
+        "--max-body",
+        type=int,
+        default=MAX_BODY,
+        help=f"Number of body bytes read and hashed per response ; By default {MAX_BODY}",
+    )
+    parser.add_argument(
+        "--inline",
+        type=int,
+        default=INLINE,
+        help=f"Number of body bytes kept in the output ; By default {INLINE}",
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        metavar="DIR",
+        help="Write the bodies to a content-addressed store in DIR, once per SHA-256",
+    )
+    parser.add_argument(
+        "--schemes",
+        choices=["reuse", "https-first", "both"],
+        default="reuse",
+        help="Schemes tried for lines without one: both, HTTPS with HTTP as fallback, "
+        "or both with shared redirect chains ; By default reuse",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["json", "parquet"],
+        default="json",
+        help="Output format ; By default JSON lines",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        metavar="PATH",
+        help="Write the output to PATH instead of STDOUT, required for Parquet",
+    )
+    parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes, the input is sharded by host name ; By default 1",
+    )
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print each fetched URL to STDERR",
+    )
+
+    args = parser.parse_args()
+
+    if args.format == "parquet" and not args.output:
+        parser.error("--format parquet requires --output")
+
+    args.concurrency = max(1, args.concurrency)
+    args.nameserver = [ns.lstrip("@") for ns in args.nameserver]
+
+    return args
+
+
+async def main():
+    args = parse_args()
+
+    if args.workers > 1:
+        if rc := await main_sharded(args):
+            sys.exit(rc)
+        return
+
+    stats = Stats()
+
+    rc = 0
+
+    if args.nameserver:
+        resolver = EngineResolver(Resolver(args.nameserver, concurrency=args.concurrency))
+    else:
+        resolver = aiohttp.DefaultResolver()
+
+    resolver = CachingResolver(resolver, args.dns_ttl)
+    capture = Capture(
+        max_body=args.max_body,
+        inline=args.inline,
+        store=BodyStore(args.store) if args.store else None,
+    )
+    if args.format == "parquet":
+        writer = ParquetWriter(args.output)
+    else:
+        writer = JSONWriter(open(args.output, "wb") if args.output else None)
+
+    scheduler = Scheduler(
+        resolver,
+        size=args.backlog * args.concurrency,
+        rate=args.rate,
+        host_rate=args.host_rate,
+        ip_rate=args.ip_rate,
+        per_host=args.limit_per_host,
+    )
+    fetches = Fetches() if args.schemes == "reuse" else None
+
+    async with session(args, stats, resolver) as s:
+        # A fixed pool of workers, fed by the scheduler. Only the
+        # requests in flight and the queued URLs are held in memory.
+        tasks = [asyncio.create_task(producer(scheduler, args.schemes))] + [
+            asyncio.create_task(worker(scheduler, s, capture, writer, fetches, verbose=args.verbose))
+            for _ in range(args.concurrency)
+        ]
+
+        flusher = asyncio.create_task(writer.run()) if isinstance(writer, JSONWriter) else None
+
+        try:
+            fetched = sum((await asyncio.gather(*tasks))[1:])
+            err(f"[OK] {fetched} URLs fetched")
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # asyncio.run() cancels the main task on SIGINT
+            rc = 255
+        except BrokenPipeError:
+            # STDOUT is closed early, e.g. by `head`
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            rc = 1
+        finally:
+            # Stop the producer and all workers if one of them failed
+            for t in tasks:
+                t.cancel()
 
+            if flusher is not None:
+                flusher.cancel()
+                tasks.append(flusher)
 
-    # TODO: make number of simultaneous lookups specifyable
-    semaphore = asyncio.Semaphore(value=32)
-    tasks = []
-    #await query(urls, semaphore)
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    # async with aiohttp.ClientSession() as session:
-    #    await semaphore.acquire()
+            try:
+                writer.close()
+            except BrokenPipeError:
+                os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+                rc = rc or 1
+            stats.report(scheduler)
 
-    for url in urls:
-        tasks.append(query(url, semaphore))
-    
-    # await asyncio.wait(tasks)
-    results = await asyncio.gather(*tasks)
+            if capture.store is not None:
+                err(f"[OK] Body store: {capture.store.unique} unique, {capture.store.duplicates} duplicate bodies")
+            if fetches is not None:
+                err(f"[OK] Redirects: {fetches.reused} responses reused from other chains")
 
-    for responses in results:
-        for response in responses:
-            sys.stdout.write(response.to_json())
-            sys.stdout.write("\n")
+            await resolver.close()
 
-        sys.stdout.flush()
+    if rc:
+        sys.exit(rc)
 
 
 if __name__ == "__main__":
@@ -8,13 +8,53 @@
 # default, it looks up the public IP address via icanhazip.com which
 # dubbed this application.
 #
+# With `--batch`, many IP addresses are read from STDIN and looked up at
+# bgpview.io concurrently over a single pooled session. The responses
+# are cached per covering prefix (see ipcache.py): later addresses of a
+# prefix that was seen already skip the API, and their PTR record is
+# resolved by the DNS engine of bulkdig.py instead. One CSV row
+# `ip,asn,cidr,ptr` is written per input line, in input order.
+#
+# The HTTP and DNS libraries are imported on first use only, so a
+# single lookup starts quickly.
+#
 # ======================================================================
 
 import sys
+import os
 import argparse
-import requests
-from ipaddress import ip_address
-from pprint import pprint as pp
+import asyncio
+import collections
+from ipaddress import ip_address, ip_network
+
+# HTTP client of the batch mode, imported by lookup_batch()
+aiohttp = None
+
+API_URL = "https://api.bgpview.io"
+
+# Number of requests in flight in batch mode
+CONCURRENCY = 8
+# Seconds until a request times out
+TIMEOUT = 10
+# Retries of a request answered with 429, and the first backoff in
+# seconds, which doubles on each retry
+RETRIES = 5
+BACKOFF = 1.0
+# Prefix lengths of the addresses that wait for each other's lookup, as
+# they likely share a prefix
+GROUP_V4 = 24
+GROUP_V6 = 48
+# Failed lookups of a group in a row after which its waiting addresses
+# get an empty row without a request
+GROUP_FAILURES = 2
+
+# Number of input lines looked up at once in batch mode, most of them
+# answered from the cache
+WINDOW = 1024
+# Number of input lines that are read at once
+READ_HINT = 1 << 16
+
+HEADER = "ip,asn,cidr,ptr"
 
 USAGE=f"""
 {sys.argv[0]} [CMD] [IP]
@@ -22,34 +62,26 @@ USAGE=f"""
 Lookup BGP features of a given IP. Possible options are listed below.
 """
 
-def main():
-    parser = argparse.ArgumentParser(
-        description="Lookup some BGP features of a given IP",
-        # usage=USAGE,
-    )
-    parser.add_argument(
-        "cmd",
-        type=str.lower,
-        default="ip",
-        choices=["asn", "cidr", "ip", "ptr"],
-        help="Command to specify the feature to return.",
-    )
-    parser.add_argument(
-        "-i",
-        "--ip",
-        type=str.lower,
-        default="127.0.0.1",
-        required=False
-    )
-    parser.add_argument(
-        "-v",
-        "--ip-version",
-        type=int,
-        default=4,
-        choices=[4, 6],
-        help="Define the IP version to lookup ; By default IPv4",
-    )
-    args = parser.parse_args(sys.argv[1:])
+
+def err(msg, do_flush=True):
+    sys.stderr.write(msg)
+    sys.stderr.write('\n')
+
+    if do_flush:
+        sys.stderr.flush()
+
+
+def prefix_of(data: dict):
+    """Returns the most specific prefix of a bgpview response, or None."""
+    prefixes = data.get("prefixes") or []
+    if not prefixes:
+        return None
+
+    return max(prefixes, key=lambda p: ip_network(p["prefix"], strict=False).prefixlen)
+
+
+def lookup_one(args):
+    import requests
 
     # Lookup public IP address
     if args.ip in ["127.0.0.1", "::1", "localhost"]:
@@ -65,8 +97,8 @@ def main():
         print(f"Invalid IP address: {args.ip}")
         sys.exit(1)
 
-    res = requests.get(f"https://api.bgpview.io/ip/{args.ip}")
-    
+    res = requests.get(f"{args.api_url}/ip/{args.ip}")
+
     if not res.ok:
         print(
             f"{res.status_code} - Failed to query {args.ip} from bgpview.io",
@@ -93,11 +125,288 @@ def main():
         answer = res["ip"]
     elif args.cmd ==  "ptr":
         answer = "" if res["ptr_record"] is None else res["ptr_record"]
-    
+
     print(answer, file=sys.stdout)
 
 
+class Batch:
+    """Looks up the addresses of the batch mode, with the prefix cache
+    in front of the API.
+    """
+
+    def __init__(self, args, session, cache, resolver):
+        self.args = args
+        self.session = session
+        self.cache = cache
+        self.resolver = resolver
+
+        self.slots = asyncio.Semaphore(args.concurrency)
+        # Group of addresses -> lookup in flight
+        self.inflight = {}
+
+        self.requests = 0
+        self.retries = 0
+        self.failed = 0
+
+    async def request(self, ip: str):
+        """Returns the data node of the API response, or None."""
+        delay = BACKOFF
+        url = f"{self.args.api_url}/ip/{ip}"
+
+        for attempt in range(RETRIES + 1):
+            self.requests += 1
+
+            try:
+                async with self.session.get(url) as res:
+                    if res.status == 429 and attempt < RETRIES:
+                        try:
+                            wait = float(res.headers.get("Retry-After"))
+                        except (TypeError, ValueError):
+                            wait = delay
+
+                        self.retries += 1
+                        await asyncio.sleep(wait)
+                        delay *= 2
+                        continue
+
+                    if not res.ok:
+                        err(f"[EE] {res.status} - Failed to query {ip} from bgpview.io")
+                        break
+
+                    data = await res.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                err(f"[EE] Failed to query {ip}: {str(e) or type(e).__name__}")
+                break
+
+            if data.get("status", "error") == "error":
+                err(f"[EE] API error for {ip}: {data.get('status_message', '<no message>')}")
+                break
+
+            return data.get("data")
+
+        self.failed += 1
+        return None
+
+    async def ptr(self, ip: str) -> str:
+        from dnsengine import DNSError, reverse_name
+
+        try:
+            msg = await self.resolver.query(reverse_name(ip), "PTR")
+        except (DNSError, ValueError):
+            return ""
+
+        names = [rr.data for rr in msg.answers if rr.rtype == "PTR"]
+        return names[0].rstrip(".") if names else ""
+
+    async def row(self, ip: str, hit: dict) -> tuple:
+        """Returns the row of a cache hit."""
+        ptr = hit.get("ptr")
+        if ptr is None:
+            ptr = await self.ptr(ip)
+
+        return ip, hit["asn"], hit["cidr"], ptr
+
+    async def fetch(self, ip: str):
+        """Returns the row of an address, fetched from the API, or None
+        if the request failed.
+        """
+        async with self.slots:
+            # A lookup of another group may have cached the prefix while
+            # this one waited for a slot. The address is counted by the
+            # first check already.
+            hit = self.cache.get(ip, count=False)
+            data = await self.request(ip) if hit is None else None
+
+        if hit is not None:
+            return await self.row(ip, hit)
+        if data is None:
+            return None
+
+        prefix = prefix_of(data)
+        row = {
+            "asn": "" if prefix is None else str(prefix["asn"]["asn"]),
+            "cidr": "" if prefix is None else prefix["prefix"],
+            "ptr": data.get("ptr_record") or "",
+        }
+        self.cache.put(ip, row, network=row["cidr"] or None)
+
+        return ip, row["asn"], row["cidr"], row["ptr"]
+
+    async def lookup(self, ip: str) -> tuple:
+        """Returns the (ip, asn, cidr, ptr) row of an address."""
+        addr = ip_address(ip)
+        group = ip_network(f"{ip}/{GROUP_V4 if addr.version == 4 else GROUP_V6}", strict=False)
+
+        # Wait for a lookup of the same group, which likely caches the
+        # prefix of this address as well. A lookup resolves with the
+        # number of failed lookups of the group in a row: after the
+        # first failure one waiter retries, after the second the others
+        # give up, rather than retrying the group one address at a time.
+        failures = 0
+        while (pending := self.inflight.get(group)) is not None:
+            failures = await asyncio.shield(pending)
+
+        if failures >= GROUP_FAILURES:
+            self.failed += 1
+            return ip, "", "", ""
+
+        if (hit := self.cache.get(ip)) is not None:
+            return await self.row(ip, hit)
+
+        done = self.inflight[group] = asyncio.get_running_loop().create_future()
+        row = None
+
+        try:
+            row = await self.fetch(ip)
+        finally:
+            del self.inflight[group]
+            done.set_result(0 if row is not None else failures + 1)
+
+        return row if row is not None else (ip, "", "", "")
+
+
+async def lookup_batch(args):
+    global aiohttp
+    import aiohttp
+
+    from dnsengine import Resolver
+    from ipcache import Cache
+
+    cache = Cache(args.cache or ":memory:", per_address=("ip", "ptr"))
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+    rc = 0
+
+    async with Resolver(args.nameserver or None, concurrency=4 * args.concurrency) as resolver, \
+            aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        batch = Batch(args, session, cache, resolver)
+
+        # Lookups in input order, the oldest is written once it is done
+        window = collections.deque()
+
+        def write(row):
+            sys.stdout.write(",".join(row) + "\n")
+
+        try:
+            sys.stdout.write(HEADER + "\n")
+
+            loop = asyncio.get_running_loop()
+
+            while lines := await loop.run_in_executor(None, sys.stdin.readlines, READ_HINT):
+                for line in lines:
+                    line = line.strip()
+
+                    if not line or line[0] == "#":
+                        continue
+
+                    try:
+                        ip = str(ip_address(line))
+                    except ValueError:
+                        # Invalid addresses get an empty row
+                        window.append((line, None))
+                    else:
+                        window.append((ip, asyncio.create_task(batch.lookup(ip))))
+
+                    while len(window) >= WINDOW or (window and (window[0][1] is None or window[0][1].done())):
+                        ip, task = window.popleft()
+                        write(await task if task is not None else (ip, "", "", ""))
+
+            while window:
+                ip, task = window.popleft()
+                write(await task if task is not None else (ip, "", "", ""))
+
+            sys.stdout.flush()
+        except BrokenPipeError:
+            # STDOUT is closed early, e.g. by `head`
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            rc = 1
+        finally:
+            for _, task in window:
+                if task is not None:
+                    task.cancel()
+
+    err(f"[OK] {batch.requests} requests, {batch.retries} retries, {batch.failed} failed")
+    cache.report()
+    cache.close()
+
+    return rc
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Lookup some BGP features of a given IP",
+        # usage=USAGE,
+    )
+    parser.add_argument(
+        "cmd",
+        type=str.lower,
+        nargs="?",
+        default="ip",
+        choices=["asn", "cidr", "ip", "ptr"],
+        help="Command to specify the feature to return.",
+    )
+    parser.add_argument(
+        "-i",
+        "--ip",
+        type=str.lower,
+        default="127.0.0.1",
+        required=False
+    )
+    parser.add_argument(
+        "-v",
+        "--ip-version",
+        type=int,
+        default=4,
+        choices=[4, 6],
+        help="Define the IP version to lookup ; By default IPv4",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="Read IP addresses from STDIN and write `ip,asn,cidr,ptr` rows",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Number of requests in flight in batch mode ; By default {CONCURRENCY}",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        metavar="PATH",
+        help="SQLite file to cache the responses per prefix between runs",
+    )
+    parser.add_argument(
+        "-n",
+        "--nameserver",
+        action="append",
+        default=[],
+        help="Nameserver for the PTR records of cached prefixes ; By default from /etc/resolv.conf",
+    )
+    parser.add_argument(
+        "--api-url",
+        type=str,
+        default=API_URL,
+        help=f"URL of the API, e.g. a local stand-in for tests ; By default {API_URL}",
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    args.api_url = args.api_url.rstrip("/")
+    args.concurrency = max(1, args.concurrency)
+    args.nameserver = [ns.lstrip("@") for ns in args.nameserver]
+
+    if not args.batch:
+        lookup_one(args)
+        return
+
+    try:
+        sys.exit(asyncio.run(lookup_batch(args)))
+    except KeyboardInterrupt:
+        sys.exit(255)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,9 +1,12 @@
 #!/bin/bash
 
 host="whois.cymru.com"
+dir="$(dirname "$(readlink -f "$0")")"
+db=""
+cymru_opts=()
 
 usage() {
-    echo "Usage: $0 [-46] [input_file]"
+    echo "Usage: $0 [-4p] [-c connections] [-d prefix_table] [input_file]"
     echo ""
     echo "This scripts performs a lookup of IP addresses. It will send a whois request"
     echo "to Team Cymru's whois service. Besides the regular lookup, one can also lookup"
@@ -13,6 +16,8 @@ usage() {
     echo "Options:"
     echo "  -4      Enforces the usage of IPv4 for data transmission"
     echo "  -p      Looks up the first hop of an IP address."
+    echo "  -c N    Number of parallel bulk sessions (by default 4)"
+    echo "  -d FILE Looks up offline in a prefix table of asnlookup.py instead"
     echo ""
     echo "Examples:"
     echo "  $0 -4 input_file.txt    # Performs a whois lookup by using the IPv4 service"
@@ -22,7 +27,7 @@ usage() {
 }
 
 # Parser command line arguments
-while getopts "4p" opt; do
+while getopts "4pc:d:" opt; do
     case $opt in
         4)
             host="v4.whois.cymru.com"
@@ -30,6 +35,12 @@ while getopts "4p" opt; do
         p)
             host="v4-peer.whois.cymru.com"
             ;;
+        c)
+            cymru_opts+=(--connections "$OPTARG")
+            ;;
+        d)
+            db="$OPTARG"
+            ;;
         h)
             usage
             ;;
@@ -42,28 +53,13 @@ done
 # Shift parsed options so $1 becomes the input file if provided
 shift $((OPTIND - 1))
 
+if [[ -n "${db}" ]] ; then
+    # Same CSV columns, answered from the local table
+    cat "${1:-/dev/stdin}" | sort | uniq | "${dir}/asnlookup.py" --db "${db}"
+    exit $?
+fi
 
-# Trap the temporary directory to delete on EXIT
-TMP=$(mktemp -d)
-trap "rm -rf $TMP" EXIT
-
-
-# Input file
-bulk="$TMP/bulk.txt"
-
-echo "begin" >> $bulk
-echo "verbose" >> $bulk
-# TODO: Add a filter on IPv4 and IPv6.
-cat "${1:-/dev/stdin}" | sort | uniq >> $bulk
-echo "end" >> $bulk
-
-tmp_lookup=$(mktemp)
-
-netcat $host 43 < $bulk >> ${tmp_lookup}
-
-# Print CSV header
-echo "asn,ip,prefix,cc,rir,allocated,asname"
-
-# Convert IP-to-ASN output to CSV
-cat ${tmp_lookup} | grep "^[0-9]" | sed -E 's/\| ([^|]+)$/| "\1"/' | sed 's/ *| */,/g'
-
+# Bulk sessions over parallel connections, see cymru.py. The input is
+# deduplicated and filtered on IPv4 and IPv6 addresses, the rows are
+# written as the answers arrive.
+exec "${dir}/cymru.py" --host "${host}" "${cymru_opts[@]}" "${1:-/dev/stdin}"
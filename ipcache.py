@@ -0,0 +1,242 @@
+# ======================================================================
+#
+#   ipcache.py
+#
+# Prefix-aware cache of IP lookups, used as library by ipinfo.py and
+# icanhaz.py. The responses are kept in a SQLite file between runs,
+# keyed by address range: each address is stored on its own and, if the
+# caller or the response names the routed prefix it belongs to
+# (`asn.route` of ipinfo.io), the response is stored for the whole
+# prefix as well. Later addresses of the prefix are answered from the
+# cache by a longest-prefix match, without the per-address fields such
+# as `hostname`.
+#
+# Addresses are stored as 16-byte BLOBs, IPv4 mapped into IPv6
+# (::ffff:0:0/96), so both families share one sorted table and a range
+# is a pair of comparable keys.
+#
+# Usage:
+#
+#   cache = Cache("ipinfo.sqlite", ttl=30 * 86400)
+#   if (data := cache.get("8.8.8.8")) is None:
+#       data = lookup("8.8.8.8")
+#       cache.put("8.8.8.8", data)
+#   cache.report()
+#
+# ======================================================================
+
+import ipaddress
+import json
+import sqlite3
+import sys
+import time
+
+
+# Number of writes that are committed at once
+COMMIT_BATCH = 1024
+
+# Fields of a response that belong to the single address, not to the
+# prefix
+PER_ADDRESS = ("ip", "hostname")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS networks (
+    start BLOB NOT NULL,
+    end BLOB NOT NULL,
+    prefixlen INTEGER NOT NULL,
+    fetched REAL NOT NULL,
+    ttl REAL NOT NULL,
+    data TEXT NOT NULL,
+    PRIMARY KEY (start, prefixlen)
+) WITHOUT ROWID
+"""
+
+MAPPED = 0xFFFF << 32
+
+
+def key(ip) -> tuple:
+    """Returns the address as integer in the IPv6 space and the offset
+    of its prefix lengths (96 for IPv4, 0 for IPv6).
+    """
+    if ip.version == 4:
+        return MAPPED | int(ip), 96
+
+    return int(ip), 0
+
+
+def blob(n: int) -> bytes:
+    return n.to_bytes(16, "big")
+
+
+def route(data: dict):
+    """Returns the routed prefix of a response, or None."""
+    asn = data.get("asn")
+    if isinstance(asn, dict) and asn.get("route"):
+        try:
+            return ipaddress.ip_network(asn["route"], strict=False)
+        except ValueError:
+            pass
+
+    return None
+
+
+class Cache:
+    """Persistent cache of IP lookups with longest-prefix matching.
+
+    Args:
+        path (str): Path of the SQLite file.
+        ttl (float): Seconds a new entry is valid.
+        refresh_older_than (float): Entries fetched more seconds ago
+            count as misses, whatever their TTL.
+        per_address (tuple): Fields that are dropped from the answers of
+            a prefix.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        ttl: float = 30 * 86400,
+        refresh_older_than: float = None,
+        per_address: tuple = PER_ADDRESS,
+    ):
+        self.ttl = ttl
+        self.refresh_older_than = refresh_older_than
+        self.per_address = per_address
+
+        self.hits = 0
+        self.prefix_hits = 0
+        self.expired = 0
+        self.misses = 0
+
+        # Writes since the last commit
+        self._pending = 0
+
+        self._db = sqlite3.connect(path)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(SCHEMA)
+
+        # Prefix lengths in the table, longest first, so a lookup is one
+        # index probe per length
+        self._lengths = set(r[0] for r in self._db.execute("SELECT DISTINCT prefixlen FROM networks"))
+        self._order = sorted(self._lengths, reverse=True)
+
+    def _fresh(self, fetched: float, ttl: float, now: float) -> bool:
+        if fetched + ttl <= now:
+            return False
+
+        return self.refresh_older_than is None or fetched > now - self.refresh_older_than
+
+    def get(self, ip: str, count: bool = True):
+        """Returns the cached response of an address, or None if it is
+        not cached, expired or to be refreshed. With `count` False, the
+        lookup is left out of the statistics, e.g. a second look at an
+        address that was counted already.
+        """
+        addr = ipaddress.ip_address(ip)
+        n, offset = key(addr)
+        now = time.time()
+
+        # Uncommitted writes are visible to the connection already
+        for length in self._order:
+            if length < offset:
+                break
+
+            start = n & ~((1 << (128 - length)) - 1)
+            row = self._db.execute(
+                "SELECT fetched, ttl, data FROM networks WHERE start = ? AND prefixlen = ?",
+                (blob(start), length),
+            ).fetchone()
+
+            if row is None:
+                continue
+
+            if not self._fresh(row[0], row[1], now):
+                # A shorter prefix may still be fresh
+                self.expired += count
+                continue
+
+            data = json.loads(row[2])
+            self.hits += count
+
+            if length < 128:
+                self.prefix_hits += count
+                data = {k: v for k, v in data.items() if k not in self.per_address}
+                data = {"ip": str(addr), **data}
+
+            return data
+
+        self.misses += count
+        return None
+
+    def _store(self, network, data: str, now: float):
+        n, offset = key(network.network_address)
+        length = network.prefixlen + offset
+        last = n | ((1 << (128 - length)) - 1)
+
+        self._db.execute(
+            "INSERT OR REPLACE INTO networks VALUES (?, ?, ?, ?, ?, ?)",
+            (blob(n), blob(last), length, now, self.ttl, data),
+        )
+        self._pending += 1
+
+        if length not in self._lengths:
+            self._lengths.add(length)
+            self._order = sorted(self._lengths, reverse=True)
+
+    def put(self, ip: str, data: dict, network=None):
+        """Stores the response of an address, and of its routed prefix
+        if given or named by the response. Error responses are not
+        stored.
+        """
+        if not data or "error" in data:
+            return
+
+        addr = ipaddress.ip_address(ip)
+        now = time.time()
+        encoded = json.dumps(data)
+
+        self._store(ipaddress.ip_network(addr), encoded, now)
+
+        if network is None:
+            network = route(data)
+        elif isinstance(network, str):
+            network = ipaddress.ip_network(network, strict=False)
+
+        if network is not None and network.version == addr.version and addr in network:
+            self._store(network, encoded, now)
+
+        self.flush(force=False)
+
+    def flush(self, force: bool = True):
+        if not self._pending or (not force and self._pending < COMMIT_BATCH):
+            return
+
+        self._db.commit()
+        self._pending = 0
+
+    def purge(self):
+        """Drops expired entries from the disk."""
+        self.flush()
+        self._db.execute("DELETE FROM networks WHERE fetched + ttl <= ?", (time.time(),))
+        self._db.commit()
+
+    def close(self):
+        if self._db is not None:
+            self.flush()
+            self._db.close()
+            self._db = None
+
+    def report(self, batch: int = 1):
+        """Writes the hit/miss statistics to STDERR, with the API calls
+        saved for `batch` addresses per call.
+        """
+        total = self.hits + self.misses
+        ratio = 100.0 * self.hits / total if total else 0.0
+
+        sys.stderr.write(
+            f"[OK] Cache: {self.hits} hits ({self.prefix_hits} by prefix), {self.misses} misses "
+            f"({self.expired} expired entries skipped), hit ratio {ratio:0.1f}%, "
+            f"~{-(-self.hits // batch)} API calls saved\n"
+        )
+        sys.stderr.flush()
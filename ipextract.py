@@ -0,0 +1,296 @@
+#!/usr/bin/env python3
+
+# ======================================================================
+#
+#   ipextract.py
+#
+# Extracts the IPv4 and IPv6 addresses of any text, e.g. log files, and
+# writes them line by line to STDOUT in the order they occur. Used by
+# filter_ipv4.py and filter_ipv6.py and as library.
+#
+# The input is scanned as bytes by a single precompiled pattern, which
+# finds the candidates. IPv4 candidates are validated by inet_pton
+# (octets 0-255, no leading zeros); IPv6 candidates are validated and
+# canonicalized by inet_pton/inet_ntop (lowercase, `::` compression), so
+# hex words, MAC addresses and times are skipped. Regular files, including a redirected STDIN, are memory
+# mapped and may be split on several processes with `--jobs`; pipes are
+# read in chunks, and the addresses of a chunk are written right away.
+#
+# Usage:
+#
+#   extractor = Extractor(v4=True, v6=False)
+#   ips = extractor.findall(b"... 192.0.2.1 ...")
+#
+# ======================================================================
+
+import argparse
+import mmap
+import os
+import re
+import socket
+import stat
+import sys
+
+
+# Both patterns start with a character class, which the regex engine
+# scans for quickly, and check the byte in front of it by a lookbehind
+# afterwards. The candidates are validated by inet_pton.
+
+# Dotted quad that is not part of a longer number or dotted sequence
+IPV4 = rb"[0-9](?<![0-9.][0-9])[0-9]{0,2}\.[0-9]{1,3}\.[0-9]{1,3}\.[0-9]{1,3}(?![0-9]|\.[0-9])"
+# Run of hex digits, colons and dots with at least two colons, that is
+# not part of a longer word
+IPV6 = (
+    rb"[0-9A-Fa-f:](?<![0-9A-Za-z:.][0-9A-Fa-f:])(?:(?<=:)|[0-9A-Fa-f]{0,3}:)"
+    rb"[0-9A-Fa-f]{0,4}:[0-9A-Fa-f:.]*(?![0-9A-Za-z:.])"
+)
+
+# Bytes read from a pipe at once
+CHUNK = 1 << 20
+# Bytes of a regular file scanned per task with --jobs
+SPLIT = 64 << 20
+
+# Last byte that cannot be part of an address, where a chunk is cut
+_CUT = re.compile(rb"[^0-9A-Fa-f:.][0-9A-Fa-f:.]*\Z")
+
+
+def err(msg, do_flush=True):
+    sys.stderr.write(msg)
+    sys.stderr.write('\n')
+
+    if do_flush:
+        sys.stderr.flush()
+
+
+class Extractor:
+    """Finds the valid IPv4 and/or IPv6 addresses of a bytes-like
+    object, e.g. an mmap, in canonical form.
+
+    Args:
+        v4 (bool): Extract IPv4 addresses.
+        v6 (bool): Extract IPv6 addresses, including IPv4-mapped ones.
+    """
+
+    def __init__(self, v4: bool = True, v6: bool = True):
+        if not (v4 or v6):
+            raise ValueError("Neither IPv4 nor IPv6 addresses are extracted")
+
+        self.v4 = v4
+        self.v6 = v6
+
+        if v4 and v6:
+            # A single pass keeps the addresses in order
+            self.pattern = re.compile(b"(" + IPV4 + b")|(" + IPV6 + b")")
+        elif v6:
+            self.pattern = re.compile(IPV6)
+        else:
+            self.pattern = re.compile(IPV4)
+
+        self._ipv4 = re.compile(IPV4)
+
+    @staticmethod
+    def _valid4(candidate: bytes) -> bool:
+        # Octets above 255 and leading zeros are rejected
+        try:
+            socket.inet_pton(socket.AF_INET, candidate.decode())
+        except OSError:
+            return False
+
+        return True
+
+    def _canonical6(self, candidate: bytes, out: list):
+        try:
+            packed = socket.inet_pton(socket.AF_INET6, candidate.rstrip(b".").decode())
+        except OSError:
+            # E.g. a time or a MAC address, which may still end with an
+            # IPv4 address
+            if self.v4:
+                out.extend(ip for ip in self._ipv4.findall(candidate) if self._valid4(ip))
+            return
+
+        out.append(socket.inet_ntop(socket.AF_INET6, packed).encode())
+
+    def findall(self, data, pos: int = 0, endpos: int = sys.maxsize) -> list:
+        """Returns the addresses of data[pos:endpos] as bytes."""
+        matches = self.pattern.findall(data, pos, endpos)
+        valid4 = self._valid4
+
+        if not self.v6:
+            # Valid IPv4 addresses are canonical as matched
+            return [ip for ip in matches if valid4(ip)]
+
+        out = []
+
+        if self.v4:
+            for v4, v6 in matches:
+                if v6:
+                    self._canonical6(v6, out)
+                elif valid4(v4):
+                    out.append(v4)
+        else:
+            for v6 in matches:
+                self._canonical6(v6, out)
+
+        return out
+
+
+def _write(output, ips: list):
+    if ips:
+        output.write(b"\n".join(ips))
+        output.write(b"\n")
+
+
+def split(mm, size: int = SPLIT) -> list:
+    """Returns (start, end) ranges of about `size` bytes, cut after a
+    newline, or at the end.
+    """
+    ranges = []
+    start = 0
+
+    while start < len(mm):
+        end = mm.find(b"\n", min(start + size, len(mm)))
+        end = len(mm) if end < 0 else end + 1
+        ranges.append((start, end))
+        start = end
+
+    return ranges
+
+
+def _scan_range(task) -> bytes:
+    """Scans a range of a file in a worker process."""
+    path, v4, v6, start, end = task
+
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        ips = Extractor(v4, v6).findall(mm, start, end)
+
+    return b"".join(ip + b"\n" for ip in ips)
+
+
+def scan_file(fd: int, path: str, extractor: Extractor, output, jobs: int = 1):
+    """Scans a regular file, memory mapped. With several jobs, the
+    workers map the file by its path and the parent writes their results
+    in order.
+    """
+    if os.fstat(fd).st_size == 0:
+        return
+
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+        ranges = split(mm)
+
+        if jobs <= 1 or len(ranges) <= 1:
+            for start, end in ranges:
+                _write(output, extractor.findall(mm, start, end))
+            return
+
+    import multiprocessing
+
+    tasks = [(path, extractor.v4, extractor.v6, start, end) for start, end in ranges]
+
+    with multiprocessing.Pool(jobs) as pool:
+        for block in pool.imap(_scan_range, tasks):
+            output.write(block)
+
+
+def scan_stream(fd: int, extractor: Extractor, output):
+    """Scans a pipe chunk by chunk and writes the addresses of each
+    chunk right away.
+    """
+    rest = b""
+
+    while chunk := os.read(fd, CHUNK):
+        data = rest + chunk
+
+        # Keep the bytes from the last separator on, which may be
+        # followed by the beginning of an address; the separator stays
+        # in front of them for the lookbehind of the pattern
+        cut = data.rfind(b"\n")
+        if cut < 0 and (m := _CUT.search(data)) is not None:
+            cut = m.start()
+
+        if cut >= 0:
+            _write(output, extractor.findall(data, 0, cut + 1))
+            rest = data[cut:]
+        elif len(data) > CHUNK:
+            # A run of address bytes without any separator
+            _write(output, extractor.findall(data))
+            rest = b""
+        else:
+            rest = data
+
+        output.flush()
+
+    _write(output, extractor.findall(rest))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Extract the IPv4 and IPv6 addresses of text files or STDIN",
+    )
+    parser.add_argument(
+        "files",
+        nargs="*",
+        help="Input files ; By default STDIN",
+    )
+    family = parser.add_mutually_exclusive_group()
+    family.add_argument(
+        "-4",
+        dest="v6",
+        action="store_false",
+        help="Extract IPv4 addresses only",
+    )
+    family.add_argument(
+        "-6",
+        dest="v4",
+        action="store_false",
+        help="Extract IPv6 addresses only",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of processes that scan a regular file, 0 for one per CPU ; By default 1",
+    )
+
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        args.jobs = os.cpu_count() or 1
+
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    extractor = Extractor(v4=args.v4, v6=args.v6)
+    output = sys.stdout.buffer
+
+    def scan(fd, path):
+        if stat.S_ISREG(os.fstat(fd).st_mode):
+            scan_file(fd, path, extractor, output, args.jobs)
+        else:
+            scan_stream(fd, extractor, output)
+
+    try:
+        if not args.files:
+            # The path of a redirected file, for the workers of --jobs
+            scan(sys.stdin.fileno(), os.path.realpath("/dev/stdin"))
+
+        for path in args.files:
+            try:
+                with open(path, "rb") as f:
+                    scan(f.fileno(), path)
+            except OSError as e:
+                err(f"[EE] {path}: {e.strerror}")
+
+        output.flush()
+    except KeyboardInterrupt:
+        sys.exit(255)
+    except BrokenPipeError:
+        # STDOUT is closed early, e.g. by `head`
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -10,30 +10,62 @@
 # The results are written to STDOUT, which makes the tool suitable to be
 # used within shellscripts and pipes.
 #
+# The lookups are sent asynchronously over a single pooled session, so
+# connections are kept alive and reused. A fixed number of requests is
+# in flight at any time; with `--batch N`, up to N IP addresses are
+# resolved per request by the batch endpoint. Each result is written as
+# soon as it is complete, so the output is not in input order.
+#
+# Responses with status 429 (Too Many Requests) are retried with an
+# exponential backoff, or after the delay of the `Retry-After` header.
+#
+# With `--cache PATH`, the responses are kept in a SQLite file between
+# runs (see ipcache.py). An address inside a routed prefix of an earlier
+# response is answered from the cache without an API call.
+#
 # Requires a configuration in $HOME/.config/mrit.ini as follows
 #
+#   [ipinfo]
+#   token = <API token>
+#
 # ======================================================================
 
+import argparse
+import asyncio
 import configparser
 import ipaddress
 import json
 import os
 import sys
-import requests
 
 from pathlib import Path
 
-BASE_URI = "ipinfo.io"
+import aiohttp
+
+from ipcache import Cache
 
+BASE_URL = "https://ipinfo.io"
 
-def fetch(ip, token):
-    req = f"https://{BASE_URI}/{ip}?token={token}"
-    res = requests.get(req)
+# Number of requests in flight
+CONCURRENCY = 16
+# Maximum number of IP addresses per request of the batch endpoint
+MAX_BATCH = 1000
+# Seconds until a request times out
+TIMEOUT = 10
+# Retries of a request answered with 429, and the first backoff in
+# seconds, which doubles on each retry
+RETRIES = 5
+BACKOFF = 1.0
+# Seconds a partial batch waits for more input
+LINGER = 0.5
+# Number of bytes read from STDIN at once
+READ_HINT = 1 << 16
+# Days a cached response is valid
+CACHE_TTL = 30
 
-    if not res.ok:
-        return None
 
-    return res.json()
+class RateLimited(Exception):
+    pass
 
 
 def err(msg, do_flush=True):
@@ -52,8 +84,230 @@ def write(data, do_flush=True):
         sys.stdout.flush()
 
 
-def main():
-    # Load config
+class Stats:
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.failed = 0
+        self.results = 0
+
+
+async def request(session: aiohttp.ClientSession, stats: Stats, method: str, url: str, **kwargs):
+    """Sends a request and returns the decoded JSON, or None if the
+    request failed. Responses with status 429 are retried.
+    """
+    delay = BACKOFF
+
+    for attempt in range(RETRIES + 1):
+        stats.requests += 1
+
+        try:
+            async with session.request(method, url, **kwargs) as res:
+                if res.status == 429:
+                    raise RateLimited(res.headers.get("Retry-After"))
+
+                if not res.ok:
+                    err(f"[EE] {method} {url.split('?')[0]}: status {res.status}")
+                    break
+
+                return await res.json(content_type=None)
+        except RateLimited as e:
+            if attempt == RETRIES:
+                err(f"[EE] {method} {url.split('?')[0]}: rate limited, giving up after {RETRIES} retries")
+                break
+
+            try:
+                wait = float(e.args[0])
+            except (TypeError, ValueError):
+                wait = delay
+
+            stats.retries += 1
+            await asyncio.sleep(wait)
+            delay *= 2
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            err(f"[EE] {method} {url.split('?')[0]}: {str(e) or type(e).__name__}")
+            break
+
+    stats.failed += 1
+    return None
+
+
+async def fetch(session, stats, base_url, token, ips):
+    """Looks up a list of IP addresses, one per request or all of them
+    by the batch endpoint. Returns (IP address, result) pairs in any
+    order.
+    """
+    if len(ips) == 1:
+        data = await request(session, stats, "GET", f"{base_url}/{ips[0]}", params={"token": token})
+        return [(ips[0], data)] if data else []
+
+    data = await request(session, stats, "POST", f"{base_url}/batch", params={"token": token}, json=ips)
+    if not data:
+        return []
+
+    return [(k, v) for k, v in data.items() if isinstance(v, dict)]
+
+
+async def readlines(stream):
+    """Reads lines from a stream without blocking the event loop. The
+    lines are passed on as they arrive, not once a buffer is full.
+    """
+    loop = asyncio.get_running_loop()
+    fd = stream.fileno()
+    rest = b""
+
+    while chunk := await loop.run_in_executor(None, os.read, fd, READ_HINT):
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+
+        for line in lines:
+            yield line.decode(errors="replace")
+
+    if rest:
+        yield rest.decode(errors="replace")
+
+
+async def producer(
+    queue: asyncio.Queue,
+    stats: Stats,
+    batch: int,
+    workers: int,
+    cache: Cache = None,
+    cache_only: bool = False,
+):
+    """Puts the valid IP addresses of STDIN into the queue, in lists of
+    up to `batch` addresses. A partial list is put once the input pauses
+    for a moment. A None per worker marks the end. Cached addresses are
+    written right away.
+    """
+    lines = readlines(sys.stdin)
+    ips = []
+    pending = None
+
+    while True:
+        if pending is None:
+            pending = asyncio.ensure_future(anext(lines, None))
+
+        try:
+            line = await asyncio.wait_for(asyncio.shield(pending), LINGER if ips else None)
+        except asyncio.TimeoutError:
+            await queue.put(ips)
+            ips = []
+            continue
+
+        pending = None
+        if line is None:
+            break
+
+        line = line.strip()
+
+        try:
+            ipaddress.ip_address(line)
+        except ValueError:
+            # Ignore IPs that cannot be parsed
+            continue
+
+        if cache is not None:
+            if (data := cache.get(line)) is not None:
+                write(json.dumps(data))
+                stats.results += 1
+                continue
+
+            if cache_only:
+                continue
+
+        ips.append(line)
+        if len(ips) >= batch:
+            await queue.put(ips)
+            ips = []
+
+    if ips:
+        await queue.put(ips)
+
+    for _ in range(workers):
+        await queue.put(None)
+
+
+async def worker(queue: asyncio.Queue, session, stats: Stats, base_url: str, token: str, cache: Cache = None):
+    while (ips := await queue.get()) is not None:
+        for ip, data in await fetch(session, stats, base_url, token, ips):
+            write(json.dumps(data), do_flush=False)
+            stats.results += 1
+
+            if cache is not None:
+                cache.put(ip, data)
+
+        sys.stdout.flush()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Look up IP addresses of STDIN at ipinfo.io and write the results as JSON lines",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        default=CONCURRENCY,
+        help=f"Number of requests in flight ; By default {CONCURRENCY}",
+    )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        type=int,
+        default=1,
+        help=f"Number of IP addresses per request, up to {MAX_BATCH} ; "
+        "More than 1 uses the batch endpoint ; By default 1",
+    )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        default=BASE_URL,
+        help=f"URL of the API, e.g. a local stand-in for tests ; By default {BASE_URL}",
+    )
+    parser.add_argument(
+        "--token",
+        type=str,
+        help="API token, instead of the one in the configuration file",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        metavar="PATH",
+        help="SQLite file to cache the responses between runs",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=CACHE_TTL,
+        metavar="DAYS",
+        help=f"Days a cached response is valid ; By default {CACHE_TTL}",
+    )
+    parser.add_argument(
+        "--refresh-older-than",
+        type=float,
+        metavar="DAYS",
+        help="Look up cached responses again if they are older than DAYS",
+    )
+    parser.add_argument(
+        "--cache-only",
+        action="store_true",
+        help="Answer from the cache only, do not send any request",
+    )
+
+    args = parser.parse_args()
+
+    if args.cache_only and not args.cache:
+        parser.error("--cache-only requires --cache")
+
+    args.concurrency = max(1, args.concurrency)
+    args.batch = min(max(1, args.batch), MAX_BATCH)
+    args.base_url = args.base_url.rstrip("/")
+
+    return args
+
+
+def load_token():
     cfg_file = os.path.join(
         Path.home(),
         '.config/mrit.ini',
@@ -82,29 +336,62 @@ def main():
         err(f"Token not configured in {cfg_file}")
         sys.exit(1)
 
-    try:
-        # Reads from STDIN and writes to STDOUT
-        for _in in sys.stdin:
-            # Prepare the input data ...
-            _in = _in.strip()
+    return ipinfo_token
 
-            try:
-                ipaddress.ip_address(_in)
-            except Exception:
-                # Ignore IPs that cannot be parsed
-                continue
 
-            # ... fetch the IP info ...
-            ipinfo = fetch(_in, ipinfo_token)
+async def main():
+    args = parse_args()
+    token = args.token or (None if args.cache_only else load_token())
+
+    stats = Stats()
+    rc = 0
+
+    cache = None
+    if args.cache:
+        cache = Cache(
+            args.cache,
+            ttl=args.cache_ttl * 86400,
+            refresh_older_than=args.refresh_older_than * 86400 if args.refresh_older_than is not None else None,
+        )
+
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+    timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        queue = asyncio.Queue(maxsize=2 * args.concurrency)
+        tasks = [
+            asyncio.create_task(producer(queue, stats, args.batch, args.concurrency, cache, args.cache_only))
+        ] + [
+            asyncio.create_task(worker(queue, session, stats, args.base_url, token, cache))
+            for _ in range(args.concurrency)
+        ]
+
+        try:
+            await asyncio.gather(*tasks)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            # asyncio.run() cancels the main task on SIGINT
+            pass
+        except BrokenPipeError:
+            # STDOUT is closed early, e.g. by `head`
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+            rc = 1
+        finally:
+            for t in tasks:
+                t.cancel()
+
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    err(
+        f"[OK] {stats.results} results, {stats.requests} requests, "
+        f"{stats.retries} retries, {stats.failed} failed"
+    )
+
+    if cache is not None:
+        cache.report(args.batch)
+        cache.close()
 
-            # ... and write to STDOUT
-            if ipinfo:
-                ipinfo = json.dumps(ipinfo)
-                write(ipinfo)
-    except KeyboardInterrupt:
-        pass
+    sys.exit(rc)
 
-    sys.exit(0)
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())
@@ -0,0 +1,136 @@
+# ======================================================================
+#
+#   journal.py
+#
+# Checkpoint journal for long runs of the bulk tools, used as library.
+# The input lines are numbered; the journal keeps track of the lines
+# that are done and appends a checkpoint to a sidecar file every few
+# hundred lines. A restarted run skips the lines that are done.
+#
+# Each checkpoint is a single line:
+#
+#   <watermark> <output size> [<line> ...]
+#
+# All lines below the watermark are done, the lines that follow are
+# done out of order. If STDOUT is a regular file, the output size is
+# recorded as well and rows written after the last checkpoint are cut
+# off on restart, so the output has no duplicate rows. Therefore,
+# append to the output on restart, e.g. `bulkdig.py --journal j >> out`.
+#
+# ======================================================================
+
+import os
+import stat
+import sys
+import time
+
+
+class Journal:
+    """Append-only journal of the completed input lines.
+
+    Args:
+        path (str): Path of the sidecar file.
+        output (file): The output of the tool, truncated to the last
+            checkpoint if it is a regular file.
+        batch (int): Number of completed lines per checkpoint.
+        interval (float): Seconds after which a checkpoint is written,
+            even if the batch is not full yet.
+    """
+
+    def __init__(self, path: str, output=sys.stdout, batch: int = 1024, interval: float = 5.0):
+        self.path = path
+        self.output = output
+        self.batch = batch
+        self.interval = interval
+
+        self.watermark = 0
+        self._done = set()
+        self._pending = 0
+        self._last = time.monotonic()
+
+        self.resumed = self._load()
+        self._f = open(path, "a")
+
+    def _output_size(self):
+        try:
+            st = os.fstat(self.output.fileno())
+        except (AttributeError, OSError, ValueError):
+            return None
+
+        return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+    def _load(self):
+        """Restores the last complete checkpoint. Returns True if a run
+        is resumed.
+        """
+        if not os.path.isfile(self.path):
+            return False
+
+        last = None
+        with open(self.path, "r") as f:
+            for line in f:
+                if line.endswith("\n") and line.strip():
+                    last = line
+
+        if last is None:
+            return False
+
+        tokens = last.split()
+        self.watermark = int(tokens[0])
+        self._done = set(map(int, tokens[2:]))
+        offset = int(tokens[1])
+
+        size = self._output_size()
+        if offset >= 0 and size is not None:
+            if size > offset:
+                # Cut off the rows written after the checkpoint
+                self.output.flush()
+                os.ftruncate(self.output.fileno(), offset)
+            elif size < offset:
+                sys.stderr.write(
+                    f"[WW] Output is shorter than at the last checkpoint ({size} < {offset} bytes). "
+                    "Append the output on restart to keep the previous rows.\n"
+                )
+
+        return True
+
+    def done(self, idx: int) -> bool:
+        return idx < self.watermark or idx in self._done
+
+    def complete(self, idx: int):
+        """Marks an input line as done. The output of the line must be
+        written before. Lines without output, e.g. empty lines and
+        comments, are marked as done as well, so the watermark passes
+        them.
+        """
+        if self.done(idx):
+            return
+
+        self._done.add(idx)
+
+        while self.watermark in self._done:
+            self._done.discard(self.watermark)
+            self.watermark += 1
+
+        self._pending += 1
+
+        if self._pending >= self.batch or time.monotonic() - self._last >= self.interval:
+            self.flush()
+
+    def flush(self):
+        # Output first, so the checkpoint never runs ahead of it
+        self.output.flush()
+
+        size = self._output_size()
+        extra = " ".join(map(str, sorted(self._done)))
+
+        self._f.write(f"{self.watermark} {size if size is not None else -1} {extra}".rstrip(" ") + "\n")
+        self._f.flush()
+
+        self._pending = 0
+        self._last = time.monotonic()
+
+    def close(self):
+        if not self._f.closed:
+            self.flush()
+            self._f.close()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+
+# ======================================================================
+#
+#   bench-traceparser.py
+#
+# Micro-benchmark of the traceroute parser of bulktrace.py on synthetic
+# transcripts of 20 hops, against the former parser that consumed the
+# tokens with `tokens.pop(0)`. Both must return the same rows.
+#
+# ======================================================================
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from bulktrace import _parse_traceroute
+
+
+def _old_parse_probes(tokens):
+    probes = []
+    name = ""
+    ip = ""
+
+    while len(tokens):
+        t1 = tokens.pop(0)
+
+        if t1 == '*':
+            while len(tokens) > 0 and tokens[0] == '*':
+                tokens.pop(0)
+            probes.append(("*", "*", -1.0, ""))
+            continue
+
+        t2 = tokens.pop(0).strip(" (),.")
+
+        if t2 == 'ms':
+            t3 = t1
+            t2 = ip
+            t1 = name
+        else:
+            t3 = tokens.pop(0)
+            tokens.pop(0)
+
+        name, ip, rtt, annotation = t1, t2, float(t3), (tokens.pop(0) if len(tokens) and tokens[0].startswith("!") else "")
+        probes.append((name, ip, rtt, annotation))
+
+    return probes
+
+
+def old_parse_traceroute(input):
+    dest_host = ""
+    dest_ip = ""
+    hops = []
+
+    for line in input.split('\n'):
+        line = line.strip()
+        if not line:
+            continue
+
+        if line.lower().startswith("traceroute to "):
+            tokens = line.replace("traceroute to ", "").split()
+            dest_host = tokens[0].strip(" (),.")
+            dest_ip = tokens[1].strip(" (),.")
+        else:
+            tokens = line.split()
+            hop_idx = int(tokens.pop(0))
+            for probe_idx, probe in enumerate(_old_parse_probes(tokens)):
+                hops.append((dest_host, dest_ip, hop_idx, probe_idx, *probe))
+
+    return hops
+
+
+def transcript(rng: random.Random, probes: int, hops: int = 20) -> str:
+    lines = [f"traceroute to example.org (192.0.2.1), {hops} hops max, 60 byte packets"]
+
+    for hop in range(1, hops + 1):
+        parts = [f"{hop:2d}"]
+        last = None
+
+        for _ in range(probes):
+            if rng.random() < 0.05:
+                parts.append("*")
+                continue
+
+            router = f"10.{hop}.0.{rng.randrange(1, 4)}"
+            if router != last:
+                parts.append(f"r{hop}.example.net ({router})")
+                last = router
+
+            parts.append(f"{rng.uniform(1, 100):0.3f} ms")
+
+        lines.append("  ".join(parts))
+
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the traceroute parser of bulktrace.py")
+    parser.add_argument("-n", "--transcripts", type=int, default=50, help="Transcripts per probe count")
+    parser.add_argument("-q", "--probes", type=int, nargs="+", default=[3, 16, 64, 256], help="Probes per hop")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="Best of N runs")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+
+    print("probes  old ms  new ms  speedup")
+    for q in args.probes:
+        inputs = [transcript(rng, q) for _ in range(args.transcripts)]
+
+        for t in inputs:
+            assert old_parse_traceroute(t) == _parse_traceroute(t)
+
+        old = min(timeit.repeat(lambda: [old_parse_traceroute(t) for t in inputs], number=1, repeat=args.repeat))
+        new = min(timeit.repeat(lambda: [_parse_traceroute(t) for t in inputs], number=1, repeat=args.repeat))
+
+        n = len(inputs)
+        print(f"{q:6d}  {1000 * old / n:6.3f}  {1000 * new / n:6.3f}  {old / new:6.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -8,6 +8,11 @@ link_file() {
     return 0
   fi
 
+  if [[ ! -x $1 ]] ; then
+    # Library modules, e.g. dnsengine.py, are not executable
+    return 0
+  fi
+
   filename=$(basename $1)
   filename=${filename%.*}
 
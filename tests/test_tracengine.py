@@ -0,0 +1,58 @@
+import collections
+import os
+import socket
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from tracengine import DoubletreeTracer, SimulatedBackend, build_probe, checksum, parse_reply
+
+
+def probes_per_ttl(tracer: DoubletreeTracer, targets: list) -> collections.Counter:
+    counts = collections.Counter()
+    probe = tracer._probe
+
+    def counting(target, ttl):
+        counts[ttl] += 1
+        probe(target, ttl)
+
+    tracer._probe = counting
+    tracer.trace(targets)
+
+    return counts
+
+
+def test_backward_probing_stops_at_local_stop_set():
+    backend = SimulatedBackend(seed=1, silent=0.0)
+    tracer = DoubletreeTracer(backend, start_ttl=4, wait=0.5, seed=1)
+    targets = [f"198.51.100.{i}" for i in range(1, 51)]
+
+    counts = probes_per_ttl(tracer, targets)
+
+    # All targets share the near side of the path: the first reply at
+    # TTL 3 enters the local stop set and every other target stops there
+    assert counts[3] == len(targets)
+    assert counts[2] == 1
+    assert counts[1] == 1
+
+
+def quoted_header(reply: bytes) -> bytes:
+    ihl = (reply[0] & 0x0F) * 4
+    return reply[ihl + 8:ihl + 28]
+
+
+def test_reply_quotes_ttl_at_router():
+    backend = SimulatedBackend(seed=1, silent=0.0)
+    src = socket.inet_aton("192.0.2.1")
+    target = "198.51.100.7"
+    distance = len(backend.path(int.from_bytes(socket.inet_aton(target), "big")))
+
+    for ttl, quoted in ((1, 1), (3, 1), (distance + 2, 3)):
+        backend.send(build_probe(src, socket.inet_aton(target), ttl, 1))
+        reply, = backend.wait(10.0)
+        header = quoted_header(reply)
+
+        # Time exceeded quotes TTL 1, the target the TTL that is left
+        assert header[8] == quoted
+        assert checksum(header) == 0
+        assert parse_reply(reply)[2] == ttl
@@ -0,0 +1,183 @@
+# ======================================================================
+#
+#   topology.py
+#
+# IP-level topology of a traceroute run, used as library by
+# bulktrace.py. The hops of each path are aggregated into a graph while
+# the run goes: IP addresses are interned to integer node IDs and each
+# edge between two responding hops at consecutive TTLs is kept once,
+# with its number of observations and the minimum and median RTT of the
+# far end. The memory grows with the unique edges, not with the probes.
+#
+# The median is estimated from a reservoir sample of at most 16 RTTs per
+# edge; it is exact for edges with up to 16 RTTs.
+#
+# Usage:
+#
+#   topo = Topology()
+#   prev = None
+#   for rows in hops:
+#       prev = topo.add_hop(prev, rows)
+#   topo.write("topology.parquet")
+#
+# ======================================================================
+
+import random
+import statistics
+
+from array import array
+
+
+# Number of RTT samples kept per edge for the median
+SAMPLES = 16
+
+
+class Topology:
+    """Interned, integer-indexed edge table of the paths."""
+
+    def __init__(self, seed: int = None):
+        self._random = random.Random(seed)
+
+        # Node ID -> IP address and back
+        self.nodes = []
+        self._ids = {}
+
+        # (source ID, destination ID) -> edge ID, and the columns of the
+        # edge table
+        self._edges = {}
+        self.src = array("I")
+        self.dst = array("I")
+        self.count = array("I")
+        self.rtt_min = array("d")
+        # Observations with an RTT, from which the samples are drawn
+        self._timed = array("I")
+        self._samples = []
+
+    def __len__(self):
+        return len(self.src)
+
+    def node(self, ip: str) -> int:
+        """Returns the ID of an IP address, which is added if unknown."""
+        if (node := self._ids.get(ip)) is None:
+            node = self._ids[ip] = len(self.nodes)
+            self.nodes.append(ip)
+
+        return node
+
+    def add_edge(self, a: int, b: int, rtt: float):
+        key = (a, b)
+
+        if (edge := self._edges.get(key)) is None:
+            edge = self._edges[key] = len(self.src)
+            self.src.append(a)
+            self.dst.append(b)
+            self.count.append(0)
+            self.rtt_min.append(float("inf"))
+            self._timed.append(0)
+            self._samples.append(array("f"))
+
+        self.count[edge] += 1
+
+        if rtt < 0:
+            # Inferred hops or probes without reply carry no RTT
+            return
+
+        self.rtt_min[edge] = min(self.rtt_min[edge], rtt)
+        self._timed[edge] += 1
+
+        samples = self._samples[edge]
+        if len(samples) < SAMPLES:
+            samples.append(rtt)
+        elif (k := self._random.randrange(self._timed[edge])) < SAMPLES:
+            samples[k] = rtt
+
+    def add_hop(self, prev, rows: list):
+        """Adds the probes of a single hop, given as rows of the
+        bulktrace CSV schema. `prev` is the return value of the call for
+        the previous TTL of the same path, or None at the start of a
+        path. Every responding host of the previous TTL is connected to
+        every responding host of this TTL.
+        """
+        hosts = {}
+        for row in rows:
+            ip, rtt = row[5], row[6]
+            if ip != "*":
+                hosts.setdefault(self.node(ip), []).append(rtt)
+
+        if prev:
+            for b, rtts in hosts.items():
+                for a in prev:
+                    if a != b:
+                        for rtt in rtts:
+                            self.add_edge(a, b, rtt)
+
+        return list(hosts)
+
+    def add_path(self, rows: list):
+        """Adds a complete path, given as rows of all TTLs in order."""
+        prev = None
+        hop = []
+
+        for row in rows:
+            if hop and row[2] != hop[0][2]:
+                prev = self.add_hop(prev, hop)
+                hop = []
+            hop.append(row)
+
+        if hop:
+            self.add_hop(prev, hop)
+
+    def rtt_median(self, edge: int) -> float:
+        samples = self._samples[edge]
+        return statistics.median(samples) if samples else -1.0
+
+    def write_parquet(self, path: str):
+        """Writes the edges to `path` and the nodes next to it, with the
+        suffix `.nodes.parquet`. The IP addresses of the edges are
+        dictionary-encoded with the node table as dictionary.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        ips = pa.array(self.nodes, type=pa.string())
+        src = pa.array(self.src, type=pa.uint32())
+        dst = pa.array(self.dst, type=pa.uint32())
+
+        edges = pa.table({
+            "src_id": src,
+            "dst_id": dst,
+            "src": pa.DictionaryArray.from_arrays(src.cast(pa.int32()), ips),
+            "dst": pa.DictionaryArray.from_arrays(dst.cast(pa.int32()), ips),
+            "count": pa.array(self.count, type=pa.uint32()),
+            "rtt_min": pa.array([r if r != float("inf") else -1.0 for r in self.rtt_min], type=pa.float64()),
+            "rtt_median": pa.array([self.rtt_median(e) for e in range(len(self))], type=pa.float64()),
+        })
+        nodes = pa.table({
+            "id": pa.array(range(len(self.nodes)), type=pa.uint32()),
+            "ip": ips,
+        })
+
+        pq.write_table(edges, path)
+        pq.write_table(nodes, path[:-len(".parquet")] + ".nodes.parquet")
+
+    def write_adjacency(self, path: str):
+        """Writes one line per node with outgoing edges: the IP address
+        of the node, followed by the IP addresses of its successors.
+        """
+        succ = {}
+        for a, b in zip(self.src, self.dst):
+            succ.setdefault(a, []).append(b)
+
+        with open(path, "w") as f:
+            for a in sorted(succ):
+                f.write(" ".join([self.nodes[a]] + [self.nodes[b] for b in succ[a]]))
+                f.write("\n")
+
+    def write(self, path: str):
+        """Writes Parquet files if the path ends with `.parquet`, an
+        adjacency file otherwise.
+        """
+        if path.endswith(".parquet"):
+            self.write_parquet(path)
+        else:
+            self.write_adjacency(path)
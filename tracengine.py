@@ -0,0 +1,659 @@
+# ======================================================================
+#
+#   tracengine.py
+#
+# Stateless traceroute engine in the style of yarrp and Paris
+# traceroute, used as library by bulktrace.py. A single process sends
+# UDP probes for many targets in a randomized order at a fixed packet
+# rate. Everything needed to interpret a reply is encoded in the probe
+# itself and comes back in the quote of the ICMP error:
+#
+#   - the target is the destination of the quoted IP header,
+#   - the TTL is the IP ID of the quoted IP header,
+#   - the send time is the checksum of the quoted UDP header, which is
+#     set by two bytes of payload.
+#
+# The ports of all probes of a target are the same, so load balancers
+# keep them on the same flow (Paris traceroute). No state is kept per
+# probe; the paths are rebuilt from the replies.
+#
+# `DoubletreeTracer` cuts the redundant probes of the TTL sweep: paths
+# towards the same prefix share their last hops and all paths share
+# the first hops, so probing stops where a path joins a known one and
+# the rest is inferred (Donnet et al., Doubletree, 2005).
+#
+# The packet I/O is pluggable. `RawBackend` uses raw sockets and needs
+# root. `SimulatedBackend` answers the probes from a synthetic topology,
+# to benchmark the engine without root or a network.
+#
+# ======================================================================
+
+import heapq
+import ipaddress
+import random
+import select
+import socket
+import struct
+import time
+
+
+SRC_PORT = 33433
+DST_PORT = 33435
+
+# Resolution of the send time in the UDP checksum in seconds. The 16
+# bit checksum wraps after 6.5 seconds.
+TICK = 0.0001
+TICKS = 65535
+
+_IP = struct.Struct("!BBHHHBBH4s4s")
+_UDP = struct.Struct("!HHHH")
+_ICMP = struct.Struct("!BBHI")
+
+# Annotations of ICMP destination unreachable codes, as traceroute
+UNREACH = {
+    0: "!N",
+    1: "!H",
+    2: "!P",
+    3: "",
+    4: "!F",
+    5: "!S",
+    9: "!X",
+    10: "!X",
+    13: "!X",
+}
+
+
+# ----------------------------------------------------------------------
+# Packets
+# ----------------------------------------------------------------------
+
+def checksum(data: bytes) -> int:
+    """Internet checksum (RFC 1071)."""
+    if len(data) % 2:
+        data += b"\x00"
+
+    s = sum(struct.unpack(f"!{len(data) // 2}H", data))
+    while s >> 16:
+        s = (s & 0xFFFF) + (s >> 16)
+
+    return ~s & 0xFFFF
+
+
+def _add(a: int, b: int) -> int:
+    """Ones' complement addition of two 16 bit words."""
+    s = a + b
+    return (s & 0xFFFF) + (s >> 16)
+
+
+def build_probe(src: bytes, dst: bytes, ttl: int, ticks: int) -> bytes:
+    """Builds a UDP probe with the TTL in the IP ID and the send time
+    (1..65535 ticks) as UDP checksum.
+    """
+    ulen = _UDP.size + 2
+    udp = _UDP.pack(SRC_PORT, DST_PORT, ulen, 0)
+    pseudo = src + dst + struct.pack("!BBH", 0, socket.IPPROTO_UDP, ulen)
+
+    # Sum without payload, then choose the payload word such that the
+    # checksum equals the send time
+    partial = ~checksum(pseudo + udp + b"\x00\x00") & 0xFFFF
+    payload = _add(~ticks & 0xFFFF, ~partial & 0xFFFF)
+    udp = _UDP.pack(SRC_PORT, DST_PORT, ulen, ticks) + struct.pack("!H", payload)
+
+    ip = _IP.pack(0x45, 0, _IP.size + ulen, ttl, 0, ttl, socket.IPPROTO_UDP, 0, src, dst)
+    ip = ip[:10] + struct.pack("!H", checksum(ip)) + ip[12:]
+
+    return ip + udp
+
+
+def build_reply(router: bytes, dst: bytes, icmp_type: int, icmp_code: int, probe: bytes, ttl: int = 1) -> bytes:
+    """Builds an ICMP error as a router would send it, quoting the IP
+    header and the first 8 bytes of the probe (RFC 792). The quoted
+    header carries the TTL the probe reached the router with, 1 if it
+    expired there.
+    """
+    header = probe[:8] + bytes([ttl]) + probe[9:10] + b"\x00\x00" + probe[12:_IP.size]
+    header = header[:10] + struct.pack("!H", checksum(header)) + header[12:]
+    quote = header + probe[_IP.size:_IP.size + 8]
+    icmp = _ICMP.pack(icmp_type, icmp_code, 0, 0) + quote
+    icmp = icmp[:2] + struct.pack("!H", checksum(icmp)) + icmp[4:]
+
+    ip = _IP.pack(0x45, 0, _IP.size + len(icmp), 0, 0, 64, socket.IPPROTO_ICMP, 0, router, dst)
+    return ip + icmp
+
+
+def parse_reply(packet: bytes):
+    """Parses an ICMP error in reply to a probe. Returns a tuple (hop,
+    target, ttl, ticks, type, code) or None if the packet is no reply
+    to a probe.
+    """
+    if len(packet) < _IP.size or packet[9] != socket.IPPROTO_ICMP:
+        return None
+
+    ihl = (packet[0] & 0x0F) * 4
+    icmp_type, icmp_code = packet[ihl], packet[ihl + 1]
+
+    if icmp_type not in (3, 11):
+        return None
+
+    quote = ihl + _ICMP.size
+    if len(packet) < quote + _IP.size + _UDP.size:
+        return None
+
+    qihl = (packet[quote] & 0x0F) * 4
+    _, _, _, ttl, _, _, proto, _, _, target = _IP.unpack_from(packet, quote)
+    sport, dport, _, ticks = _UDP.unpack_from(packet, quote + qihl)
+
+    if proto != socket.IPPROTO_UDP or sport != SRC_PORT or dport != DST_PORT:
+        return None
+
+    return packet[12:16], target, ttl, ticks or TICKS, icmp_type, icmp_code
+
+
+def permutation(n: int, seed: int):
+    """Yields 0..n-1 in a pseudo-random order without storing them. A
+    full-period linear congruential generator (Hull-Dobell) over the
+    next power of two is walked, values >= n are skipped.
+    """
+    if n <= 0:
+        return
+
+    m = 1
+    while m < n:
+        m <<= 1
+
+    rng = random.Random(seed)
+    # a = 1 mod 4 and an odd c give the full period m
+    a = (rng.getrandbits(30) * 4 + 1) % m if m > 4 else 1
+    c = (rng.getrandbits(30) * 2 + 1) % m
+    x = rng.randrange(m)
+
+    for _ in range(m):
+        x = (a * x + c) % m
+        if x < n:
+            yield x
+
+
+# ----------------------------------------------------------------------
+# Backends
+# ----------------------------------------------------------------------
+
+class RawBackend:
+    """Sends the probes via a raw IP socket and receives the ICMP errors
+    via a raw ICMP socket. Requires root or CAP_NET_RAW.
+    """
+
+    def __init__(self, source: str = None, probe_target: str = "192.0.2.1"):
+        if not source:
+            # Let the kernel pick the source address of the default route
+            s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            s.connect((probe_target, DST_PORT))
+            source = s.getsockname()[0]
+            s.close()
+
+        self.source = source
+
+        self._send = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_RAW)
+        self._recv = socket.socket(socket.AF_INET, socket.SOCK_RAW, socket.IPPROTO_ICMP)
+        self._recv.setblocking(False)
+        self._recv.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1 << 24)
+
+    def now(self) -> float:
+        return time.monotonic()
+
+    def send(self, packet: bytes):
+        self._send.sendto(packet, (socket.inet_ntoa(packet[16:20]), 0))
+
+    def wait(self, timeout: float):
+        replies = []
+        ready, _, _ = select.select([self._recv], [], [], max(0.0, timeout))
+
+        while ready:
+            try:
+                replies.append(self._recv.recv(65535))
+            except BlockingIOError:
+                break
+
+        return replies
+
+    def close(self):
+        self._send.close()
+        self._recv.close()
+
+
+def _mix(x: int) -> int:
+    """SplitMix64 finalizer, a cheap deterministic hash."""
+    x = (x + 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 30)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF
+    x = ((x ^ (x >> 27)) * 0x94D049BB133111EB) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 31)
+
+
+class SimulatedBackend:
+    """Answers the probes from a synthetic topology on a virtual clock,
+    so waiting costs no time. Every path has a near side shared by all
+    targets, a core part shared per /16, an edge part shared per /24 and
+    the target itself. Some routers never answer.
+
+    Args:
+        seed (int): Seed of the topology.
+        loss (float): Probability that a probe or its reply is lost.
+        silent (float): Share of routers that never answer.
+    """
+
+    NEAR = 3
+
+    def __init__(self, seed: int = 0, loss: float = 0.0, silent: float = 0.05):
+        self.source = "192.0.2.254"
+        self.seed = seed
+        self.loss = loss
+        self.silent = silent
+
+        self.sent = 0
+        self._clock = 0.0
+        self._events = []
+        self._rng = random.Random(seed)
+        self._paths = {}
+
+    def _router(self, prefix: int, salt: int, base: str, bits: int) -> int:
+        return int(ipaddress.IPv4Address(base)) + (_mix(prefix * 64 + salt + self.seed) & ((1 << bits) - 1) | 1)
+
+    def path(self, target: int):
+        """Returns the hops of the path to a target as list of integers;
+        the last hop is the target.
+        """
+        if path := self._paths.get(target):
+            return path
+
+        p16, p24 = target >> 16, target >> 8
+        hops = [int(ipaddress.IPv4Address("10.0.0.1")) + i for i in range(self.NEAR)]
+        hops += [self._router(p16, i, "100.64.0.0", 22) for i in range(2 + _mix(p16) % 3)]
+        hops += [self._router(p24, i, "172.16.0.0", 20) for i in range(1 + _mix(p24) % 3)]
+        hops.append(target)
+
+        if len(self._paths) > 1 << 16:
+            self._paths.clear()
+
+        self._paths[target] = hops
+        return hops
+
+    def responsive(self, router: int) -> bool:
+        return (_mix(router ^ self.seed) % 1000) >= self.silent * 1000
+
+    def rtt(self, target: int, hop: int) -> float:
+        return 0.002 + 0.003 * hop + (_mix(target + hop) % 1000) / 1e6
+
+    def now(self) -> float:
+        return self._clock
+
+    def send(self, packet: bytes):
+        self.sent += 1
+
+        if self.loss and self._rng.random() < self.loss:
+            return
+
+        ttl = packet[8]
+        target = int.from_bytes(packet[16:20], "big")
+        path = self.path(target)
+        hop = min(ttl, len(path)) - 1
+        router = path[hop]
+
+        if router != target and not self.responsive(router):
+            return
+
+        # Each router in front of this one decremented the TTL
+        if router == target:
+            reply = build_reply(packet[16:20], packet[12:16], 3, 3, packet, ttl - hop)
+        else:
+            reply = build_reply(router.to_bytes(4, "big"), packet[12:16], 11, 0, packet, ttl - hop)
+
+        heapq.heappush(self._events, (self._clock + self.rtt(target, hop), self.sent, reply))
+
+    def wait(self, timeout: float):
+        """Advances the virtual clock to the next reply, at most by the
+        timeout, and returns the replies that arrived until then.
+        """
+        deadline = self._clock + max(0.0, timeout)
+
+        if self._events and self._events[0][0] <= deadline:
+            self._clock = max(self._clock, self._events[0][0])
+        else:
+            self._clock = deadline
+
+        replies = []
+        while self._events and self._events[0][0] <= self._clock:
+            replies.append(heapq.heappop(self._events)[2])
+
+        return replies
+
+    def close(self):
+        self._events = []
+
+
+# ----------------------------------------------------------------------
+# Engine
+# ----------------------------------------------------------------------
+
+class StatelessTracer:
+    """Traces a block of targets at once. The (target, TTL) pairs are
+    probed in a random order at the given packet rate.
+
+    Args:
+        backend: Packet I/O, e.g. RawBackend or SimulatedBackend.
+        rate (int): Probes per second.
+        min_ttl (int): First TTL to probe.
+        max_ttl (int): Last TTL to probe.
+        wait (float): Seconds to wait for replies after the last probe.
+        seed (int): Seed of the probing order.
+    """
+
+    def __init__(
+        self,
+        backend,
+        rate: int = 1000,
+        min_ttl: int = 1,
+        max_ttl: int = 16,
+        wait: float = 2.0,
+        seed: int = None,
+    ):
+        self.backend = backend
+        self.rate = max(1, rate)
+        self.min_ttl = max(1, min_ttl)
+        self.max_ttl = min(255, max(self.min_ttl, max_ttl))
+        self.wait = min(wait, TICKS * TICK * 0.9)
+        self.seed = seed if seed is not None else random.getrandbits(32)
+
+        self.src = socket.inet_aton(backend.source)
+        self.sent = 0
+        self.received = 0
+        # Set from another thread to abort a running trace
+        self.stopped = False
+
+    def _ticks(self) -> int:
+        return int(self.backend.now() / TICK) % TICKS + 1
+
+    def _handle(self, packets, index: dict, hops: list):
+        now = self._ticks()
+
+        for packet in packets:
+            reply = parse_reply(packet)
+            if reply is None:
+                continue
+
+            hop, target, ttl, sent, icmp_type, icmp_code = reply
+            idx = index.get(target)
+            if idx is None or not self.min_ttl <= ttl <= self.max_ttl:
+                continue
+
+            self.received += 1
+            rtt = ((now - sent) % TICKS) * TICK * 1000.0
+
+            if icmp_type == 11:
+                annotation = ""
+            else:
+                # Destination unreachable, usually the target itself
+                annotation = UNREACH.get(icmp_code, f"!{icmp_code}")
+
+            # Keep the first reply per TTL
+            hops[idx].setdefault(ttl, (socket.inet_ntoa(hop), round(rtt, 3), annotation, icmp_type == 3))
+
+    def _pace(self, start: float, index: dict, hops: list):
+        """Waits until the next probe may be sent and handles the
+        replies in the meantime.
+        """
+        while True:
+            due = start + self.sent / self.rate - self.backend.now()
+            if due <= 0:
+                return
+            self._handle(self.backend.wait(due), index, hops)
+
+    def trace(self, targets: list):
+        """Traces a list of IPv4 addresses. Returns one dict per target,
+        mapping the TTL to a tuple (hop, rtt, annotation, unreachable).
+        """
+        addrs = [socket.inet_aton(t) for t in targets]
+        index = {a: i for i, a in enumerate(addrs)}
+        hops = [{} for _ in targets]
+        nttl = self.max_ttl - self.min_ttl + 1
+
+        start = self.backend.now() - self.sent / self.rate
+
+        for k in permutation(len(addrs) * nttl, self.seed):
+            if self.stopped:
+                break
+
+            self._pace(start, index, hops)
+            self._probe(addrs[k // nttl], self.min_ttl + k % nttl)
+
+        self._drain(index, hops)
+        return hops
+
+    def _probe(self, target: bytes, ttl: int):
+        self.backend.send(build_probe(self.src, target, ttl, self._ticks()))
+        self.sent += 1
+
+    def _drain(self, index: dict, hops: list):
+        """Handles the replies until the wait time is over."""
+        deadline = self.backend.now() + self.wait
+        while (left := deadline - self.backend.now()) > 0 and not self.stopped:
+            self._handle(self.backend.wait(left), index, hops)
+
+
+class DoubletreeTracer(StatelessTracer):
+    """Traces with Doubletree-style redundancy reduction (Donnet et
+    al., 2005). Probing starts at `start_ttl` and goes forward and then
+    backward, one TTL per round. A target stops forward probing once it
+    reaches an (interface, destination prefix) pair of the global stop
+    set, and backward probing once it reaches an interface of the local
+    stop set. The rest of its path is inferred from the target that
+    added the entry; such hops are annotated as `inferred`. The stop
+    sets are kept for the whole run.
+
+    Args:
+        start_ttl (int): TTL of the first round.
+        prefix (int): Prefix length of the destination prefixes.
+        gap (int): Consecutive TTLs without reply that end a path.
+    """
+
+    def __init__(self, backend, start_ttl: int = 4, prefix: int = 24, gap: int = 3, **kwargs):
+        super().__init__(backend, **kwargs)
+
+        self.start_ttl = min(self.max_ttl, max(self.min_ttl, start_ttl))
+        self.mask = (0xFFFFFFFF << (32 - prefix)) & 0xFFFFFFFF
+        self.gap = gap
+
+        # (interface, prefix) -> hops after the interface, and
+        # interface -> hops before the interface. Entries of the current
+        # block are (target index, TTL) until the block is done.
+        self.global_stop = {}
+        self.local_stop = {}
+
+        self.inferred = 0
+
+    def _round(self, probes: list, addrs: list, index: dict, hops: list):
+        """Sends a list of (target index, TTL) probes in random order and
+        waits for the replies.
+        """
+        start = self.backend.now() - self.sent / self.rate
+
+        for k in permutation(len(probes), self.seed + self.sent):
+            if self.stopped:
+                return
+
+            self._pace(start, index, hops)
+            idx, ttl = probes[k]
+            self._probe(addrs[idx], ttl)
+
+        self._drain(index, hops)
+
+    def trace(self, targets: list):
+        addrs = [socket.inet_aton(t) for t in targets]
+        index = {a: i for i, a in enumerate(addrs)}
+        prefixes = [int.from_bytes(a, "big") & self.mask for a in addrs]
+        hops = [{} for _ in targets]
+
+        # Target index -> (TTL, stop set key) of the stop
+        fwd_stops = {}
+        bwd_stops = {}
+
+        # Forward probing
+        active = list(range(len(addrs)))
+        stars = [0] * len(addrs)
+
+        for ttl in range(self.start_ttl, self.max_ttl + 1):
+            if not active:
+                break
+
+            self._round([(idx, ttl) for idx in active], addrs, index, hops)
+            still = []
+
+            for idx in active:
+                reply = hops[idx].get(ttl)
+
+                if reply is None:
+                    stars[idx] += 1
+                    if stars[idx] < self.gap:
+                        still.append(idx)
+                    continue
+
+                stars[idx] = 0
+                key = (reply[0], prefixes[idx])
+
+                if key in self.global_stop:
+                    fwd_stops[idx] = (ttl, key)
+                    continue
+
+                self.global_stop[key] = (idx, ttl)
+
+                if not reply[3]:
+                    still.append(idx)
+
+            active = still
+
+        # Infer the rest of the stopped paths, then probe the targets
+        # once behind the inferred hops to find their own last hop.
+        last = []
+        for idx in list(fwd_stops):
+            ttl = self._complete_forward(hops, fwd_stops, idx)
+            if ttl is not None and ttl <= self.max_ttl:
+                last.append((idx, ttl))
+
+        self._round(last, addrs, index, hops)
+
+        # Backward probing
+        active = list(range(len(addrs)))
+
+        for ttl in range(self.start_ttl - 1, self.min_ttl - 1, -1):
+            if not active:
+                break
+
+            self._round([(idx, ttl) for idx in active], addrs, index, hops)
+            still = []
+
+            for idx in active:
+                reply = hops[idx].get(ttl)
+
+                if reply is None:
+                    still.append(idx)
+                elif reply[0] in self.local_stop:
+                    bwd_stops[idx] = (ttl, reply[0])
+                else:
+                    self.local_stop[reply[0]] = (idx, ttl)
+                    still.append(idx)
+
+            active = still
+
+        self._infer(hops, bwd_stops)
+        return hops
+
+    def _suffix(self, hops: list, fwd_stops: dict, key, seen=()):
+        """Returns the hops after the interface of a stop set entry."""
+        entry = self.global_stop[key]
+        if isinstance(entry, list):
+            return entry
+
+        idx, ttl = entry
+        if idx in seen:
+            return []
+
+        self._complete_forward(hops, fwd_stops, idx, seen + (idx,))
+
+        # The routers up to the destination of the discoverer. The reply
+        # of the destination itself tells nothing about other targets.
+        suffix = []
+        for t in range(ttl + 1, max(hops[idx], default=ttl) + 1):
+            hop = hops[idx].get(t)
+            if hop is not None and hop[3]:
+                break
+            suffix.append(hop)
+
+        return suffix
+
+    def _complete_forward(self, hops: list, fwd_stops: dict, idx: int, seen=()):
+        """Fills in the hops of a target after its forward stop. Returns
+        the first TTL behind the inferred hops.
+        """
+        if idx not in fwd_stops:
+            return None
+
+        ttl, key = fwd_stops.pop(idx)
+        suffix = self._suffix(hops, fwd_stops, key, seen)
+
+        for offset, hop in enumerate(suffix, start=1):
+            if hop is not None and ttl + offset <= self.max_ttl:
+                if ttl + offset not in hops[idx]:
+                    hops[idx][ttl + offset] = (hop[0], -1.0, "inferred", False)
+                    self.inferred += 1
+
+        return ttl + len(suffix) + 1
+
+    def _prefix(self, hops: list, iface: str):
+        """Returns the hops before an interface of the local stop set."""
+        entry = self.local_stop[iface]
+        if isinstance(entry, list):
+            return entry
+
+        idx, ttl = entry
+        return [hops[idx].get(t) for t in range(self.min_ttl, ttl)]
+
+    def _infer(self, hops: list, bwd_stops: dict):
+        """Fills in the first hops of the targets stopped backward and
+        turns the stop set entries of this block into hop lists for the
+        next blocks.
+        """
+        for idx, (ttl, iface) in bwd_stops.items():
+            for t, hop in enumerate(self._prefix(hops, iface), start=self.min_ttl):
+                if hop is not None and t < ttl and t not in hops[idx]:
+                    hops[idx][t] = (hop[0], -1.0, "inferred", hop[3])
+                    self.inferred += 1
+
+        for key, entry in self.global_stop.items():
+            if not isinstance(entry, list):
+                self.global_stop[key] = self._suffix(hops, {}, key)
+
+        for iface, entry in self.local_stop.items():
+            if not isinstance(entry, list):
+                self.local_stop[iface] = self._prefix(hops, iface)
+
+
+def path_rows(target: str, hops: dict, min_ttl: int, max_ttl: int):
+    """Turns the replies of a target into rows of the bulktrace CSV
+    schema. Probing stops at the first TTL reaching the target; TTLs
+    without reply are written as `*`.
+    """
+    last = 0
+    for ttl, (_, _, _, unreachable) in hops.items():
+        if unreachable:
+            last = ttl if last == 0 else min(last, ttl)
+
+    if last == 0:
+        last = max(hops) if hops else 0
+
+    rows = []
+    for ttl in range(min_ttl, min(last, max_ttl) + 1):
+        if ttl in hops:
+            ip, rtt, annotation, _ = hops[ttl]
+            rows.append((target, target, ttl, 0, ip, ip, rtt, annotation))
+        else:
+            rows.append((target, target, ttl, 0, "*", "*", -1.0, ""))
+
+    return rows